@@ -30,6 +30,7 @@ import datetime
 import glob
 from dft.cli_command import CliCommand
 from dft.enumkey import Key
+from dft.tree_copier import TreeCopier
 
 
 #
@@ -129,6 +130,9 @@ class AssembleFirmware(CliCommand):
     # to the init script ( needed to call the stacking script )
     self.update_initramfs()
 
+    # All the commands have been executed, stop the chroot session
+    self.stop_chroot_session()
+
     # Remove QEMU if it has been isntalled. It has to be done in the end
     # since some cleanup tasks could need QEMU
     if self.use_qemu_static:
@@ -160,6 +164,10 @@ class AssembleFirmware(CliCommand):
     # Install initramfs-tools to the rootfs
     self.install_package("initramfs-tools")
 
+    # veritysetup is needed by the stacking script to open the dm-verity devices
+    if self.is_verity_activated():
+      self.install_package("cryptsetup-bin")
+
 
 
   # -------------------------------------------------------------------------
@@ -177,9 +185,8 @@ class AssembleFirmware(CliCommand):
     self.project.logging.info("Updating initramfs")
 
     # Copy the stacking script to /tmp in the rootfs
-    command = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-    command += " update-initramfs -t -u -k all"
-    self.execute_command(command)
+    command = "update-initramfs -t -u -k all"
+    self.execute_in_chroot(command)
 
     # Check if we have to run mkimage to make it bootable on ARM or PowerPC
     # boards
@@ -248,10 +255,14 @@ class AssembleFirmware(CliCommand):
     # Create boot  under firmware directory
     os.makedirs(self.project.get_firmware_content_directory() + "/boot", exist_ok=True)
 
-    # Copy the stacking script to /tmp in the rootfs
+    # Copy the boot directory of the rootfs, preserving all the metadata
     source_dir = self.project.get_rootfs_mountpoint() + '/boot/'
-    command = "cp -fra " + source_dir + " " + self.project.get_firmware_content_directory()
-    self.execute_command(command)
+    try:
+      copier = TreeCopier(self.project.logging, self.project.get_copy_concurrency())
+      copier.copy(source_dir, self.project.get_firmware_content_directory() + "/boot")
+    except OSError as exception:
+      self.project.logging.critical("Error: %s - %s.", exception.filename, exception.strerror)
+      exit(1)
 
     # for copy_target in os.listdir(source_dir):
     #   copy_source_path = os.path.join(source_dir, copy_target)
@@ -294,6 +305,10 @@ class AssembleFirmware(CliCommand):
         self.project.logging.error("Unknown stacking method " +
                                    self.project.firmware[Key.LAYOUT.value][Key.METHOD.value])
 
+      # dm-verity is needed to check the squashfs files
+      if self.is_verity_activated():
+        working_file.write("dm-verity\n")
+
       # Check if there is an initramfs customization section
       if Key.INITRAMFS.value in self.project.firmware:
         # Yes, so now look for an additional module section
@@ -368,6 +383,8 @@ class AssembleFirmware(CliCommand):
       working_file.write("# ----- Copy the binaries using copy_exec -----\n")
       working_file.write("copy_exec /sbin/fsck.ext4 /sbin\n")
       working_file.write("copy_exec /sbin/e2fsck    /sbin\n")
+      if self.is_verity_activated():
+        working_file.write("copy_exec /sbin/veritysetup /sbin\n")
 
       # Check if there is an initramfs customization section
       if Key.INITRAMFS.value in self.project.firmware:
@@ -588,10 +605,22 @@ class AssembleFirmware(CliCommand):
 
       # ----- Generate the mount command to be used for a SQUASHFS file ----------------------------
       if item[Key.STACK_ITEM.value][Key.TYPE.value] == Key.SQUASHFS.value:
+        squashfs_path = self.dft_root + "/"
+        squashfs_path += self.project.firmware[Key.LAYOUT.value][Key.PATH.value] + "/"
+        squashfs_path += item[Key.STACK_ITEM.value][Key.SQUASHFS_FILE.value]
         working_file.write("DEV=$(losetup -f)\n")
-        working_file.write("losetup ${DEV} " + self.dft_root + "/")
-        working_file.write(self.project.firmware[Key.LAYOUT.value][Key.PATH.value] + "/")
-        working_file.write(item[Key.STACK_ITEM.value][Key.SQUASHFS_FILE.value] + "\n")
+        working_file.write("losetup ${DEV} " + squashfs_path + "\n")
+
+        # With dm-verity, the squashfs is mounted through a verity device checking each block
+        # when it is read, against the hash tree stored next to the squashfs. build_firmware
+        # produces only one squashfs file, thus there is a single root hash
+        if self.is_verity_activated():
+          device_name = "dft-" + item[Key.STACK_ITEM.value][Key.NAME.value]
+          working_file.write("HASH_DEV=$(losetup -f)\n")
+          working_file.write("losetup ${HASH_DEV} " + squashfs_path + ".verity\n")
+          working_file.write("veritysetup open ${DEV} " + device_name + " ${HASH_DEV} ")
+          working_file.write(self.get_verity_root_hash() + "\n")
+          working_file.write("DEV=/dev/mapper/" + device_name + "\n")
         working_file.write("mount -r -t squashfs")
 
         # Is there some defined options ?
@@ -633,6 +662,44 @@ class AssembleFirmware(CliCommand):
     working_file.close()
 
 
+  # -------------------------------------------------------------------------
+  #
+  # is_verity_activated
+  #
+  # -------------------------------------------------------------------------
+  def is_verity_activated(self):
+    """Returns True if dm-verity is activated in the security section
+    """
+
+    security = self.project.firmware.get(Key.SECURITY.value) or {}
+    return bool(security.get(Key.VERITY.value, False))
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_verity_root_hash
+  #
+  # -------------------------------------------------------------------------
+  def get_verity_root_hash(self):
+    """This method returns the dm-verity root hash of the firmware, written by
+    build_firmware next to the squashfs file.
+    """
+
+    # Check that the root hash has been generated
+    root_hash_path = self.project.firmware_filename + ".roothash"
+    if not os.path.isfile(root_hash_path):
+      self.project.logging.critical("The dm-verity root hash does not exist (" +
+                                    root_hash_path + "). Did you forget to run " +
+                                    "build_firmware command before ?")
+      exit(1)
+
+    # Read the root hash
+    with open(root_hash_path, "r") as root_hash_file:
+      return root_hash_file.read().strip()
+
+
+
   # -------------------------------------------------------------------------
   #
   # generate_overlayfs_stacking
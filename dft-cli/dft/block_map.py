@@ -0,0 +1,165 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the generation of block map files, using the
+bmaptool format (version 2.0). The block map lists the blocks of the image
+containing data, thus flashing tools only write these blocks instead of the
+whole image.
+"""
+
+import hashlib
+
+# -----------------------------------------------------------------------------
+#
+#    Class BlockMap
+#
+# -----------------------------------------------------------------------------
+class BlockMap(object):
+  """This class builds the block map of an image from its data extents. The
+  checksums of the ranges are computed from the data given to update, which
+  has to be called in the order of the image. Thus the image is read only
+  once, by the caller (usually while compressing it).
+  """
+
+  # Size of the blocks described by the map
+  BLOCK_SIZE = 4096
+
+  # Template of the block map file
+  TEMPLATE = """<?xml version="1.0" ?>
+<!-- This file contains the block map for an image file, which is basically
+     a list of useful (mapped) block numbers in the image file. In other words,
+     it lists only those blocks which contain data (boot sector, partition
+     table, file-system metadata, files, directories, extents, etc). These
+     blocks have to be copied to the target device. The other blocks do not
+     contain any useful data and do not have to be copied to the target
+     device. -->
+<bmap version="2.0">
+    <ImageSize> {image_size} </ImageSize>
+    <BlockSize> {block_size} </BlockSize>
+    <BlocksCount> {blocks_count} </BlocksCount>
+    <MappedBlocksCount> {mapped_blocks_count} </MappedBlocksCount>
+    <ChecksumType> sha256 </ChecksumType>
+    <BmapFileChecksum> {file_checksum} </BmapFileChecksum>
+    <BlockMap>
+{ranges}    </BlockMap>
+</bmap>
+"""
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, image_size, extents):
+    """Default constructor. Extents is the sorted list of the (start, end)
+    byte ranges of the image containing data.
+    """
+
+    # Size of the image in bytes
+    self.image_size = image_size
+
+    # List of the mapped ranges, as inclusive (first block, last block). Extents are
+    # aligned on blocks, and merged if they share a block
+    self.ranges = []
+    for start, end in extents:
+      first = start // self.BLOCK_SIZE
+      last = (min(end, image_size) - 1) // self.BLOCK_SIZE
+      if len(self.ranges) > 0 and first <= self.ranges[-1][1] + 1:
+        self.ranges[-1] = (self.ranges[-1][0], max(last, self.ranges[-1][1]))
+      else:
+        self.ranges.append((first, last))
+
+    # Checksum of each range, and index of the first range not completely hashed
+    self.hashers = [hashlib.sha256() for _ in self.ranges]
+    self.index = 0
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # update
+  #
+  # -------------------------------------------------------------------------
+  def update(self, offset, data):
+    """This method hashes the part of the mapped ranges contained in the data
+    read at offset in the image.
+    """
+
+    # Compute the bounds of the data, and use a view to avoid copies
+    end = offset + len(data)
+    view = memoryview(data)
+
+    # Walk the ranges intersecting the data
+    while self.index < len(self.ranges):
+      range_start = self.ranges[self.index][0] * self.BLOCK_SIZE
+      range_end = min((self.ranges[self.index][1] + 1) * self.BLOCK_SIZE, self.image_size)
+
+      # Stop if the range is after the data
+      if range_start >= end:
+        break
+
+      # Hash the intersection of the range and the data
+      low = max(range_start, offset)
+      high = min(range_end, end)
+      if low < high:
+        self.hashers[self.index].update(view[low - offset:high - offset])
+
+      # Move to the next range only if this one is complete
+      if range_end > end:
+        break
+      self.index += 1
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # write
+  #
+  # -------------------------------------------------------------------------
+  def write(self, path):
+    """This method writes the block map file. The checksum of the file is
+    computed with the checksum field filled with zeros, as bmaptool does.
+    """
+
+    # Generate the list of ranges
+    ranges = ""
+    mapped_blocks_count = 0
+    for (first, last), hasher in zip(self.ranges, self.hashers):
+      if first == last:
+        blocks = str(first)
+      else:
+        blocks = str(first) + "-" + str(last)
+      ranges += '        <Range chksum="' + hasher.hexdigest() + '"> ' + blocks + ' </Range>\n'
+      mapped_blocks_count += last - first + 1
+
+    # Generate the content with a zero checksum, then fill the actual checksum
+    values = {"image_size": self.image_size,
+              "block_size": self.BLOCK_SIZE,
+              "blocks_count": (self.image_size + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE,
+              "mapped_blocks_count": mapped_blocks_count,
+              "file_checksum": "0" * 64,
+              "ranges": ranges}
+    content = self.TEMPLATE.format(**values)
+    values["file_checksum"] = hashlib.sha256(content.encode()).hexdigest()
+    content = self.TEMPLATE.format(**values)
+
+    # And write it
+    with open(path, "w") as bmap_file:
+      bmap_file.write(content)
@@ -29,6 +29,8 @@ import shutil
 from shutil import rmtree
 from dft.cli_command import CliCommand
 from dft.enumkey import Key
+from dft.firmware_checksums import FirmwareChecksums
+from dft.verity_tree import VerityHashTree
 
 #
 #    Class BuildFirmware
@@ -94,6 +96,10 @@ class BuildFirmware(CliCommand):
     # Generate the squashfs files
     self.create_squashfs_files()
 
+    # Generate the dm-verity hash tree. It may pad the squashfs, thus it is done before the
+    # checksums
+    self.create_squashfs_verity()
+
     # Generate checksums for squashfs_files
     self.create_squashfs_checksums()
 
@@ -153,52 +159,119 @@ class BuildFirmware(CliCommand):
   #
   # -------------------------------------------------------------------------
   def create_squashfs_checksums(self):
-    """This method generates the checksum files (MD5 SHA1 or SHA256) according
-    to the security options defined in the firmware section of the project.
+    """This method generates the checksum files (MD5 SHA1 SHA224 SHA256 SHA384
+    SHA512 or BLAKE2B) according to the security options defined in the
+    firmware section of the project.
+
+    The algorith to use is defined by the security:hash-method key. It can be
+    a single algorithm or a list of algorithms, all the checksums are
+    computed in a single read of the squashfs file.
 
-    The algorith to use is defined by the security:hash-method key
+    If security:block_hash_size is defined, the list of the digests of each
+    block of the file is also generated, in the .blocks file. It is used to
+    check the file in chunks.
     """
 
     # Test if the security section is defined
-    if Key.SECURITY.value in self.project.firmware:
-      # Yes, thus test if the hash-method is defined. If not defined, default
-      # value is applied. Default value is "no hash"
-      if Key.HASH_METHOD.value in self.project.firmware[Key.SECURITY.value]:
-        # Convert hash-method to lower case in order to use it as command prefix
-        self.project.firmware[Key.SECURITY.value][Key.HASH_METHOD.value] = self.project.\
-                                    firmware[Key.SECURITY.value][Key.HASH_METHOD.value].lower()
-
-        # Check that the algorith is valid (valid values are md5 sha1 sha224 sha256 sha384 sha512)
-        if self.project.firmware[Key.SECURITY.value][Key.HASH_METHOD.value] in \
-                                    [Key.MD5.value, Key.SHA1.value, Key.SHA224.value, \
-                                     Key.SHA256.value, Key.SHA384, Key.SHA512]:
-          # Output some fancy logs :)
-          self.project.logging.info("Generating hash file " + self.project.firmware_filename + "." +
-                                    self.project.firmware[Key.SECURITY.value]\
-                                                             [Key.HASH_METHOD.value])
-
-          # Generate the hash tool call
-          cmd = self.project.firmware[Key.SECURITY.value][Key.HASH_METHOD.value] + "sum " + '"'
-          cmd += self.project.firmware_filename + '" > "' + self.project.firmware_filename
-          cmd += "." + self.project.firmware[Key.SECURITY.value][Key.HASH_METHOD.value] + '"'
-
-          # Execute the hash generation command
-          self.execute_command(cmd)
-
-        # Algorithm is unknown, output an error and exit
-        else:
-          self.project.logging.error("The hash-method is unknown (" +
-                                     self.project.firmware[Key.SECURITY.value]\
-                                                              [Key.HASH_METHOD.value] + ")")
-          exit(1)
-
-      # Not defined, thus no hash generated,just log it
-      else:
-        self.project.logging.info("The key hash-method is not defined under security in this" +
-                                  " firmware definition. No hash produced")
-    else:
+    if Key.SECURITY.value not in self.project.firmware:
       self.project.logging.info("The security section is not defined under security in this" +
                                 " firmware definition. No hash produced")
+      return
+    security = self.project.firmware[Key.SECURITY.value]
+
+    # Yes, thus test if the hash-method is defined. If not defined, default value is
+    # applied. Default value is "no hash"
+    algorithms = security.get(Key.HASH_METHOD.value) or []
+    if not isinstance(algorithms, list):
+      algorithms = [algorithms]
+    algorithms = [str(algorithm).lower() for algorithm in algorithms]
+
+    # Retrieve the block list parameters
+    block_size = int(security.get(Key.BLOCK_HASH_SIZE.value, 0))
+    block_algorithm = str(security.get(Key.BLOCK_HASH_METHOD.value, Key.SHA256.value)).lower()
+    if len(algorithms) == 0 and block_size <= 0:
+      self.project.logging.info("The key hash-method is not defined under security in this" +
+                                " firmware definition. No hash produced")
+      return
+
+    # Check that the algoriths are valid
+    for algorithm in algorithms + [block_algorithm]:
+      if algorithm not in FirmwareChecksums.ALGORITHMS:
+        self.project.logging.error("The hash-method is unknown (" + algorithm + ")")
+        exit(1)
+
+    # Output some fancy logs :)
+    for algorithm in algorithms:
+      self.project.logging.info("Generating hash file " + self.project.firmware_filename + "." +
+                                algorithm)
+
+    # Compute the checksums, and write the files
+    checksums = FirmwareChecksums(algorithms, block_size, block_algorithm)
+    checksums.compute(self.project.firmware_filename)
+    checksums.write_checksum_files(self.project.firmware_filename)
+    if block_size > 0:
+      self.project.logging.info("Generating block hash list " + self.project.firmware_filename +
+                                ".blocks")
+      checksums.write_block_list(self.project.firmware_filename + ".blocks")
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # create_squashfs_verity
+  #
+  # -------------------------------------------------------------------------
+  def create_squashfs_verity(self):
+    """This method generates the dm-verity hash tree of the squashfs file, if
+    security:verity is activated. The tree is written to the .verity file,
+    and the root hash to the .roothash file. The root hash is included in
+    the stacking script by assemble_firmware, then the kernel checks each
+    block of the squashfs when it is read.
+
+    The squashfs is padded with zeros to a multiple of the block size if
+    needed (mksquashfs pads to 4096 bytes unless nopad is set).
+    """
+
+    # Check that verity is activated
+    security = self.project.firmware.get(Key.SECURITY.value) or {}
+    if not security.get(Key.VERITY.value, False):
+      self.project.logging.debug("dm-verity is not activated. No hash tree produced")
+      return
+
+    # Output some fancy logs :)
+    self.project.logging.info("Generating dm-verity hash tree " + self.project.firmware_filename +
+                              ".verity")
+
+    # Retrieve the parameters of the tree. The salt is random if not defined
+    salt = security.get(Key.VERITY_SALT.value)
+    try:
+      if salt is not None:
+        salt = bytes.fromhex(str(salt))
+      tree = VerityHashTree(str(security.get(Key.VERITY_HASH_METHOD.value,
+                                             Key.SHA256.value)).lower(),
+                            int(security.get(Key.VERITY_BLOCK_SIZE.value, 4096)), salt)
+    except ValueError as exception:
+      self.project.logging.critical("Invalid dm-verity parameters : " + str(exception))
+      exit(1)
+    errors = tree.check_parameters()
+    if len(errors) > 0:
+      for error in errors:
+        self.project.logging.critical("Invalid dm-verity parameters : " + error)
+      exit(1)
+
+    # Pad the squashfs to the block size
+    padding = -os.path.getsize(self.project.firmware_filename) % tree.block_size
+    if padding > 0:
+      self.project.logging.debug("Padding the squashfs with %d bytes" % padding)
+      with open(self.project.firmware_filename, "ab") as squashfs_file:
+        squashfs_file.write(bytes(padding))
+
+    # Compute the tree and write the files
+    root_hash = tree.compute(self.project.firmware_filename)
+    tree.write(self.project.firmware_filename + ".verity")
+    with open(self.project.firmware_filename + ".roothash", "w") as root_hash_file:
+      root_hash_file.write(root_hash + "\n")
+    self.project.logging.info("dm-verity root hash is " + root_hash)
 
 
 
@@ -281,7 +354,8 @@ class BuildFirmware(CliCommand):
       if self.project.firmware["configuration"]["nopad"]:
         cmd += ' -nopad '
 
-    self.execute_command(cmd)
+    # Run mksquashfs. Its progress output is only streamed to the logs, it is not parsed
+    self.execute_command(cmd, capture_output=False)
 
     # Final log
     logging.info("Firmware has been successfully generated into : "\
@@ -24,9 +24,15 @@ setting up the firmware in memory at system boot.
 
 import logging
 import os
+import shutil
 import tarfile
+import tempfile
+import subprocess
 from dft.cli_command import CliCommand
 from dft.enumkey import Key
+from dft.firmware_delta import FirmwareDelta
+from dft.update_archive import UpdateArchive
+from dft.update_archive import ArchiveStream
 
 
 #
@@ -38,6 +44,11 @@ class BuildFirmwareUpdate(CliCommand):
 
   """
 
+  # Suffixes appended to the archive filename, by compression method
+  COMPRESSION_SUFFIXES = {Key.GZIP.value: ".gz",
+                          Key.XZ.value: ".xz",
+                          Key.ZSTD.value: ".zst"}
+
   # -------------------------------------------------------------------------
   #
   # __init__
@@ -50,6 +61,9 @@ class BuildFirmwareUpdate(CliCommand):
     # Initialize ancestor
     CliCommand.__init__(self, dft, project)
 
+    # Flag set once the archive has been signed while it was written
+    self.streaming_signed = False
+
 
 
   # -------------------------------------------------------------------------
@@ -57,7 +71,7 @@ class BuildFirmwareUpdate(CliCommand):
   # build_update_archive
   #
   # -------------------------------------------------------------------------
-  def build_update_archive(self):
+  def build_update_archive(self, delta_base=None):
     """This method generates the final archive containing the elements of the
     firmware. The main steps :
     . Creating a manisfest describing the content items (hash value)
@@ -65,6 +79,9 @@ class BuildFirmwareUpdate(CliCommand):
     . Create a detached signature using either gnupg or openssl
 
     The two generated files are stored under firmware (same levelas content)
+
+    If delta_base is defined (a previous firmware content directory or update
+    archive), the archive contains only the delta against this base.
     """
 
     # Check that there is a firmware configuration file first
@@ -80,8 +97,13 @@ class BuildFirmwareUpdate(CliCommand):
                                      self.project.get_firmware_content_directory())
       exit(1)
 
+    # Check that the delta base exists
+    if delta_base is not None and not os.path.exists(delta_base):
+      self.project.logging.critical("The delta base " + delta_base + " does not exist")
+      exit(1)
+
     # Create the tar archive
-    self.create_main_archive()
+    self.create_main_archive(delta_base)
 
     # Sign the main archive
     self.sign_main_archive()
@@ -94,36 +116,228 @@ class BuildFirmwareUpdate(CliCommand):
   # create_main_archive
   #
   # -------------------------------------------------------------------------
-  def create_main_archive(self):
+  def create_main_archive(self, delta_base=None):
     """This method create the manifest of the archive (a file listing all the
     files with their checksums). Then it creates the archive to be signed.
 
     All the files are stored under firmware directory. In the en only two
     files should be produced. The archive, created by this method, and the
     detached signature. Coded in next method.
+
+    When building a delta update, the archive contains the delta manifest and
+    payload instead of the firmware content.
     """
 
     # Output current task to logs
     logging.info("Creating the main archive")
 
-    # Creating the manifest
+    # Creating the archive. The signature is created while writing it if streaming
+    # signature is activated
+    dest_archive = self.get_archive_path()
+    compress_command = self.get_compress_command()
+    sign_command = self.get_streaming_sign_command(dest_archive + ".sig")
+    self.streaming_signed = False
+
+    # Select the directory to archive, which is the delta when building a delta update
+    with tempfile.TemporaryDirectory(prefix="dft-delta-",
+                                     dir=self.project.get_firmware_output_directory()) \
+                                                                                 as work_dir:
+      content_directory = self.project.get_firmware_content_directory()
+      if delta_base is not None:
+        content_directory = self.create_delta(delta_base, work_dir)
+
+      # Create the tar itself. The manifest is the first member, and files are hashed while
+      # they are archived
+      if compress_command is None and sign_command is None:
+        with open(dest_archive, "wb") as archive_file:
+          UpdateArchive(self.project.logging).write(content_directory, archive_file)
+
+      # Otherwise the archive is streamed through the compressor and the signer
+      else:
+        if os.path.isfile(dest_archive + ".sig"):
+          os.remove(dest_archive + ".sig")
+        output = ArchiveStream(dest_archive, compress_command, sign_command)
+        output.open()
+        try:
+          UpdateArchive(self.project.logging).stream(content_directory, output)
+        finally:
+          errors = output.close()
+        if len(errors) > 0:
+          for error in errors:
+            self.project.logging.critical(error)
+          exit(1)
+        self.streaming_signed = sign_command is not None
+    logging.debug("Archive " + dest_archive + " has been created")
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_archive_path
+  #
+  # -------------------------------------------------------------------------
+  def get_archive_path(self):
+    """This method returns the path of the update archive. The suffix of the
+    compression method is appended to the filename.
+    """
 
-    # Creating the archive
     dest_archive = self.project.get_firmware_output_directory()
     dest_archive += "/" + self.project.firmware[Key.CONFIGURATION.value][Key.FILENAME.value]
+    update = self.project.firmware.get(Key.UPDATE.value) or {}
+    compression = str(update.get(Key.COMPRESSION.value, "")).lower()
+    return dest_archive + self.COMPRESSION_SUFFIXES.get(compression, "")
 
-    # Create the tar itself
-    tar = tarfile.open(name=dest_archive, mode='w')
 
-    # Iterate firmware content directory
-    for name in os.listdir(self.project.get_firmware_content_directory()):
-      # And add each and every file
-      filename = self.project.get_firmware_content_directory() + "/" + name
-      tar.add(filename, name, recursive=True)
 
-    # Let's close the tar to flushit
-    tar.close()
-    logging.debug("Archive " + dest_archive + " has been created")
+  # -------------------------------------------------------------------------
+  #
+  # get_compress_command
+  #
+  # -------------------------------------------------------------------------
+  def get_compress_command(self):
+    """This method returns the command compressing the archive from stdin to
+    stdout, according to the update section of the firmware definition, or
+    None if compression is not activated. Multi-threaded tools are used,
+    except for gzip when pigz is not installed.
+    """
+
+    # Retrieve the compression method
+    update = self.project.firmware.get(Key.UPDATE.value) or {}
+    compression = str(update.get(Key.COMPRESSION.value, "")).lower()
+    if compression == "" or compression == "none":
+      return None
+    elif compression not in self.COMPRESSION_SUFFIXES:
+      self.project.logging.critical("Unknown archive compression method : " + compression)
+      self.project.logging.critical("Valid values are gzip, xz, zstd or none")
+      exit(1)
+
+    # Retrieve the number of threads. 0 means one thread per CPU
+    threads = int(update.get(Key.COMPRESSION_THREADS.value, 0))
+    if threads <= 0:
+      threads = os.cpu_count()
+    options = update.get(Key.COMPRESSION_OPTIONS.value, "")
+
+    # Select the tool
+    if compression == Key.ZSTD.value:
+      command = "/usr/bin/env zstd -q -T" + str(threads)
+    elif compression == Key.XZ.value:
+      command = "/usr/bin/env xz -z -T" + str(threads)
+    elif shutil.which("pigz") is not None:
+      command = "/usr/bin/env pigz -p " + str(threads)
+    else:
+      command = "/usr/bin/env gzip"
+    return command + " -c " + options
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_streaming_sign_command
+  #
+  # -------------------------------------------------------------------------
+  def get_streaming_sign_command(self, dest_sign):
+    """This method returns the command signing the archive read from stdin,
+    or None if streaming signature is not activated. It is only available
+    with GnuPG.
+    """
+
+    # Check that streaming signature is activated, using GnuPG
+    security = self.project.firmware.get(Key.SECURITY.value) or {}
+    if not security.get(Key.STREAMING_SIGNATURE.value, False):
+      return None
+    signing_tool = security.get(Key.SIGNATURE.value, "")
+    if signing_tool not in [Key.GPG.value, Key.GPG2.value]:
+      self.project.logging.debug("Streaming signature is only available with gpg and gpg2")
+      return None
+
+    # Generate the command, the archive is read from stdin
+    command = signing_tool
+    if security.get(Key.GPG_ARMOR_SIGNATURE.value, False):
+      command += " --armor"
+    return command + " --output " + dest_sign + " --detach-sig"
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # create_delta
+  #
+  # -------------------------------------------------------------------------
+  def create_delta(self, delta_base, work_dir):
+    """This method creates the delta between the base firmware and the
+    firmware content directory, under the work directory. The delta is then
+    verified by reconstructing the firmware from the base and the delta. It
+    returns the directory containing the delta.
+    """
+
+    # Output current task to logs
+    logging.info("Creating the delta update against " + delta_base)
+
+    # Retrieve the delta configuration from the update section of the firmware definition
+    update = self.project.firmware.get(Key.UPDATE.value) or {}
+    method = update.get(Key.DELTA_METHOD.value, Key.ZSTD.value)
+    if method not in FirmwareDelta.PATCH_SUFFIXES:
+      self.project.logging.critical("Unknown delta method : " + method)
+      exit(1)
+    delta = FirmwareDelta(self.project.logging, method,
+                          int(update.get(Key.DELTA_BLOCK_SIZE.value, 65536)))
+
+    # An update archive used as a base is extracted first. tarfile does not support zstd,
+    # such archives are decompressed by the zstd tool
+    base_directory = delta_base
+    if os.path.isfile(delta_base):
+      base_directory = os.path.join(work_dir, "base")
+      if delta_base.endswith(self.COMPRESSION_SUFFIXES[Key.ZSTD.value]):
+        command = "/usr/bin/env zstd -q -d -c " + delta_base
+        decompressor = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+        with tarfile.open(fileobj=decompressor.stdout, mode="r|") as base_archive:
+          self.extract_archive(base_archive, base_directory)
+        if decompressor.wait() != 0:
+          self.project.logging.critical("Error occured when executing " + command)
+          exit(1)
+      else:
+        with tarfile.open(delta_base) as base_archive:
+          self.extract_archive(base_archive, base_directory)
+
+      # The manifest of the base archive is not part of the firmware content
+      base_manifest = os.path.join(base_directory, UpdateArchive.MANIFEST_NAME)
+      if os.path.isfile(base_manifest):
+        os.remove(base_manifest)
+
+    # Compute the delta
+    delta_directory = os.path.join(work_dir, "delta")
+    os.makedirs(delta_directory)
+    delta.create(base_directory, self.project.get_firmware_content_directory(), delta_directory,
+                 os.path.basename(delta_base.rstrip("/")))
+
+    # Verify it by reconstructing the firmware, as the device will do
+    errors = delta.apply(base_directory, delta_directory, os.path.join(work_dir, "verify"))
+    if len(errors) > 0:
+      for error in errors:
+        self.project.logging.critical("Delta verification failed : " + error)
+      exit(1)
+    logging.debug("Delta update has been verified successfully")
+
+    # Return the directory to archive
+    return delta_directory
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # extract_archive
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def extract_archive(archive, directory):
+    """This method extracts an opened tar archive into the directory. The
+    data filter is used when available, to reject unsafe members.
+    """
+
+    if hasattr(tarfile, "data_filter"):
+      archive.extractall(directory, filter="data")
+    else:
+      archive.extractall(directory)
 
 
 
@@ -148,12 +362,11 @@ class BuildFirmwareUpdate(CliCommand):
         signing_tool = self.project.firmware[Key.SECURITY.value][Key.SIGNATURE.value]
 
         # Generate the path to the archive and detached signature file
-        dest_archive = self.project.get_firmware_output_directory()
-        dest_archive += "/" + self.project.firmware[Key.CONFIGURATION.value][Key.FILENAME.value]
+        dest_archive = self.get_archive_path()
         dest_sign = dest_archive  + ".sig"
 
-        # Remove any exsting signature
-        if os.path.isfile(dest_sign):
+        # Remove any exsting signature, unless it has been created with the archive
+        if os.path.isfile(dest_sign) and not self.streaming_signed:
           os.remove(dest_sign)
           self.project.logging.info("Existing " + dest_archive + " has been removed")
 
@@ -182,9 +395,13 @@ class BuildFirmwareUpdate(CliCommand):
             # Yes, let's append --armor to the command
             command += " --armor"
 
-          command += " --output " + dest_sign + "  --detach-sig " + dest_archive
-          self.execute_command(command)
-          self.project.logging.info(dest_archive + " has been created and signed successfully")
+          # The archive does not need to be read again if it was signed while written
+          if self.streaming_signed:
+            self.project.logging.info(dest_archive + " has been signed while created")
+          else:
+            command += " --output " + dest_sign + "  --detach-sig " + dest_archive
+            self.execute_command(command)
+            self.project.logging.info(dest_archive + " has been created and signed successfully")
 
           # Update archive has been signed, let's verify signature before finishing
           command = signing_tool + " --verify " + dest_sign + " " + dest_archive
@@ -25,13 +25,19 @@ the rootfs and bootchain.
 
 import logging
 import os
+import errno
+import time
 import tempfile
 import shutil
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from distutils import file_util
 import parted
 from dft.cli_command import CliCommand
 from dft.enumkey import Key
+from dft.parallel_compressor import ParallelCompressor
+from dft.partition_job import PartitionJob
+from dft.tree_copier import TreeCopier
 from dft import release
 
 #
@@ -42,6 +48,16 @@ class BuildImage(CliCommand):
   written in flash memory or on a SD card.
   """
 
+  # Size of the chunks written when filling the image (random or preallocated zeros)
+  FILL_CHUNK_SIZE = 4 * 1024 * 1024
+
+  # Suffix of the compressed image for each compression method
+  COMPRESSION_SUFFIXES = {Key.LZMA.value: ".lzma",
+                          Key.XZ.value: ".xz",
+                          Key.BZIP2.value: ".bz2",
+                          Key.GZIP.value: ".gz",
+                          Key.ZSTD.value: ".zst"}
+
   # -------------------------------------------------------------------------
   #
   # __init__
@@ -66,6 +82,14 @@ class BuildImage(CliCommand):
     # Flag used to know if the image is mounted or not. Initial value is False
     self.image_is_mounted = False
 
+    # Flag used to know if the image is built without loopback device. In this mode the
+    # filesystems are generated into partition files, which are then copied into the image
+    self.loop_free = False
+
+    # Offset and size (in bytes) of each partition in the image, indexed by partition number.
+    # Filled once the partition table has been written
+    self.partition_geometries = {}
+
 
 
   # -------------------------------------------------------------------------
@@ -85,6 +109,10 @@ class BuildImage(CliCommand):
     . Install the boot sectors
     . Umount the image and release loopback
     . Compress image file if reuired
+
+    If loop_free is set in the devices section, no loopback device is used.
+    The filesystems are generated from staging directories into partition
+    files, which are copied into the image at the partition offsets.
     """
 
     # Control configuration file, and search for any missing information that could be a showstopper
@@ -93,6 +121,25 @@ class BuildImage(CliCommand):
     # Create the image file
     self.create_image_storage()
 
+    # Check if the image has to be built without loopback device
+    self.loop_free = self.project.image[Key.DEVICES.value].get(Key.LOOP_FREE.value, False)
+    if self.loop_free:
+      # Write the partition table directly into the image file
+      self.create_partitions_inside_image()
+
+      # Generate the partitions files, and copy them into the image
+      self.install_partition_files()
+
+      # Install the boot (either grub or uboot)
+      self.install_boot()
+
+      # Compress the generated image
+      self.compress_image()
+
+      # Final information if the information is available
+      self.project.logging.info("The image has been successfully generated in : " + self.image_path)
+      return
+
     # Create the loopbck device and mount the image file
     self.setup_loopback()
 
@@ -302,10 +349,79 @@ class BuildImage(CliCommand):
       self.project.logging.debug("Image target aldredy exist, removing it")
       os.remove(self.image_path)
 
-    # Create the fill command
-    command = 'dd if=/dev/' + fill_method + ' of="' + self.image_path
-    command += '" bs=' + str(block_size) + ' count=' + str(size)
-    self.execute_command(command)
+    # Check if the zero filled image has to be allocated on disk. By default it is sparse
+    sparse = True
+    if Key.SPARSE.value in self.project.image[Key.DEVICES.value]:
+      sparse = self.project.image[Key.DEVICES.value][Key.SPARSE.value]
+
+    # Create the image file. Only the bytes actually written will use space on disk
+    image_size = size * block_size
+    try:
+      with open(self.image_path, "wb") as image_file:
+        if fill_method == "random":
+          # Random content is written by chunks, thus memory usage does not depend on unit
+          self.project.logging.debug("Filling the image with random data")
+          self.__write_random_content(image_file, image_size)
+        elif sparse:
+          # Zero filled image is a sparse file, holes are read as zeros
+          self.project.logging.debug("Allocating a sparse image of " + str(image_size) + " bytes")
+          image_file.truncate(image_size)
+        else:
+          # Blocks are allocated without being written
+          self.project.logging.debug("Preallocating an image of " + str(image_size) + " bytes")
+          self.__preallocate_content(image_file, image_size)
+    except OSError as exception:
+      self.project.logging.critical("Cannot create the image file " + self.image_path + " : " +
+                                    str(exception))
+      exit(1)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __write_random_content
+  #
+  # -------------------------------------------------------------------------
+  def __write_random_content(self, image_file, image_size):
+    """This method fills the image file with random data. Data is generated
+    and written by chunks of bounded size.
+    """
+
+    # Write full chunks, then the remaining bytes
+    remaining = image_size
+    while remaining > 0:
+      chunk_size = min(self.FILL_CHUNK_SIZE, remaining)
+      image_file.write(os.urandom(chunk_size))
+      remaining -= chunk_size
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __preallocate_content
+  #
+  # -------------------------------------------------------------------------
+  def __preallocate_content(self, image_file, image_size):
+    """This method allocates the blocks of the image file on disk. It uses
+    fallocate if the filesystem supports it, and writes zeros otherwise.
+    """
+
+    # Try to allocate the blocks without writing them
+    try:
+      os.posix_fallocate(image_file.fileno(), 0, image_size)
+      return
+    except OSError as exception:
+      if exception.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+        raise
+      self.project.logging.debug("fallocate is not supported, writing zeros")
+
+    # Fallback to zero writing, by chunks
+    zeros = bytes(self.FILL_CHUNK_SIZE)
+    remaining = image_size
+    while remaining > 0:
+      chunk_size = min(self.FILL_CHUNK_SIZE, remaining)
+      image_file.write(zeros[:chunk_size])
+      remaining -= chunk_size
 
 
 
@@ -416,8 +532,11 @@ class BuildImage(CliCommand):
     # an exception
     try:
 
-      # Create the partition tabl on the device
-      device = parted.getDevice(self.loopback_device)
+      # Create the partition tabl on the device. Without loopback, the image file is used
+      if self.loop_free:
+        device = parted.getDevice(self.image_path)
+      else:
+        device = parted.getDevice(self.loopback_device)
 
       # Create a new disk object
       disk = parted.freshDisk(device, label)
@@ -511,8 +630,10 @@ class BuildImage(CliCommand):
           part_filesystem = None
         else:
           part_filesystem = partition[Key.FILESYSTEM.value].lower()
-          # Check that the value is in the list of valid values
-          if part_filesystem not in parted.fileSystemType:
+          # Check that the value is in the list of valid values. squashfs is unknown to parted
+          # but can be generated in loop free mode
+          if part_filesystem not in parted.fileSystemType and \
+             not (self.loop_free and part_filesystem == Key.SQUASHFS.value):
             self.project.logging.critical("Unknown filesystem type '" + part_filesystem +
                                           "' . Aborting")
             exit(1)
@@ -539,7 +660,8 @@ class BuildImage(CliCommand):
         geometry = parted.Geometry(start=part_start_sector, length=sector_count, device=device)
 
         # Create the parted filesystem object
-        if part_filesystem is not None:
+        filesys = None
+        if part_filesystem is not None and part_filesystem in parted.fileSystemType:
           filesys = parted.FileSystem(type=part_filesystem, geometry=geometry)
 
         # Create the partition object in the loopback device
@@ -561,8 +683,17 @@ class BuildImage(CliCommand):
         # Add the partition to the disk
         disk.addPartition(partition=new_partition, constraint=constraint)
 
-      # Make modification persistent to disk
-      disk.commit()
+      # Make modification persistent to disk. An image file has no partition to reload in the OS
+      if self.loop_free:
+        disk.commitToDevice()
+      else:
+        disk.commit()
+
+      # Store the geometry of the partitions, needed to copy partition files into the image
+      for new_partition in disk.partitions:
+        self.partition_geometries[new_partition.number] = \
+                    (new_partition.geometry.start * device.sectorSize,
+                     new_partition.geometry.length * device.sectorSize)
 
     except parted.PartitionException as exception:
       self.cleanup()
@@ -670,12 +801,14 @@ class BuildImage(CliCommand):
     #
     logging.debug("Starting to copy rootfs image content")
 
-    # Iterate the list of files in the rootfs and copy them to image
-    for copy_target in os.listdir(self.project.get_rootfs_mountpoint()):
-      copy_source_path = os.path.join(self.project.get_rootfs_mountpoint(), copy_target)
-      copy_target_path = os.path.join(image_mount_root, copy_target)
-      command = "cp -fra " + copy_source_path + " " + copy_target_path
-      self.execute_command(command)
+    # Copy the rootfs to the image, preserving all the metadata
+    try:
+      copier = TreeCopier(self.project.logging, self.project.get_copy_concurrency())
+      copier.copy(self.project.get_rootfs_mountpoint(), image_mount_root)
+    except OSError as exception:
+      self.cleanup()
+      self.project.logging.critical("Error: %s - %s.", exception.filename, exception.strerror)
+      exit(1)
 
     # Generate the bootscript
     self.generate_bootscript(image_mount_root)
@@ -696,6 +829,370 @@ class BuildImage(CliCommand):
 
 
 
+  # -------------------------------------------------------------------------
+  #
+  # install_partition_files
+  #
+  # -------------------------------------------------------------------------
+  def install_partition_files(self):
+    """This method is the loop free equivalent of filesystems creation,
+    labeling, content installation and checking. It does not need any loopback
+    device nor mount.
+
+    . The content of each partition is prepared in a staging directory
+    . Each filesystem is generated from its staging directory into a
+      partition file (mke2fs -d, mkfs.vfat and mtools, mksquashfs)
+    . The partition files are copied into the image at the partition offset
+    """
+
+    # Output current task to logs
+    logging.info("Generating the partitions files from staging directories")
+
+    # Get a temporary directory used to stage the partitions content
+    staging_root = tempfile.mkdtemp(dir=self.project.get_image_directory())
+
+    # Prepare the content of the partitions
+    if self.project.is_image_content_rootfs():
+      content_directories = self.stage_rootfs_content(staging_root)
+    else:
+      content_directories = self.stage_firmware_content(staging_root)
+
+    # Generate the filesystem of a partition and copy it into the image. Partitions do not
+    # overlap, thus they can be processed concurrently
+    def install_partition_file(job):
+      # Retrieve the partition format flag. Partitions not formatted are left untouched
+      if not job.format:
+        self.project.logging.debug("The format flag is deactivated for partition " +
+                                   str(job.index))
+        return
+
+      # Generate the partition file, then copy it into the image
+      part_path = self.build_partition_file(job.index, job.definition,
+                                            content_directories.get(job.index))
+      if part_path is not None:
+        self.splice_partition_file(part_path, job.index)
+        os.remove(part_path)
+
+    # Run the jobs
+    self.run_partition_jobs("partition file", install_partition_file)
+
+    # Remove the staging directories before exiting
+    shutil.rmtree(staging_root)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_indexed_partitions
+  #
+  # -------------------------------------------------------------------------
+  def get_indexed_partitions(self):
+    """This method returns the list of the partitions of the devices section,
+    as tuples (partition number, partition). Logical partitions are numbered
+    from 5.
+    """
+
+    # Defines the primary and logical partitions counters. First partitions are 1 and 5
+    primary_part_index = 0
+    logical_part_index = 4
+
+    # Iterate the partitions and compute their numbers
+    partitions = []
+    for partition in self.project.image[Key.DEVICES.value][Key.PARTITIONS.value]:
+      if partition.get(Key.TYPE.value) == Key.LOGICAL.value:
+        logical_part_index += 1
+        partitions.append((logical_part_index, partition))
+      else:
+        primary_part_index += 1
+        partitions.append((primary_part_index, partition))
+
+    # Return the numbered partitions
+    return partitions
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # stage_rootfs_content
+  #
+  # -------------------------------------------------------------------------
+  def stage_rootfs_content(self, staging_root):
+    """This method prepares the content of each partition from the rootfs.
+    The rootfs is copied (using hard links when possible) into a staging
+    tree, then the subtree of each partition mapping is moved into its own
+    directory, deepest mappings first, leaving an empty mount point.
+
+    It returns the dictionnary of staging directories by partition number.
+    """
+
+    # Copy the rootfs and generate the bootscript, as it is done when installing into mounts
+    tree = os.path.join(staging_root, "tree")
+    self.populate_staging_directory(self.project.get_rootfs_mountpoint(), tree)
+    self.generate_staged_bootscript(tree)
+
+    # Retrieve the mapping of the formatted partitions
+    mappings = []
+    for part_index, partition in self.get_indexed_partitions():
+      if partition.get(Key.FORMAT.value, False) and \
+         Key.CONTENT_PARTITION_MAPPING.value in partition:
+        mapping = os.path.normpath("/" + partition[Key.CONTENT_PARTITION_MAPPING.value])
+        mappings.append((part_index, mapping))
+
+    # Move the subtrees, deepest first, so /var/log is moved out of /var before /var itself
+    mappings.sort(key=lambda m: len(m[1].rstrip("/").split("/")), reverse=True)
+    content_directories = {}
+    for part_index, mapping in mappings:
+      part_directory = os.path.join(staging_root, "p" + str(part_index))
+
+      # The root partition takes whatever remains of the tree
+      if mapping == "/":
+        os.rename(tree, part_directory)
+      else:
+        source = tree + mapping
+        if os.path.isdir(source):
+          # Move the subtree and keep an empty mount point with the same attributes
+          os.rename(source, part_directory)
+          os.makedirs(source)
+          shutil.copystat(part_directory, source)
+        else:
+          os.makedirs(part_directory)
+      content_directories[part_index] = part_directory
+
+    # Return the staging directories
+    return content_directories
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # stage_firmware_content
+  #
+  # -------------------------------------------------------------------------
+  def stage_firmware_content(self, staging_root):
+    """This method prepares the content of the firmware partitions. Banks
+    receive the firmware content and the bootscript, the rescue partition
+    only receives the bootscript and the update partition is empty.
+
+    It returns the dictionnary of staging directories by partition number.
+    """
+
+    # Shortcut to the resilience section of the firmware
+    resilience = self.project.firmware[Key.RESILIENCE.value]
+    content_directories = {}
+
+    # Bank 0 is mandatory, bank 1 is populated if dual banks are activated
+    banks = [Key.BANK_0.value]
+    if resilience.get(Key.DUAL_BANKS.value, False):
+      banks.append(Key.BANK_1.value)
+    for bank in banks:
+      bank_directory = os.path.join(staging_root, bank)
+      self.populate_staging_directory(self.project.get_firmware_content_directory(),
+                                      bank_directory)
+      self.generate_staged_bootscript(bank_directory)
+      part_index = int(resilience[Key.PARTITIONS.value][bank][Key.PARTITION.value])
+      content_directories[part_index] = bank_directory
+
+    # Rescue firmware copy is not yet implemented, only the bootscript is generated
+    if resilience.get(Key.RESCUE_IMAGE.value, False):
+      rescue_directory = os.path.join(staging_root, Key.RESCUE.value)
+      os.makedirs(rescue_directory)
+      self.project.logging.info("Rescue firmware copy is not yet implemented")
+      self.generate_staged_bootscript(rescue_directory)
+      part_index = int(resilience[Key.PARTITIONS.value][Key.RESCUE.value][Key.PARTITION.value])
+      content_directories[part_index] = rescue_directory
+
+    # Update partition is created empty
+    if resilience.get(Key.UPDATE_PARTITION.value, False):
+      update_directory = os.path.join(staging_root, Key.UPDATE.value)
+      os.makedirs(update_directory)
+      part_index = int(resilience[Key.PARTITIONS.value][Key.UPDATE.value][Key.PARTITION.value])
+      content_directories[part_index] = update_directory
+
+    # Return the staging directories
+    return content_directories
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # populate_staging_directory
+  #
+  # -------------------------------------------------------------------------
+  def populate_staging_directory(self, source, target):
+    """This method copies the source directory into the staging directory.
+    Files are hard linked if source and target are on the same filesystem,
+    which avoids copying the data. Otherwise a regular copy is done.
+    """
+
+    # Create the target and try to hard link the content
+    os.makedirs(target, exist_ok=True)
+    command = 'cp -al "' + source + '/." "' + target + '"'
+    self.project.logging.debug("running : " + command)
+    if self.command_runner.run(command).succeeded():
+      return
+
+    # Hard links are not possible, fallback to a copy
+    self.project.logging.debug("Cannot hard link " + source + ", copying it")
+    shutil.rmtree(target)
+    os.makedirs(target)
+    self.execute_command('cp -a "' + source + '/." "' + target + '"')
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # generate_staged_bootscript
+  #
+  # -------------------------------------------------------------------------
+  def generate_staged_bootscript(self, target):
+    """This method generates the bootscript into a staging directory. The
+    staged files may be hard links to the rootfs, thus the generated files are
+    unlinked first to never modify the rootfs.
+    """
+
+    # Unlink the files written by generate_bootscript
+    for filename in ["boot.scr", "boot/kernel_cmdline_extra_parameters.txt", "boot/uEnv.txt"]:
+      path = os.path.join(target, filename)
+      if os.path.lexists(path):
+        os.remove(path)
+
+    # Then generate the bootscript
+    self.generate_bootscript(target)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # build_partition_file
+  #
+  # -------------------------------------------------------------------------
+  def build_partition_file(self, part_index, partition, content_directory):
+    """This method generates the filesystem of a partition into a partition
+    file, from the content of the staging directory (None if the filesystem is
+    empty). The filesystem is labeled, tuned and checked the same way it is in
+    loopback mode.
+
+    It returns the path to the partition file, or None if there is no
+    filesystem to generate.
+    """
+
+    # Retrieve the partition file system type
+    if Key.FILESYSTEM.value not in partition:
+      self.project.logging.debug("File system to create on the partition is not defined.")
+      return None
+    part_filesystem = partition[Key.FILESYSTEM.value].lower()
+
+    # Retrieve the geometry from the partition table
+    if part_index not in self.partition_geometries:
+      self.project.logging.critical("Partition " + str(part_index) + " is not in partition table")
+      exit(1)
+    part_size = self.partition_geometries[part_index][1]
+
+    # Create the sparse partition file. The filesystem tools use its size
+    part_path = self.image_path + ".p" + str(part_index)
+    with open(part_path, "wb") as part_file:
+      part_file.truncate(part_size)
+
+    # Name of the partition is used as filesystem label
+    part_name = partition.get(Key.NAME.value)
+    check_filesystem = False
+
+    # ext filesystems are populated by mke2fs
+    if part_filesystem == "ext2" or part_filesystem == "ext3" or part_filesystem == "ext4":
+      command = 'mkfs.' + part_filesystem + ' -F -q'
+      if part_name is not None:
+        command += ' -L "' + part_name + '"'
+      if content_directory is not None:
+        command += ' -d "' + content_directory + '"'
+      self.execute_command(command + ' "' + part_path + '"')
+
+      # Check if some ext filesystems options should be applied (accord to man tune2fs)
+      if Key.EXT_FS_TUNE.value in partition:
+        command = 'tune2fs ' + partition[Key.EXT_FS_TUNE.value] + ' "' + part_path + '"'
+        self.execute_command(command)
+      check_filesystem = True
+
+    # fat filesystems are populated by mtools
+    elif part_filesystem == "fat12" or part_filesystem == "fat16" or part_filesystem == "fat32":
+      command = 'mkfs.vfat -F ' + part_filesystem[3:]
+      if part_name is not None:
+        command += ' -n "' + part_name + '"'
+      self.execute_command(command + ' "' + part_path + '"')
+
+      # Copy the content recursively, preserving the attributes and times
+      if content_directory is not None and len(os.listdir(content_directory)) > 0:
+        command = 'mcopy -i "' + part_path + '" -s -p -m -Q'
+        for entry in sorted(os.listdir(content_directory)):
+          command += ' "' + os.path.join(content_directory, entry) + '"'
+        self.execute_command(command + ' ::/')
+      check_filesystem = True
+
+    # squashfs is generated by mksquashfs, it must fit in the partition
+    elif part_filesystem == Key.SQUASHFS.value:
+      os.remove(part_path)
+      empty_directory = None
+      if content_directory is None:
+        empty_directory = tempfile.mkdtemp(dir=self.project.get_image_directory())
+        content_directory = empty_directory
+      command = 'mksquashfs "' + content_directory + '" "' + part_path + '" -noappend -no-progress'
+      self.execute_command(command)
+      if empty_directory is not None:
+        os.rmdir(empty_directory)
+      if os.path.getsize(part_path) > part_size:
+        self.project.logging.critical("squashfs of partition " + str(part_index) +
+                                      " is larger than the partition")
+        exit(1)
+
+    # swap only needs to be initialized
+    elif part_filesystem == "linux-swap(v0)" or part_filesystem == "linux-swap(v1)":
+      self.execute_command('mkswap "' + part_path + '"')
+
+    else:
+      self.project.logging.error("No loop free tool is defined for partition " +
+                                 str(part_index) + " with file system " + part_filesystem)
+      os.remove(part_path)
+      return None
+
+    # Check the generated filesystem (fsck)
+    if check_filesystem and Key.CONTENT_PARTITION_MAPPING.value in partition:
+      self.execute_command('fsck -f -y "' + part_path + '"')
+
+    # Return the generated file
+    return part_path
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # splice_partition_file
+  #
+  # -------------------------------------------------------------------------
+  def splice_partition_file(self, part_path, part_index):
+    """This method copies a partition file into the image at the partition
+    offset. Only the data extents of the partition file are copied, thus the
+    image stays sparse.
+    """
+
+    # Retrieve the geometry from the partition table
+    part_offset, part_size = self.partition_geometries[part_index]
+    self.project.logging.debug("Copying " + part_path + " at offset " + str(part_offset))
+
+    # Copy the data extents of the partition file
+    with open(part_path, "rb") as part_file, open(self.image_path, "rb+") as image_file:
+      file_size = os.fstat(part_file.fileno()).st_size
+      if file_size > part_size:
+        self.project.logging.critical("Partition file " + part_path + " is larger than partition")
+        exit(1)
+
+      for start, end in ParallelCompressor.get_data_extents(part_file.fileno(), file_size):
+        position = start
+        while position < end:
+          data = os.pread(part_file.fileno(), min(self.FILL_CHUNK_SIZE, end - position), position)
+          os.pwrite(image_file.fileno(), data, part_offset + position)
+          position += len(data)
+
+
+
   # -------------------------------------------------------------------------
   #
   # install_boot
@@ -791,8 +1288,13 @@ class BuildImage(CliCommand):
             else:
               options = action[Key.OPTIONS.value]
 
-            # Let's run dd to copy to the image
-            command = 'dd if="' + source + '" of="' + self.loopback_device + '" ' + options
+            # Let's run dd to copy to the image. Without loopback the image file is written
+            # directly, and must not be truncated
+            if self.loop_free:
+              command = 'dd if="' + source + '" of="' + self.image_path + '" conv=notrunc '
+              command += options
+            else:
+              command = 'dd if="' + source + '" of="' + self.loopback_device + '" ' + options
             self.execute_command(command)
       else:
         logging.debug("No UBOOT defined, skipping.")
@@ -825,50 +1327,15 @@ class BuildImage(CliCommand):
   # -------------------------------------------------------------------------
   def check_partition_filesystems(self):
     """This method is in charge of checking partition file systems once content
-    has been writtent. Basicaly it does a fsck.
+    has been writtent. Basicaly it does a fsck. Partitions are checked
+    concurrently.
     """
 
     # Output current task to logs
     logging.info("Checking partitions filesystems")
 
-    # Defines a primary partition counter. Starts at zero and is incremented at each iteration
-    # beginning. It means first partition is 1.
-    primary_part_index = 0
-
-    # Defines a cwlogical partition counter. Starts at four and is incremented at each iteration
-    # beginning. It means first partition is 5.
-    logical_part_index = 4
-
-    # Defines the current partition which can be either primary (or extended) or logical.
-    part_index = 0
-
-    # Now iterate the partition tables and create them
-    for partition in self.project.image[Key.DEVICES.value][Key.PARTITIONS.value]:
-
-      # Check if current partition is logical, then increase the counter and set
-      # current partition index
-      if partition[Key.TYPE.value] == Key.LOGICAL.value:
-        logical_part_index += 1
-        part_index = logical_part_index
-      else:
-        # If partition is not logicial, then increase the other index and use it
-        primary_part_index += 1
-        part_index = primary_part_index
-
-      # Retrieve the partition format flag
-      if Key.FORMAT.value not in partition:
-        self.project.logging.debug("File system format flag is not defined. Defaulting to True")
-        part_format = True
-      else:
-        part_format = partition[Key.FORMAT.value]
-        self.project.logging.debug("File system format flag => '" + str(part_format) + "'")
-
-      # Process only if the partition has been formatted and mapping is defined
-      if part_format and Key.CONTENT_PARTITION_MAPPING.value in partition:
-        # Generate the command to check the device
-        command = 'fsck -f -y ' + self.loopback_device + "p" + str(part_index)
-        self.project.logging.debug("Checking partition : " + command)
-        self.execute_command(command)
+    # Run fsck on the formatted partitions with content
+    self.run_partition_jobs("fsck", lambda job: self.__run_job_command(job.get_check_command()))
 
 
 
@@ -915,94 +1382,27 @@ class BuildImage(CliCommand):
     File system creation is implemented in a different method since it has tp
     be done after partition creation and commit. It can't be done on the fly.
 
-    This code has been separated to make it more easy to read and maintain.
-
     Since it is executed in sequence after partition creation, configuration
     file is not checked again for the same parameters. Only parameters
-    specific to filesystems are checked.
+    specific to filesystems are checked. Partitions are independent, thus
+    they are formatted concurrently.
     """
 
     # Output current task to logs
     logging.info("Creating the filesystems in the newly created partitions")
 
-    # Defines a primary partition counter. Starts at zero and is incremented at each iteration
-    # beginning. It means first partition is 1.
-    primary_part_index = 0
-
-    # Defines a cwlogical partition counter. Starts at four and is incremented at each iteration
-    # beginning. It means first partition is 5.
-    logical_part_index = 4
-
-    # Defines the current partition which can be either primary (or extended) or logical.
-    part_index = 0
-
-    # Nox iterate the partitiontables and create them
-    for partition in self.project.image[Key.DEVICES.value][Key.PARTITIONS.value]:
-
-      # Check if current partition is logical, then increase the counter and set
-      # current partition index
-      if partition[Key.TYPE.value] == Key.LOGICAL.value:
-        logical_part_index += 1
-        part_index = logical_part_index
-      else:
-        # If partition is not logicial, then increase the other index and use it
-        primary_part_index += 1
-        part_index = primary_part_index
-
-      # Retrieve the partition format flag
-      if Key.FORMAT.value not in partition:
-        self.project.logging.debug("File system format flag is not defined. Defaulting to False")
-        part_format = False
-      else:
-        part_format = partition[Key.FORMAT.value]
-        self.project.logging.debug("File system format flag => '" + str(part_format) + "'")
-
+    # Format the partition, then apply ext filesystems options
+    def format_partition(job):
       # Check if the flag is true, if not there is nothing to do
-      if not part_format:
-        self.project.logging.debug("The format flag is deactivated for martition " \
-                                   + str(part_index))
-      else:
-        # Retrieve the partition file system type
-        if Key.FILESYSTEM.value not in partition:
-          self.project.logging.debug("File system to create on the partition is not defined.")
-          part_filesystem = None
-        else:
-          part_filesystem = partition[Key.FILESYSTEM.value].lower()
-
-        # Default is having no format nor tunefs tool. It will be checked after fs type
-        # control and tool command guessing
-        format_tool = None
-        tune_tool = None
-
-        # Check that the value is in the list of valid values
-        if part_filesystem == "ext2":
-          format_tool = "mkfs.ext2"
-          tune_tool = "tune2fs"
-        elif part_filesystem == "ext3":
-          format_tool = "mkfs.ext3"
-          tune_tool = "tune2fs"
-        elif part_filesystem == "ext4":
-          format_tool = "mkfs.ext4"
-          tune_tool = "tune2fs"
-        elif part_filesystem == "fat12":
-          format_tool = "mkfs.vfat -F 12"
-        elif part_filesystem == "fat16":
-          format_tool = "mkfs.vfat -F 16"
-        elif part_filesystem == "fat32":
-          format_tool = "mkfs.vfat -F 32"
-        elif part_filesystem == "linux-swap(v0)" or part_filesystem == "linux-swap(v1)":
-          format_tool = "mkswap"
-
-        # Creation du file fystem sur a prtition
-        if part_filesystem is not None and format_tool is not None:
-          command = format_tool + ' ' + self.loopback_device + 'p' + str(part_index)
-          self.execute_command(command)
+      if not job.format:
+        self.project.logging.debug("The format flag is deactivated for martition " +
+                                   str(job.index))
+        return
+      self.__run_job_command(job.get_format_command())
+      self.__run_job_command(job.get_tune_command())
 
-        # Check if some ext filesystems options should be applied (accord to man tune2fs)
-        if Key.EXT_FS_TUNE.value in partition and tune_tool is not None:
-          command = tune_tool + ' ' + partition[Key.EXT_FS_TUNE.value]
-          command += ' ' + self.loopback_device + 'p' + str(part_index)
-          self.execute_command(command)
+    # Run the jobs
+    self.run_partition_jobs("mkfs", format_partition)
 
 
 
@@ -1014,68 +1414,100 @@ class BuildImage(CliCommand):
   def label_filesystems(self):
     """This method set the file systems labels on the partition created by the
     create_partitions_inside_image method. It uses the same configuration file.
+    Partitions are labeled concurrently.
     """
 
     # Output current task to logs
     logging.info("Labeling the filesystems in the newly created partitions")
 
-    # Defines a primary partition counter. Starts at zero and is incremented at each iteration
-    # beginning. It means first partition is 1.
-    primary_part_index = 0
+    # Label the partition if it has a name
+    def label_partition(job):
+      # Process only if there is a name
+      if job.label is None:
+        return
+
+      # Filesystem should be defined and formatted or we can't label it
+      if job.filesystem is None:
+        self.project.logging.error("Partition label is defined but there is no filesystem set" \
+                                   " for partition " + str(job.index))
+      elif not job.is_labelable():
+        self.project.logging.error("Partition label is defined, but partition " + \
+                                   str(job.index) + " is not formatted")
+      elif job.get_label_command() is None:
+        self.project.logging.error("No labelling tool is defined for partition " + \
+                                   str(job.index) + " with file system " + job.filesystem)
+      else:
+        self.__run_job_command(job.get_label_command())
 
-    # Defines a cwlogical partition counter. Starts at four and is incremented at each iteration
-    # beginning. It means first partition is 5.
-    logical_part_index = 4
+    # Run the jobs
+    self.run_partition_jobs("label", label_partition)
 
-    # Defines the current partition which can be either primary (or extended) or logical.
-    part_index = 0
 
-    # Now iterate once again the partition tables to set labels
-    for partition in self.project.image[Key.DEVICES.value][Key.PARTITIONS.value]:
 
-      # Check if current partition is logical, then increase the counter and set
-      # current partition index
-      if partition[Key.TYPE.value] == Key.LOGICAL.value:
-        logical_part_index += 1
-        part_index = logical_part_index
+  # -------------------------------------------------------------------------
+  #
+  # get_partition_jobs
+  #
+  # -------------------------------------------------------------------------
+  def get_partition_jobs(self):
+    """This method returns the list of the partition jobs, computed from the
+    devices section. The device of each partition is in the loopback device,
+    or is a partition file next to the image in loop free mode.
+    """
+
+    # Compute the device of each partition
+    jobs = []
+    for part_index, partition in self.get_indexed_partitions():
+      if self.loop_free:
+        device = self.image_path + ".p" + str(part_index)
       else:
-        # If partition is not logicial, then increase the other index and use it
-        primary_part_index += 1
-        part_index = primary_part_index
+        device = self.loopback_device + "p" + str(part_index)
+      jobs.append(PartitionJob(part_index, partition, device))
 
-      # Retrieve the partition name, and process only if there is a name
-      if Key.NAME.value in partition:
-        part_name = partition[Key.NAME.value]
+    # Return the jobs
+    return jobs
 
-        # Retrieve the partition file system type. It should be defined or we can't label it
-        if Key.FILESYSTEM.value not in partition:
-          self.project.logging.error("Partition label is defined but there is no filesystem set" \
-                                     " for partition " + str(part_index))
-        else:
-          part_filesystem = partition[Key.FILESYSTEM.value].lower()
 
-          # Retrieve the partition format flag. It should be formatted or we can't label it.
-          if Key.FORMAT.value in partition and not partition[Key.FORMAT.value]:
-            self.project.logging.error("Partition label is defined, but partition " + \
-                                       str(part_index) + " is not formatted")
-          else:
-            # Go so far, thus all checks are ok we can label and select tool according to FS
-            label_tool = None
-
-            # Check that the value is in the list of valid values
-            if part_filesystem == "ext2" or part_filesystem == "ext3" or part_filesystem == "ext4":
-              label_tool = "e2label"
-            elif part_filesystem == "fat32":
-              label_tool = "fatlabel"
-
-            # If the label tool is defined let's call it
-            if label_tool:
-              command = label_tool + ' ' + self.loopback_device + 'p' + str(part_index)
-              command += ' ' + part_name
-              self.execute_command(command)
-            else:
-              self.project.logging.error("No labelling tool is defined for partition " + \
-                                         str(part_index) + " with file system " + part_filesystem)
+
+  # -------------------------------------------------------------------------
+  #
+  # run_partition_jobs
+  #
+  # -------------------------------------------------------------------------
+  def run_partition_jobs(self, name, function):
+    """This method runs the function on each partition job, in a pool of
+    threads whose size is the partition concurrency. The time spent on each
+    partition is logged. If a job fails, the command exits, and the error is
+    raised again in the calling thread.
+    """
+
+    # Run the function and measure its duration
+    def run_job(job):
+      start_time = time.time()
+      function(job)
+      self.project.logging.debug("Partition " + str(job.index) + " : " + name +
+                                 " completed in %.2f seconds" % (time.time() - start_time))
+
+    # Submit all the jobs, then wait for them in order so errors are raised here
+    with ThreadPoolExecutor(max_workers=self.project.get_partition_concurrency()) as executor:
+      futures = [executor.submit(run_job, job) for job in self.get_partition_jobs()]
+      for future in futures:
+        future.result()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __run_job_command
+  #
+  # -------------------------------------------------------------------------
+  def __run_job_command(self, command):
+    """This method executes the command of a partition job, if any.
+    """
+
+    # Nothing to do if the job has no command
+    if command is not None:
+      self.execute_command(command)
 
 
 
@@ -1089,8 +1521,20 @@ class BuildImage(CliCommand):
     options, and if needed to run the compression tools on the iage.
 
     The compression is done by running the selected compression tool as a
-    subpress. The python compression library is not (yet?) called since the
-    compressor usage is really basic.
+    subpress. The multi-threaded tools (xz -T, pigz, pbzip2, zstd -T) are
+    used when available. Otherwise the image is compressed by independent
+    blocks using a pool of threads in Python (ParallelCompressor), which is
+    sparse aware and does not read the holes of the image.
+
+    The compression backend is selected by the compression_backend key :
+    - auto (default) use the multi-threaded tool if available, or Python
+    - tool always run the external tool, even if it is single threaded
+    - python always use the Python pool
+
+    If streaming_compression is True, the image is piped into the tool
+    instead of being compressed in place. Streaming also allows to release
+    the raw image while it is compressed (punch_holes), and to generate a
+    block map (bmap) used by flashing tools to write only the mapped blocks.
     """
 
     # Output current task to logs
@@ -1102,30 +1546,26 @@ class BuildImage(CliCommand):
       return
 
     # Retrieve the compression tool and check its vaidity
-    compression_tool = self.project.image[Key.DEVICES.value][Key.COMPRESSION.value].lower()
-    if compression_tool == "" or compression_tool == "none":
+    compression = self.project.image[Key.DEVICES.value][Key.COMPRESSION.value].lower()
+    if compression == "" or compression == "none":
       self.project.logging.info("Compression is deactivated. Skipping image copmpression")
       return
-    # Check for lzma format
-    elif compression_tool == Key.LZMA.value:
-      compression_tool = "/usr/bin/env xz -z --format=lzma"
-      compression_suffix = ".lzma"
-    # Check for xz format
-    elif compression_tool == Key.XZ.value:
-      compression_tool = "/usr/bin/env xz -z"
-      compression_suffix = ".xz"
-    # Check for bzip2 format
-    elif compression_tool == Key.BZIP2.value:
-      compression_tool = "/usr/bin/env bzip2"
-      compression_suffix = ".bz2"
-    # Check for gzip format
-    elif compression_tool == Key.GZIP.value:
-      compression_tool = "/usr/bin/env gzip"
-      compression_suffix = ".gz"
-    else:
-      self.project.logging.error("Unknow compression method '" + compression_tool +
+    elif compression not in self.COMPRESSION_SUFFIXES:
+      self.project.logging.error("Unknow compression method '" + compression +
                                  "'. Skipping image copmpression")
       return
+    compression_suffix = self.COMPRESSION_SUFFIXES[compression]
+
+    # Retrieve the number of threads. 0 means one thread per CPU
+    compression_threads = int(self.project.image[Key.DEVICES.value].get(
+        Key.COMPRESSION_THREADS.value, 0))
+    if compression_threads <= 0:
+      compression_threads = os.cpu_count()
+
+    # Retrieve the backend and select the tool
+    compression_backend = self.project.image[Key.DEVICES.value].get(
+        Key.COMPRESSION_BACKEND.value, Key.AUTO.value).lower()
+    compression_tool, is_parallel = self.__get_compression_tool(compression, compression_threads)
 
     # Check that the filename is available from the devices section in the configuration file
     if Key.COMPRESSION_OPTIONS.value not in self.project.image[Key.DEVICES.value]:
@@ -1139,15 +1579,113 @@ class BuildImage(CliCommand):
       self.project.logging.debug("Compressed image aldredy exist, removing it")
       os.remove(self.image_path + compression_suffix)
 
-    # Let's run dd to copy to the image
-    command = compression_tool + ' ' + compression_options + '"' + self.image_path + '"'
-    self.execute_command(command)
+    # Retrieve the streaming options. Raw image blocks can be released only when streaming
+    streaming = self.project.image[Key.DEVICES.value].get(Key.STREAMING_COMPRESSION.value, False)
+    punch_holes = self.project.image[Key.DEVICES.value].get(Key.PUNCH_HOLES.value, False)
+
+    # Check if the block map has to be generated, it is computed while streaming
+    bmap_path = None
+    if self.project.image[Key.DEVICES.value].get(Key.BMAP.value, False):
+      bmap_path = self.image_path + ".bmap"
+      streaming = True
+      if os.path.isfile(bmap_path):
+        os.remove(bmap_path)
+
+    # Python backend is used if requested, or if no multi-threaded tool is available and the
+    # format is supported by the Python compressor
+    use_python = compression_backend == Key.PYTHON.value
+    if compression_backend == Key.AUTO.value and not is_parallel:
+      use_python = compression in ParallelCompressor.FORMATS
+    compressor = ParallelCompressor(self.project.logging, compression, compression_threads)
+
+    if use_python:
+      # Check the format is supported by the Python compressor
+      if compression not in ParallelCompressor.FORMATS:
+        self.project.logging.critical("Compression method '" + compression +
+                                      "' is not supported by the python backend")
+        exit(1)
+
+      # Compression options are specific to the tools, they are not used in Python
+      if compression_options != "":
+        self.project.logging.debug("Compression options are ignored by the python backend")
+
+      # Compress the image, then remove the raw image as the tools do. Python backend
+      # always streams the image
+      compressor.compress_file(self.image_path, self.image_path + compression_suffix,
+                               punch_holes, bmap_path)
+      os.remove(self.image_path)
+    else:
+      # Check the tool is available
+      if compression_tool is None:
+        self.project.logging.critical("No tool available for compression method '" +
+                                      compression + "'")
+        exit(1)
+
+      # In streaming mode the image is read once and piped into the tool
+      if streaming:
+        command = compression_tool + ' -c ' + compression_options
+        returncode = compressor.pipe_file(self.image_path, self.image_path + compression_suffix,
+                                          command, punch_holes, bmap_path)
+        if returncode != 0:
+          self.cleanup()
+          self.project.logging.critical("Error %d occured when executing %s", returncode, command)
+          exit(1)
+        os.remove(self.image_path)
+      else:
+        # Let's run the compression tool on the image
+        if punch_holes:
+          self.project.logging.warning("punch_holes is only used in streaming mode")
+        command = compression_tool + ' ' + compression_options + ' "' + self.image_path + '"'
+        self.execute_command(command)
 
     # Update the image file name
     self.image_path = self.image_path + compression_suffix
 
 
 
+  # -------------------------------------------------------------------------
+  #
+  # __get_compression_tool
+  #
+  # -------------------------------------------------------------------------
+  def __get_compression_tool(self, compression, threads):
+    """This method returns the command used to compress the image in place,
+    and a flag telling if this command is multi-threaded. Multi-threaded tools
+    are preferred. The command is None if no tool is available.
+
+    All the commands remove the raw image once compressed.
+    """
+
+    # lzma (alone) format cannot be multi-threaded
+    if compression == Key.LZMA.value:
+      return ("/usr/bin/env xz -z --format=lzma", False)
+
+    # xz is multi-threaded since 5.2
+    elif compression == Key.XZ.value:
+      return ("/usr/bin/env xz -z -T" + str(threads), True)
+
+    # bzip2 is multi-threaded using pbzip2
+    elif compression == Key.BZIP2.value:
+      if shutil.which("pbzip2") is not None:
+        return ("/usr/bin/env pbzip2 -p" + str(threads), True)
+      return ("/usr/bin/env bzip2", False)
+
+    # gzip is multi-threaded using pigz
+    elif compression == Key.GZIP.value:
+      if shutil.which("pigz") is not None:
+        return ("/usr/bin/env pigz -p " + str(threads), True)
+      return ("/usr/bin/env gzip", False)
+
+    # zstd is natively multi-threaded, but it does not remove its input by default
+    elif compression == Key.ZSTD.value:
+      if shutil.which("zstd") is not None:
+        return ("/usr/bin/env zstd -q --rm -T" + str(threads), True)
+
+    # No tool available
+    return (None, False)
+
+
+
   # -------------------------------------------------------------------------
   #
   # cleanup
@@ -1182,7 +1720,8 @@ class BuildImage(CliCommand):
 
     . Scan the firmware parameter to identify the list of banks to mount
     . Mount each activated banks
-    . Copy either the firmware to bank_0 and 1 if activated
+    . Copy either the firmware to bank_0 and 1 if activated. If clone_banks
+      is activated, bank_1 is cloned from bank_0 instead of being copied
     . Generate and copy the boot script to current bank for each bank
     . Copy the rescue firmware if activated
     """
@@ -1252,18 +1791,30 @@ class BuildImage(CliCommand):
                                                                      [Key.BANK_1.value]\
                                                                      [Key.PARTITION.value])
 
-      # Mount the device
-      command = 'mount "' + device + '" "' + bank_1_mountpoint + '"'
-      self.execute_command(command)
+      # Check if bank 1 is cloned from bank 0 instead of copying the content once again
+      if Key.CLONE_BANKS.value in self.project.firmware[Key.RESILIENCE.value] and \
+                                  self.project.firmware[Key.RESILIENCE.value][Key.CLONE_BANKS.value]:
+        # Clone the filesystem of bank 0, block-wise, before mounting bank 1
+        self.clone_bank_partition(Key.BANK_0.value, Key.BANK_1.value)
 
-      # Iterate the list of files in the rootfs and copy them to image
-      for copy_target in os.listdir(self.project.get_firmware_content_directory()):
-        copy_source_path = os.path.join(self.project.get_firmware_content_directory(), copy_target)
-        copy_target_path = os.path.join(bank_1_mountpoint, copy_target)
-        command = "cp -fra " + copy_source_path + " " + copy_target_path
+        # Mount the device
+        command = 'mount "' + device + '" "' + bank_1_mountpoint + '"'
+        self.execute_command(command)
+      else:
+        # Mount the device
+        command = 'mount "' + device + '" "' + bank_1_mountpoint + '"'
         self.execute_command(command)
 
-      # Generate the boootscript into the current bank partition
+        # Iterate the list of files in the rootfs and copy them to image
+        for copy_target in os.listdir(self.project.get_firmware_content_directory()):
+          copy_source_path = os.path.join(self.project.get_firmware_content_directory(),
+                                          copy_target)
+          copy_target_path = os.path.join(bank_1_mountpoint, copy_target)
+          command = "cp -fra " + copy_source_path + " " + copy_target_path
+          self.execute_command(command)
+
+      # Generate the boootscript into the current bank partition. When the bank is cloned, this
+      # is the only part of the bank which is written
       self.generate_bootscript(bank_1_mountpoint)
 
       # Copy is done, let's umount the device
@@ -1348,6 +1899,61 @@ class BuildImage(CliCommand):
     shutil.rmtree(image_mount_root)
 
 
+  # -------------------------------------------------------------------------
+  #
+  # clone_bank_partition
+  #
+  # -------------------------------------------------------------------------
+  def clone_bank_partition(self, source_bank, target_bank):
+    """This method clones the filesystem of the source bank partition into
+    the target bank partition, block-wise. ext filesystems are cloned using
+    e2image, which copies only the used blocks, then grown to the partition
+    size. Other filesystems are copied using dd.
+
+    The clone keeps the label of the target partition, and ext filesystems
+    receive a new UUID. The bootscript has to be generated afterwards.
+    """
+
+    # Output current task to logs
+    logging.info("Cloning " + source_bank + " partition into " + target_bank)
+
+    # Retrieve the partition numbers of the banks
+    source_index = int(self.project.firmware[Key.RESILIENCE.value][Key.PARTITIONS.value]\
+                                            [source_bank][Key.PARTITION.value])
+    target_index = int(self.project.firmware[Key.RESILIENCE.value][Key.PARTITIONS.value]\
+                                            [target_bank][Key.PARTITION.value])
+    source_device = self.loopback_device + "p" + str(source_index)
+    target_device = self.loopback_device + "p" + str(target_index)
+
+    # The target bank must be large enough to receive the source filesystem
+    if self.partition_geometries[target_index][1] < self.partition_geometries[source_index][1]:
+      self.project.logging.critical("Partition of " + target_bank + " is smaller than partition " +
+                                    "of " + source_bank + ". Cannot clone it")
+      exit(1)
+
+    # Retrieve the definition of the target partition, used for its filesystem and label
+    partition = dict(self.get_indexed_partitions())[target_index]
+    part_filesystem = partition.get(Key.FILESYSTEM.value, "").lower()
+    part_name = partition.get(Key.NAME.value)
+
+    # Check that the value is in the list of valid values
+    if part_filesystem == "ext2" or part_filesystem == "ext3" or part_filesystem == "ext4":
+      # Copy only the used blocks, then grow the filesystem and make it unique
+      self.execute_command('e2image -ra "' + source_device + '" "' + target_device + '"')
+      self.execute_command('e2fsck -f -y "' + target_device + '"')
+      self.execute_command('resize2fs "' + target_device + '"')
+      self.execute_command('tune2fs -U random "' + target_device + '"')
+      if part_name is not None:
+        self.execute_command('e2label "' + target_device + '" ' + part_name)
+    else:
+      # Copy the whole partition
+      command = 'dd if="' + source_device + '" of="' + target_device + '" bs=4M conv=fsync'
+      self.execute_command(command)
+      if part_name is not None and part_filesystem == "fat32":
+        self.execute_command('fatlabel "' + target_device + '" ' + part_name)
+
+
+
   # -------------------------------------------------------------------------
   #
   # check_configuration_file
@@ -30,10 +30,11 @@ import glob
 import tempfile
 import errno
 from shutil import rmtree
-from distutils import dir_util
-from distutils import file_util
 from dft.cli_command import CliCommand
 from dft.enumkey import Key
+from dft.rootfs_cache import RootfsStageCache
+from dft.debootstrap_cache import SnapshotDebootstrap
+from dft.tree_copier import TreeCopier
 
 
 #
@@ -53,6 +54,9 @@ class BuildRootFS(CliCommand):
   . cleanup things when installation is done
   """
 
+  # Ordered list of the rootfs generation stages which can be cached
+  ROOTFS_STAGES = ["debootstrap", "roles", "upgrade"]
+
   # -------------------------------------------------------------------------
   #
   # __init__
@@ -68,6 +72,20 @@ class BuildRootFS(CliCommand):
     # Path to the ansible roles under dft_base
     self.ansible_roles_dir = project.get_dft_base()  + "/ansible-roles"
 
+    # List of the extra packages installed by debootstrap
+    self.debootstrap_include = "gnupg,dirmngr,apt-transport-https"
+
+    # Snapshots of debootstrap output, shared between projects. None if deactivated
+    self.debootstrap_snapshot = None
+    if project.get_use_debootstrap_snapshot():
+      self.debootstrap_snapshot = SnapshotDebootstrap(dft, project)
+
+    # Cache used to store rootfs snapshots after each stage. None if deactivated
+    self.rootfs_cache = None
+    if project.get_use_rootfs_cache():
+      self.rootfs_cache = RootfsStageCache(project, project.get_rootfs_cachedir(),
+                                           self.execute_command)
+
     # Set the log level from the configuration
     print("setting logs " + project.dft.log_level)
     logging.basicConfig(level=project.dft.log_level)
@@ -115,18 +133,32 @@ class BuildRootFS(CliCommand):
     logging.debug("creating dft_bootstrap in path : " + dft_target_path)
     os.makedirs(dft_target_path, exist_ok=True)
 
+    # Restore from the cache the longest list of stages whose inputs did not change
+    stage_keys = None
+    restored_stages = 0
+    if self.rootfs_cache is not None:
+      stage_keys = self.compute_stage_keys()
+      restored_stages = self.restore_cached_stages(stage_keys)
+
     # Do the debootstrap call
-    self.generate_debootstrap_rootfs()
+    if restored_stages < 1:
+      self.generate_debootstrap_rootfs()
+      self.save_cached_stage(stage_keys, 0)
 
-    # Inject variable files content to boostrap directory
-    self.inject_variables_in_rootfs()
+    # Deploy the roles, unless the stage has been restored from the cache
+    if restored_stages < 2:
+      # Inject variable files content to boostrap directory
+      self.inject_variables_in_rootfs()
 
-    # Launch Ansible to install roles identified in configuration file
-    self.install_packages()
+      # Launch Ansible to install roles identified in configuration file
+      self.install_packages()
+      self.save_cached_stage(stage_keys, 1)
 
     # Finally run a full upgrade in case of source modification during install
     # Allow downgrades is needed if pinning has been modified by Ansible roles
-    self.upgrade_packages(allow_downgrades=True)
+    if restored_stages < 3:
+      self.upgrade_packages(allow_downgrades=True)
+      self.save_cached_stage(stage_keys, 2)
 
     # Launch Ansible to install roles identified in configuration file
     self.generate_fstab()
@@ -152,6 +184,131 @@ class BuildRootFS(CliCommand):
     logging.info("RootFS has been successfully generated into : " +
                  self.project.get_rootfs_mountpoint())
 
+  # -------------------------------------------------------------------------
+  #
+  # compute_stage_keys
+  #
+  # -------------------------------------------------------------------------
+  def compute_stage_keys(self):
+    """This method computes the cache keys of the rootfs generation stages.
+    Each key depends on the previous stage key and on the inputs of the
+    stage :
+
+    . debootstrap : target version and arch, debootstrap repository and
+                    options, repositories and pinning used to generate APT
+                    configuration
+    . roles       : list of roles, content of the ansible roles directories
+                    and of the variables files
+    . upgrade     : nothing more than the previous stages
+    """
+
+    # Retrieve the repositories definition matching the target, they are the input of
+    # generate_apt_sources and generate_apt_preferences
+    distributions = []
+    for distro in self.project.repositories[Key.DISTRIBUTIONS.value]:
+      if distro[Key.NAME.value] == self.project.get_target_version() and \
+         self.project.get_target_arch() in distro[Key.ARCHITECTURES.value]:
+        distributions.append(distro)
+
+    # Inputs of the debootstrap stage
+    inputs = {Key.VERSION.value: self.project.get_target_version(),
+              Key.ARCH.value: self.project.get_target_arch(),
+              Key.DEBOOTSTRAP_REPOSITORY.value: self.project.project[Key.PROJECT_DEFINITION.value]\
+                                                                   [Key.DEBOOTSTRAP_REPOSITORY.value],
+              "variant": self.project.dft.debootstrap_target,
+              Key.PACKAGES.value: self.debootstrap_include,
+              Key.DISTRIBUTIONS.value: distributions,
+              Key.PINNING.value: self.project.repositories.get(Key.PINNING.value),
+              Key.GENERATE_VALIDITY_CHECK.value: self.project.project[Key.CONFIGURATION.value]\
+                                                     .get(Key.GENERATE_VALIDITY_CHECK.value, True)}
+    debootstrap_key = self.rootfs_cache.compute_key(None, self.ROOTFS_STAGES[0], inputs)
+
+    # Inputs of the roles stage. Roles directories are hashed since roles content can change
+    # without any modification of the project
+    roles_trees = [self.rootfs_cache.hash_tree(self.ansible_roles_dir)]
+    if Key.ADDITIONAL_ROLES.value in self.project.project[Key.CONFIGURATION.value]:
+      for additional_path in self.project.project[Key.CONFIGURATION.value]\
+                                                 [Key.ADDITIONAL_ROLES.value]:
+        roles_trees.append(self.rootfs_cache.hash_tree(additional_path))
+
+    # Variables files are injected in the inventory, thus their content is an input too
+    variables = []
+    if Key.VARIABLES.value in self.project.project[Key.PROJECT_DEFINITION.value]:
+      for vars_file in self.project.project[Key.PROJECT_DEFINITION.value][Key.VARIABLES.value]:
+        variables.append(self.rootfs_cache.hash_tree(self.project.generate_def_file_path(vars_file)))
+
+    inputs = {Key.ROLES.value: self.project.rootfs[Key.ROLES.value],
+              Key.ADDITIONAL_ROLES.value: roles_trees,
+              Key.VARIABLES.value: variables}
+    roles_key = self.rootfs_cache.compute_key(debootstrap_key, self.ROOTFS_STAGES[1], inputs)
+
+    # The upgrade stage has no other input than the previous stages
+    upgrade_key = self.rootfs_cache.compute_key(roles_key, self.ROOTFS_STAGES[2], {})
+
+    # Return the ordered list of keys
+    return [debootstrap_key, roles_key, upgrade_key]
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # restore_cached_stages
+  #
+  # -------------------------------------------------------------------------
+  def restore_cached_stages(self, stage_keys):
+    """This method restores the snapshot of the last stage available in the
+    cache, and prepare the rootfs to run the remaining stages. It returns
+    the number of stages restored.
+    """
+
+    # Search for the longest list of stages available
+    restored_stages = self.rootfs_cache.find_longest_prefix(stage_keys)
+    if restored_stages == 0:
+      logging.info("no rootfs snapshot found in cache, generating from scratch")
+      return 0
+
+    # Extract the snapshot into the empty rootfs
+    self.rootfs_cache.restore_snapshot(stage_keys[restored_stages - 1],
+                                       self.ROOTFS_STAGES[restored_stages - 1],
+                                       self.project.get_rootfs_mountpoint())
+
+    # The build number stored in the snapshot is the one of the build which created it
+    self.generate_build_number()
+
+    # QEMU is not stored into the snapshots. It is installed even if all the stages have been
+    # restored, since it is removed by cleanup_qemu at the end of the generation
+    if self.use_qemu_static:
+      self.setup_qemu()
+
+    # If some stages remain, the chrooted environment is needed
+    if restored_stages < len(self.ROOTFS_STAGES):
+      self.setup_chrooted_environment()
+
+    # Return the number of stages restored
+    return restored_stages
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # save_cached_stage
+  #
+  # -------------------------------------------------------------------------
+  def save_cached_stage(self, stage_keys, index):
+    """This method stores a snapshot of the rootfs once the stage at the
+    given index is done. Nothing is done if the cache is deactivated.
+    """
+
+    # Check the cache is activated
+    if self.rootfs_cache is None or stage_keys is None:
+      return
+
+    # Store the snapshot
+    self.rootfs_cache.save_snapshot(stage_keys[index], self.ROOTFS_STAGES[index],
+                                    self.project.get_rootfs_mountpoint())
+
+
+
   # -------------------------------------------------------------------------
   #
   # install_packages
@@ -178,17 +335,12 @@ class BuildRootFS(CliCommand):
       else:
         logging.debug("dft_bootstrap already exist under " + dft_target_path)
 
-      # Copy the DFT toolkit content to the target rootfs
+      # Copy the DFT toolkit content to the target rootfs. Symbolic links are followed, since
+      # they may point outside of the toolkit, which is not visible once chrooted
       logging.info("Copying DFT toolkit into chrooted environment : " + self.ansible_roles_dir + \
                                                                     " => " + dft_target_path )
-      for copy_target in os.listdir(self.ansible_roles_dir):
-        copy_target_path = os.path.join(self.ansible_roles_dir, copy_target)
-        if os.path.isfile(copy_target_path):
-          logging.debug("copying file " + copy_target_path + " => " + dft_target_path)
-          file_util.copy_file(copy_target_path, dft_target_path)
-        else:
-          logging.debug("copying tree " + copy_target_path + " => " + dft_target_path)
-          dir_util.copy_tree(copy_target_path, os.path.join(dft_target_path, copy_target))
+      copier = TreeCopier(self.project.logging, self.project.get_copy_concurrency())
+      copier.copy(self.ansible_roles_dir, dft_target_path, follow_symlinks=True)
 
       # Copy the additional toolkit content to the target rootfs
       if Key.ADDITIONAL_ROLES.value in self.project.project[Key.CONFIGURATION.value]:
@@ -196,15 +348,7 @@ class BuildRootFS(CliCommand):
                                                    [Key.ADDITIONAL_ROLES.value]:
           logging.debug("Copy the additional toolkit : preparing to copy from additional path "
                         + additional_path)
-          for copy_target in os.listdir(additional_path):
-            logging.debug("Copy the additional toolkit : preparing to copy " + copy_target)
-            copy_target_path = os.path.join(additional_path, copy_target)
-            if os.path.isfile(copy_target_path):
-              logging.debug("copying file " + copy_target_path + " => " + dft_target_path)
-              file_util.copy_file(copy_target_path, dft_target_path)
-            else:
-              logging.debug("copying tree " + copy_target_path + " => " + dft_target_path)
-              dir_util.copy_tree(copy_target_path, os.path.join(dft_target_path, copy_target))
+          copier.copy(additional_path, dft_target_path, follow_symlinks=True)
 
     except OSError as exception:
       # Call clean up to umount /proc and /dev
@@ -257,7 +401,7 @@ class BuildRootFS(CliCommand):
     command = "LANG=C.UTF8 LC_MESSAGES=C.UTF8 LC_ALL=C.UTF8 LANGUAGE=C.UTF8 chroot " + self.project.get_rootfs_mountpoint()
     command += " /bin/bash -c \"cd /dft_bootstrap && HOME=/root /usr/bin/ansible-playbook -i"
     command += " inventory.yml -c local site.yml -e ansible_python_interpreter=/usr/bin/python3\""
-    self.execute_command(command)
+    self.execute_command(command, capture_output=False)
 
     # Depending on Ansible version, a .rnd file and two directories may be left in /root
     # The following commands do the cleanup
@@ -314,6 +458,58 @@ class BuildRootFS(CliCommand):
 
     logging.info("generating debootstrap rootfs")
 
+    # Try to restore the debootstrap output from a snapshot. If there is no snapshot
+    # available, run debootstrap and store its output for the next builds
+    if self.debootstrap_snapshot is None:
+      self.run_debootstrap()
+    else:
+      snapshot_inputs = {Key.SUITE.value: self.project.get_target_version(),
+                         Key.ARCH.value: self.project.get_target_arch(),
+                         Key.MIRROR.value: self.project.project[Key.PROJECT_DEFINITION.value]\
+                                                               [Key.DEBOOTSTRAP_REPOSITORY.value],
+                         Key.INCLUDE.value: self.debootstrap_include,
+                         Key.VARIANT.value: self.project.dft.debootstrap_target}
+      snapshot_key = self.debootstrap_snapshot.compute_key(snapshot_inputs)
+      if self.debootstrap_snapshot.restore_snapshot(snapshot_key,
+                                                    self.project.get_rootfs_mountpoint()):
+        # QEMU is still needed to run the next commands in the chrooted environment
+        self.setup_qemu()
+      else:
+        self.run_debootstrap()
+        self.debootstrap_snapshot.create_snapshot(snapshot_key, snapshot_inputs,
+                                                  self.project.get_rootfs_mountpoint())
+
+    # Setup the chrooted environment (mount bind dev and proc
+    self.setup_chrooted_environment()
+
+    # Update the APT sources
+    self.generate_apt_sources()
+
+    # Update the APT preferences
+    self.generate_apt_preferences()
+
+    # Then update the list of packages
+    self.update_package_catalog()
+
+    # Install extra packages into the chroot
+    self.install_package("apt-utils ansible")
+
+    # Generate a unique build timestamp into /etc/dft_version
+    self.generate_build_number()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # run_debootstrap
+  #
+  # -------------------------------------------------------------------------
+  def run_debootstrap(self):
+    """ This method runs debootstrap, and its second stage through QEMU if host
+    and target arch are different. Once done, the rootfs contains a bare Debian
+    installation, without any configuration from the project.
+    """
+
     # Generate the base debootstrap command
     debootstrap_command = "debootstrap --no-check-gpg"
 
@@ -337,16 +533,17 @@ class BuildRootFS(CliCommand):
       logging.info("running debootstrap")
 
     # Include gnupg package in the list of software installed in the deboostrap chroot
-    debootstrap_command += " --include=gnupg,dirmngr,apt-transport-https"
+    debootstrap_command += " --include=" + self.debootstrap_include
 
     # Add the target, mount point and repository url to the debootstrap command
     debootstrap_command += " " +  self.project.get_target_version() + " "
     debootstrap_command += self.project.get_rootfs_mountpoint() + " "
-    debootstrap_command += self.project.project[Key.PROJECT_DEFINITION.value]\
-                                                   [Key.DEBOOTSTRAP_REPOSITORY.value]
+    debootstrap_command += self.get_package_cache_url(\
+                             self.project.project[Key.PROJECT_DEFINITION.value]\
+                                                 [Key.DEBOOTSTRAP_REPOSITORY.value])
 
-    # Finally run the subprocess
-    self.execute_command(debootstrap_command)
+    # Finally run the subprocess. Output is only streamed to the logs, it is not parsed
+    self.execute_command(debootstrap_command, capture_output=False)
 
     # Check if we are working with foreign arch
     if self.use_qemu_static:
@@ -357,25 +554,7 @@ class BuildRootFS(CliCommand):
       logging.info("doing debootstrap stage 2")
       debootstrap_command = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
       debootstrap_command += " /debootstrap/debootstrap --second-stage"
-      self.execute_command(debootstrap_command)
-
-    # Setup the chrooted environment (mount bind dev and proc
-    self.setup_chrooted_environment()
-
-    # Update the APT sources
-    self.generate_apt_sources()
-
-    # Update the APT preferences
-    self.generate_apt_preferences()
-
-    # Then update the list of packages
-    self.update_package_catalog()
-
-    # Install extra packages into the chroot
-    self.install_package("apt-utils ansible")
-
-    # Generate a unique build timestamp into /etc/dft_version
-    self.generate_build_number()
+      self.execute_command(debootstrap_command, capture_output=False)
 
 
 
@@ -25,12 +25,12 @@ attributes and content.
 """
 
 import os
-import subprocess
 import stat
-import hashlib
 from dft.cli_command import CliCommand
 from dft.cli_command import Code
+from dft.debian_version import DebianVersion
 from dft.enumkey import Key
+from dft.file_hasher import FileHasher
 
 #
 #    Class CheckRootFS
@@ -44,6 +44,9 @@ class CheckRootFS(CliCommand):
   """
   # pylint: disable=too-many-instance-attributes
 
+  # Hash algorithms which can be checked by file rules, in checking order
+  HASH_ALGORITHMS = [Key.MD5.value, Key.SHA1.value, Key.SHA256.value]
+
   # -------------------------------------------------------------------------
   #
   # __init__
@@ -85,6 +88,10 @@ class CheckRootFS(CliCommand):
     # Size of block used to read files when computing hashes
     self.block_size = 65536
 
+    # Engine computing file digests. All the digests of a file are computed in a single pass,
+    # and results are shared by all the rules checking the same file
+    self.file_hasher = FileHasher(self.block_size)
+
 
 
   # -------------------------------------------------------------------------
@@ -236,6 +243,9 @@ class CheckRootFS(CliCommand):
       if Key.MESSAGE_END.value in rules:
         self.project.logging.info(rules[Key.MESSAGE_END.value])
 
+    # All the commands have been executed, stop the chroot session
+    self.stop_chroot_session()
+
     # Remove QEMU if it has been isntalled. It has to be done in the end
     # since some cleanup tasks could need QEMU
     if self.use_qemu_static:
@@ -273,28 +283,17 @@ class CheckRootFS(CliCommand):
 
     self.project.logging.debug("starting to check installed packages")
 
-    # Generate the dpkg command to retrieve the list of installed packages
-    command = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-    command += " dpkg -l | tail -n +6"
-    pkglist = self.execute_command(command)
+    # Retrieve the index of the dpkg database of the rootfs
+    dpkg_index = self.project.get_dpkg_status_index()
 
-    # Iterate the output of the dpkg process and build the dictionnary of
+    # Iterate the packages known by dpkg and build the dictionnary of
     # all installed packages
-    for binaryline in pkglist.splitlines():
-      # Each fields is stored into a variable to easy manipulation and
-      # simplify code. First get the array of words converted to UTF-8
-      line = binaryline.decode(Key.UTF8.value).split()
-
-      # Extract each fields
-      pkg_status = line[0]
-      pkg_name = line[1]
-      pkg_version = line[2]
-      pkg_arch = line[3]
-
+    for record in dpkg_index:
       # Build a dictionnary, using package name as main key
-      self.installed_packages[pkg_name] = {Key.STATUS.value:pkg_status,
-                                           Key.VERSION.value:pkg_version,
-                                           Key.ARCH.value:pkg_arch}
+      self.installed_packages[record["Package"]] = \
+                                      {Key.STATUS.value:dpkg_index.get_status_flags(record),
+                                       Key.VERSION.value:record.get("Version", ""),
+                                       Key.ARCH.value:record.get("Architecture", "")}
 
     # Check the installation constraint (mandatory-only, allow-optional or no-constraint)
     self.check_installation_constraint(rules)
@@ -468,26 +467,14 @@ class CheckRootFS(CliCommand):
 
     # Check version if higher or equal than min version
     if Key.MIN_VERSION.value in rule:
-      return_code = 0
       if rule[Key.NAME.value] in self.installed_packages:
-        # Generate the dpkg command to compare the versions
-        dpkg_command = "dpkg --compare-versions " + rule[Key.MIN_VERSION.value]
-        dpkg_command += " lt " + self.installed_packages[rule[Key.NAME.value]][Key.VERSION.value]
-
-        # We have to protect the subprocess in a try except block since dpkg
-        # will return 1 if the check is invalid
-        try:
-          compare_result = subprocess.run(dpkg_command, stdout=subprocess.PIPE,
-                                          stderr=subprocess.PIPE, shell=True,
-                                          check=True, universal_newlines=False)
-          return_code = compare_result.returncode
-
-        # Catch the execution exception and set return_code to something else than zero
-        except subprocess.CalledProcessError:
-          return_code = 1
+        # Compare the versions in process, using Debian ordering rules
+        is_valid = DebianVersion.compare_versions(rule[Key.MIN_VERSION.value], "lt",
+                                                  self.installed_packages[rule[Key.NAME.value]]\
+                                                  [Key.VERSION.value])
 
         # If the result is not ok, then output an info an go on checking next keyword
-        if return_code > 0:
+        if not is_valid:
           msg = "Version " + self.installed_packages[rule[Key.NAME.value]][Key.VERSION.value]
           msg += " of package is older than minimum " + "allowed version "
           msg += rule[Key.MIN_VERSION.value]
@@ -500,26 +487,14 @@ class CheckRootFS(CliCommand):
 
     # Check version if lower or equal than max version
     if Key.MAX_VERSION.value in rule:
-      return_code = 0
       if rule[Key.NAME.value] in self.installed_packages:
-          # Generate the dpkg command to compare the versions
-        dpkg_command = "dpkg --compare-versions " + rule[Key.MAX_VERSION.value]
-        dpkg_command += " gt " + self.installed_packages[rule[Key.NAME.value]][Key.VERSION.value]
-
-        # We have to protect the subprocess in a try except block since dpkg
-        # will return 1 if the check is invalid
-        try:
-          compare_result = subprocess.run(dpkg_command, stdout=subprocess.PIPE,
-                                          stderr=subprocess.PIPE, shell=True,
-                                          check=True, universal_newlines=False)
-          return_code = compare_result.returncode
-
-        # Catch the execution exception and set return_code to something else than zero
-        except subprocess.CalledProcessError:
-          return_code = 1
+        # Compare the versions in process, using Debian ordering rules
+        is_valid = DebianVersion.compare_versions(rule[Key.MAX_VERSION.value], "gt",
+                                                  self.installed_packages[rule[Key.NAME.value]]\
+                                                  [Key.VERSION.value])
 
         # If the result is not ok, then output an info an go on checking next keyword
-        if return_code > 0:
+        if not is_valid:
           self.project.logging.error("Version " + self.installed_packages[rule[Key.NAME.value]]\
                                      [Key.VERSION.value] + " of package is newer than maximum " +
                                      "allowed version " + rule[Key.MAX_VERSION.value])
@@ -628,6 +603,9 @@ class CheckRootFS(CliCommand):
     # Reset the rules statistics before starting to itare the list of rules
     self.reset_rule_check_statistics()
 
+    # Compute in advance, concurrently, the digests of all the files having hash rules
+    self.prefetch_file_digests(rules)
+
     # Iterate the list of rules to check against installed files
     # Files will be checked on an individual basis, which is different of
     # packages. Package list can be retrieved with a single call to dpkg.
@@ -679,6 +657,36 @@ class CheckRootFS(CliCommand):
     print("")
 
 
+  # -------------------------------------------------------------------------
+  #
+  # prefetch_file_digests
+  #
+  # -------------------------------------------------------------------------
+  def prefetch_file_digests(self, rules):
+    """This method computes concurrently the digests of all the files having
+    hash rules in the rule set. Results are kept by the file hasher, and
+    used when the rules are checked one by one.
+    """
+
+    # Gather the files and the algorithms requested for each of them
+    requests = {}
+    for group in [Key.MANDATORY.value, Key.FORBIDDEN.value, Key.ALLOWED.value]:
+      for rule in rules[Key.FILES.value].get(group) or []:
+        if Key.PATH.value not in rule:
+          continue
+        algorithms = [algorithm for algorithm in self.HASH_ALGORITHMS if algorithm in rule]
+        if len(algorithms) > 0:
+          path = self.project.get_rootfs_mountpoint() + rule[Key.PATH.value]
+          requests.setdefault(path, set()).update(algorithms)
+
+    # Hash the files in the pool
+    if len(requests) > 0:
+      self.project.logging.debug("Computing digests of " + str(len(requests)) + " files")
+      self.file_hasher.prefetch([(path, sorted(algorithms))
+                                 for path, algorithms in requests.items()])
+
+
+
   # -------------------------------------------------------------------------
   #
   # check_file_rules
@@ -743,31 +751,39 @@ class CheckRootFS(CliCommand):
     self.project.logging.debug("After expension target_path " + rule[Key.PATH.value] +
                                " became " + rule[Key.TARGET_PATH.value])
 
+    # Stat the object only once. Like os.path.isdir and os.path.isfile, stat follows symlinks
+    is_link = os.path.islink(rule[Key.PATH.value])
+    try:
+      path_stat = os.stat(rule[Key.PATH.value])
+    except OSError:
+      path_stat = None
+    is_dir = path_stat is not None and stat.S_ISDIR(path_stat.st_mode)
+    is_file = path_stat is not None and stat.S_ISREG(path_stat.st_mode)
+
     # Check if mandatory package is missing
     if mandatory:
 # TODO inverser les tests et skip derriere le cas qui marche, par defaut erreur
       # Check for mandatoy directory
-      if not os.path.isdir(rule[Key.PATH.value]) and rule[Key.TYPE.value] == Key.DIRECTORY.value:
+      if not is_dir and rule[Key.TYPE.value] == Key.DIRECTORY.value:
         msg = "Missing mandatory directory : " + rule[Key.PATH.value]
         self.is_rule_check_successfull = False
         return msg
 
       # Check for mandatoy symlink
-      if not os.path.islink(rule[Key.PATH.value]) and rule[Key.TYPE.value] == Key.SYMLINK.value:
+      if not is_link and rule[Key.TYPE.value] == Key.SYMLINK.value:
         msg = "Missing mandatory symlink : " + rule[Key.PATH.value]
         self.is_rule_check_successfull = False
         return msg
 
       # Check for mandatoy file
-      if not os.path.isfile(rule[Key.PATH.value]) and rule[Key.TYPE.value] == Key.FILE.value:
+      if not is_file and rule[Key.TYPE.value] == Key.FILE.value:
         msg = "Missing mandatory file : " + rule[Key.PATH.value]
         self.is_rule_check_successfull = False
         return msg
 
       # If target is defined, we have to check that it does not exist either
       if Key.TARGET.value in rule:
-        if not os.path.isdir(rule[Key.PATH.value]) and not os.path.islink(rule[Key.PATH.value]) and\
-           not os.path.isfile(rule[Key.PATH.value]):
+        if not is_dir and not is_link and not is_file:
           msg = "Missing mandatory target : " + rule[Key.TARGET_PATH.value]
           self.is_rule_check_successfull = False
           return msg
@@ -775,46 +791,53 @@ class CheckRootFS(CliCommand):
     # Check if forbidden files are installed
     if forbidden:
       # Check for forbidden directory
-      if os.path.isdir(rule[Key.PATH.value]) and rule[Key.TYPE.value] == Key.DIRECTORY.value:
+      if is_dir and rule[Key.TYPE.value] == Key.DIRECTORY.value:
         msg = "Forbidden directory exists : " + rule[Key.PATH.value]
         self.is_rule_check_successfull = False
         return msg
 
       # Check for forbidden symlink
-      if os.path.islink(rule[Key.PATH.value]) and rule[Key.TYPE.value] == Key.SYMLINK.value:
+      if is_link and rule[Key.TYPE.value] == Key.SYMLINK.value:
         msg = "Forbidden symlink exists : " + rule[Key.PATH.value]
         self.is_rule_check_successfull = False
         return msg
 
       # Check for forbidden file
-      if os.path.isfile(rule[Key.PATH.value]) and rule[Key.TYPE.value] == Key.FILE.value:
+      if is_file and rule[Key.TYPE.value] == Key.FILE.value:
         msg = "Forbidden file exists : " + rule[Key.PATH.value]
         self.is_rule_check_successfull = False
         return msg
 
     # Check the type of the object (can be file directory or symlink)
     if allowed:
-      if not os.path.isdir(rule[Key.PATH.value]) and rule[Key.TYPE.value] == Key.DIRECTORY.value:
+      if not is_dir and rule[Key.TYPE.value] == Key.DIRECTORY.value:
         msg = "Object " + rule[Key.PATH.value] + " is not a directory"
         self.is_rule_check_successfull = False
         return msg
 
       # Check for mandatoy symlink
-      if not os.path.islink(rule[Key.PATH.value]) and rule[Key.TYPE.value] == Key.SYMLINK.value:
+      if not is_link and rule[Key.TYPE.value] == Key.SYMLINK.value:
         msg = "Object " + rule[Key.PATH.value] + " is not a symlink"
         self.is_rule_check_successfull = False
         return msg
 
       # Check for mandatoy file
-      if not os.path.isfile(rule[Key.PATH.value]) and rule[Key.TYPE.value] == Key.FILE.value:
+      if not is_file and rule[Key.TYPE.value] == Key.FILE.value:
         msg = "Object " + rule[Key.PATH.value] + " is not a file"
         self.is_rule_check_successfull = False
         return msg
 
+    # Attributes can only be checked on an existing object
+    if path_stat is None and (Key.OWNER.value in rule or Key.GROUP.value in rule or \
+                              Key.MODE.value in rule):
+      msg = "Missing object : " + rule[Key.PATH.value]
+      self.is_rule_check_successfull = False
+      return msg
+
     # Check the owner of the object
     if Key.OWNER.value in rule:
       # Retrieve the uid from the stat call
-      uid = os.stat(rule[Key.PATH.value]).st_uid
+      uid = path_stat.st_uid
 
       # Compare it to the owner from the rule
       if str(uid) != rule[Key.OWNER.value]:
@@ -826,7 +849,7 @@ class CheckRootFS(CliCommand):
     # Check the group of the object
     if Key.GROUP.value in rule:
       # Retrieve the gid from the stat call
-      gid = os.stat(rule[Key.PATH.value]).st_gid
+      gid = path_stat.st_gid
 
       # Compare it to the owner from the rule
       if str(gid) != rule[Key.GROUP.value]:
@@ -838,7 +861,7 @@ class CheckRootFS(CliCommand):
     # Check the mode of the object
     if Key.MODE.value in rule:
       # Retrieve the mode from the stat call
-      mode = os.stat(rule[Key.PATH.value]).st_mode
+      mode = path_stat.st_mode
 
       # Convert to octal with same representation as filesystem
       mode = oct(stat.S_IMODE(mode))
@@ -907,107 +930,29 @@ class CheckRootFS(CliCommand):
           self.is_rule_check_successfull = False
           return msg
 
-    # Check the md5 hash of the target
-    if Key.MD5.value in rule:
-      # Check if the file exist. Use the target path to expand symlinks
-      if not os.path.isfile(rule[Key.TARGET_PATH.value]):
-        msg = "Missing target file : " + rule[Key.TARGET_PATH.value]
-        self.is_rule_check_successfull = False
-        return msg
-
-      # Create the hasher used to parse file and compute hash
-      md5_hasher = hashlib.md5()
-
-      # Open file in read binary mode
-      with open(rule[Key.PATH.value], 'rb') as file_to_hash:
-
-        # Create the buffer for file reading
-        buffer = file_to_hash.read(self.block_size)
-
-        # Iterate the file reading. Each time it loops, it updates the hasher
-        # buffer, appending data just read
-        while len(buffer) > 0:
-          md5_hasher.update(buffer)
-          buffer = file_to_hash.read(self.block_size)
-
-        # Compare the hash to the rule, and set the check flag if needed
-        if rule[Key.MD5.value] != md5_hasher.hexdigest():
-          msg = "File " + rule[Key.PATH.value] + " has an invalid MD5 hash. hash is "
-          msg += md5_hasher.hexdigest() + " instead of " + rule[Key.MD5.value]
-          self.is_rule_check_successfull = False
-          return msg
-        else:
-          self.project.logging.debug("File " + rule[Key.PATH.value] + " has a valid MD5 hash. " +
-                                     "hash is " + md5_hasher.hexdigest())
-
-    # Check the sha1 hash of the target
-    if Key.SHA1.value in rule:
-
+    # Check the hashes of the target. All the requested digests are computed in a single pass
+    algorithms = [algorithm for algorithm in self.HASH_ALGORITHMS if algorithm in rule]
+    if len(algorithms) > 0:
       # Check if the file exist. Use the target path to expand symlinks
       if not os.path.isfile(rule[Key.TARGET_PATH.value]):
         msg = "Missing target file : " + rule[Key.TARGET_PATH.value]
         self.is_rule_check_successfull = False
         return msg
 
-      # Create the hasher used to parse file and compute hash
-      sha1_hasher = hashlib.sha1()
-
-      # Open file in read binary mode
-      with open(rule[Key.PATH.value], 'rb') as file_to_hash:
+      # Retrieve the digests, they may have been prefetched
+      digests = self.file_hasher.hash_file(rule[Key.PATH.value], algorithms)
 
-        # Create the buffer for file reading
-        buffer = file_to_hash.read(self.block_size)
-
-        # Iterate the file reading. Each time it loops, it updates the hasher
-        # buffer, appending data just read
-        while len(buffer) > 0:
-          sha1_hasher.update(buffer)
-          buffer = file_to_hash.read(self.block_size)
-
-        # Compare the hash to the rule, and set the check flag if needed
-        if rule[Key.SHA1.value] != sha1_hasher.hexdigest():
-          msg = "File " + rule[Key.PATH.value] + " has an invalid SHA1 hash. hash is "
-          msg += sha1_hasher.hexdigest() + " instead of " + rule[Key.SHA1.value]
+      # Compare each hash to the rule, and set the check flag if needed
+      for algorithm in algorithms:
+        name = algorithm.upper()
+        if rule[algorithm] != digests[algorithm]:
+          msg = "File " + rule[Key.PATH.value] + " has an invalid " + name + " hash. hash is "
+          msg += digests[algorithm] + " instead of " + rule[algorithm]
           self.is_rule_check_successfull = False
           return msg
         else:
-          self.project.logging.debug("File " + rule[Key.PATH.value] + " has a valid SHA1 hash. " +
-                                     "hash is " + sha1_hasher.hexdigest())
-
-    # Check the sha256 hash of the target
-    if Key.SHA256.value in rule:
-
-      # Check if the file exist. Use the target path to expand symlinks
-      if not os.path.isfile(rule[Key.TARGET_PATH.value]):
-        msg = "Missing target file : " + rule[Key.TARGET_PATH.value]
-        self.is_rule_check_successfull = False
-        return msg
-
-      # Create the hasher used to parse file and compute hash
-      sha256_hasher = hashlib.sha256()
-
-      # Open file in read binary mode
-      with open(rule[Key.PATH.value], 'rb') as file_to_hash:
-
-        # Create the buffer for file reading
-        buffer = file_to_hash.read(self.block_size)
-
-        # Iterate the file reading. Each time it loops, it updates the hasher
-        # buffer, appending data just read
-        while len(buffer) > 0:
-          sha256_hasher.update(buffer)
-          buffer = file_to_hash.read(self.block_size)
-
-        # Compare the hash to the rule, and set the check flag if needed
-        if rule[Key.SHA256.value] != sha256_hasher.hexdigest():
-          print("in error")
-          self.is_rule_check_successfull = False
-          msg = "File " + rule[Key.PATH.value] + " has an invalid SHA256 hash. SHA256 is "
-          msg += sha256_hasher.hexdigest() + " instead of " + rule[Key.SHA256.value]
-        else:
-          print("in success")
-          msg = "File " + rule[Key.PATH.value] + " has a valid SHA256 hash. hash is "
-          msg += sha256_hasher.hexdigest()
+          self.project.logging.debug("File " + rule[Key.PATH.value] + " has a valid " + name +
+                                     " hash. hash is " + digests[algorithm])
 
     # Default exit, return the msg value
     return msg
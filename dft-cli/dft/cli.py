@@ -37,10 +37,12 @@ from dft import build_image
 from dft import build_firmware
 from dft import build_firmware_update
 from dft import build_rootfs
+from dft import debootstrap_cache
 from dft import check_rootfs
 from dft import strip_rootfs
 from dft import list_content
 from dft import sequence
+from dft import multi_target
 
 # -----------------------------------------------------------------------------
 #
@@ -82,6 +84,8 @@ Available commands are :
 . build_rootfs          Generate a rootfs from a Debian repository, install
                         and configure required packages inside the newly
                         created rootfs (based on debootstrap and Ansible)
+. cache                 Manage the debootstrap snapshots (list, prune or
+                        verify the stored snapshots)
 . check_rootfs          Control the content of the rootfs rootfs after its
                         generation (debsecan and openscap)
 ? list_content          Generate a manifest identiyfing content and versions
@@ -120,6 +124,8 @@ Available commands are :
       self.__add_parser_assemble_firmware()
     elif self.command == Key.BUILD_ROOTFS.value:
       self.__add_parser_build_rootfs()
+    elif self.command == Key.CACHE.value:
+      self.__add_parser_cache()
     elif self.command == Key.INSTALL_BOOTCHAIN.value:
       self.__add_parser_install_bootchain()
     elif self.command == Key.BUILD_IMAGE.value:
@@ -185,6 +191,39 @@ Available commands are :
 
 
 
+  def __add_parser_cache(self):
+    """ This method add parser options specific to cache command
+    """
+
+    # Add the arguments
+    self.parser.add_argument(Key.CACHE.value,
+                             help=Key.OPT_HELP_LABEL.value)
+
+    # Action to run on the snapshots
+    self.parser.add_argument(Key.CACHE_ACTION.value,
+                             choices=[Key.LIST.value, Key.PRUNE.value, Key.VERIFY.value],
+                             help="list the snapshots, prune them according to size and age\n"
+                                  "limits, or verify their checksums")
+
+    # Overrides the maximum age of the snapshots defined in the configuration
+    self.parser.add_argument(Key.OPT_MAX_AGE.value,
+                             action='store',
+                             type=int,
+                             dest=Key.MAX_AGE.value,
+                             help="remove the snapshots unused for more than this number of days\n"
+                                  "(prune only, overrides the configuration)")
+
+    # Overrides the maximum size of the snapshots defined in the configuration
+    self.parser.add_argument(Key.OPT_MAX_SIZE.value,
+                             action='store',
+                             type=int,
+                             dest=Key.MAX_SIZE.value,
+                             help="remove the least recently used snapshots until their total\n"
+                                  "size is below this value in MB (prune only, overrides the\n"
+                                  "configuration)")
+
+
+
   def __add_parser_install_bootchain(self):
     """ This method add parser options specific to install_bootchain command
     """
@@ -234,6 +273,13 @@ Available commands are :
     self.parser.add_argument(Key.BUILD_FIRMWARE_UPDATE.value,
                              help=Key.OPT_HELP_LABEL.value)
 
+    # Defines the previous firmware used as a base to build a delta update
+    self.parser.add_argument(Key.OPT_DELTA_BASE.value,
+                             action='store',
+                             dest=Key.DELTA_BASE.value,
+                             help="build a delta update against this previous firmware. It is\n"
+                                  "either a firmware content directory or an update archive\n")
+
 
 
   def __add_parser_check_rootfs(self):
@@ -323,6 +369,13 @@ Available commands are :
                              default=Key.DEFAULT_SEQUENCE_NAME.value,
                              help='Name of the command sequence to execute')
 
+    # Skip the steps completed by a previous run of the sequence
+    self.parser.add_argument(Key.OPT_RESUME.value,
+                             action='store_true',
+                             dest=Key.RESUME.value,
+                             help="skip the steps completed by the previous run of the sequence,\n"
+                                  "unless they have been modified since")
+
   def __add_parser_common(self):
     """ This method add parser options common to all command
     Configuration file store the definition of rootfs. Option can be
@@ -364,6 +417,21 @@ Available commands are :
                                   "purposes, it cannot be harmful to use it but you will have to\n"
                                   "clean up deboostrap workdir and files by hand)")
 
+    # Run the command for all the targets defined in the project, instead of only the first
+    # one. Targets are processed concurrently, each in its own process
+    self.parser.add_argument(Key.OPT_ALL_TARGETS.value,
+                             action='store_true',
+                             dest=Key.ALL_TARGETS.value,
+                             help="run the command for all the targets of the project, in parallel")
+
+    # Maximum number of targets processed at the same time
+    self.parser.add_argument(Key.OPT_JOBS.value,
+                             action='store',
+                             type=int,
+                             dest=Key.JOBS.value,
+                             help="maximum number of targets processed at the same time when\n"
+                                  "using --all-targets. Default value is the number of CPU")
+
 
   # -------------------------------------------------------------------------
   #
@@ -371,14 +439,10 @@ Available commands are :
   #
   # -------------------------------------------------------------------------
   def run(self):
-    """ According to the command, call the method dedicated to run the
-      command called from cli
+    """ Load the configuration and the project definition, then run the
+      command for the first target, or for all the targets if requested
     """
 
-    # Deactivate too_many-branches since we want it to be written this way
-    # (it means one branch in if else test for each command word)
-    # pylint: disable=too-many-branches
-
     # Create the dft configuration object, and load its configuration
     if self.args.config_file is None:
       self.dft = model.Configuration()
@@ -415,11 +479,55 @@ Available commands are :
 
     # ---------------------------------------------------------------------
 
+    # Run the command for each target if requested, otherwise only the first target is used
+    if self.args.all_targets and self.command != Key.CACHE.value:
+      runner = multi_target.MultiTargetRunner(self.project, self.args.jobs)
+      if not runner.run(self.__run_target):
+        self.project.logging.critical("Some targets have failed")
+        exit(1)
+    else:
+      self.__run_command()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __run_target
+  #
+  # -------------------------------------------------------------------------
+  def __run_target(self, project):
+    """ Method used to run the command for a single target. It is called in
+    its own process by the multi target runner, with the project restricted
+    to the target.
+    """
+
+    # Use the restricted project, then run the command
+    self.project = project
+    self.__run_command()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __run_command
+  #
+  # -------------------------------------------------------------------------
+  def __run_command(self):
+    """ According to the command, call the method dedicated to run the
+      command called from cli
+    """
+
+    # Deactivate too_many-branches since we want it to be written this way
+    # (it means one branch in if else test for each command word)
+    # pylint: disable=too-many-branches
+
     # Select the method to run according to the command
     if self.command == Key.ASSEMBLE_FIRMWARE.value:
       self.__run_assemble_firmware()
     elif self.command == Key.BUILD_ROOTFS.value:
       self.__run_build_rootfs()
+    elif self.command == Key.CACHE.value:
+      self.__run_cache()
     elif self.command == Key.INSTALL_BOOTCHAIN.value:
       self.__run_install_bootchain()
     elif self.command == Key.BUILD_IMAGE.value:
@@ -497,6 +605,24 @@ Available commands are :
 
 
 
+  # -------------------------------------------------------------------------
+  #
+  # __run_cache
+  #
+  # -------------------------------------------------------------------------
+  def __run_cache(self):
+    """ Method used to handle the cache command.
+      Create the business objet, then execute the entry point
+    """
+
+    # Create the business object
+    command = debootstrap_cache.SnapshotDebootstrap(self.dft, self.project)
+
+    # Then call the dedicated method
+    command.run_cache(self.args.cache_action, self.args.max_size, self.args.max_age)
+
+
+
   # -------------------------------------------------------------------------
   #
   # __run_install_bootchain
@@ -585,7 +711,7 @@ Available commands are :
     command = build_firmware_update.BuildFirmwareUpdate(self.dft, self.project)
 
     # Then call the dedicated method
-    command.build_update_archive()
+    command.build_update_archive(self.args.delta_base)
 
 
 
@@ -718,6 +844,9 @@ Available commands are :
     else:
       self.dft.sequence_name = Key.DEFAULT_SEQUENCE_NAME.value
 
+    # Get the resume flag
+    self.dft.resume_sequence = self.args.resume
+
     # Create the business object
     command = sequence.Sequence(self.dft, self.project)
 
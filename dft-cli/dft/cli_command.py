@@ -28,9 +28,16 @@ import subprocess
 import logging
 import tempfile
 import errno
+import threading
+import time
+import uuid
+from collections import deque
 from enum import Enum
 from dft.enumkey import Key
 from dft.ansi_colors import Colors
+from dft.command_runner import CommandRunner
+from dft.command_runner import CommandResult
+from dft.package_cache import PackageCacheProxy
 
 
 #-----------------------------------------------------------------------------
@@ -70,6 +77,320 @@ class Code(Enum):
 
 
 
+# -----------------------------------------------------------------------------
+#
+#    Class ChrootSession
+#
+# -----------------------------------------------------------------------------
+class ChrootSession(object):
+  """This class implements a persistent session inside the chrooted
+  environment. A single shell is started in the rootfs, then commands are
+  sent to it through a pipe. This avoids forking a new chroot (and a new
+  emulated shell when QEMU is used) for each command.
+
+  Each command is run in a subshell, thus it cannot modify the session state
+  (current directory, variables, etc.). Its stdout is returned to the caller,
+  its stderr is streamed to the logs.
+  """
+
+  # Size of the chunks read from the pipes
+  READ_SIZE = 65536
+
+  # Time to wait for the stderr of a command to be drained (in seconds)
+  STDERR_SYNC_TIMEOUT = 10
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, logger, rootfs, tail_size=None):
+    """Default constructor
+    """
+
+    # Logger used to output the command output
+    self.logging = logger
+
+    # Path to the rootfs used as the root of the session
+    self.rootfs = rootfs
+
+    # Number of output lines kept for error reporting
+    if tail_size is None:
+      self.tail_size = CommandRunner.DEFAULT_TAIL_SIZE
+    else:
+      self.tail_size = tail_size
+
+    # The helper process. None until the session is started
+    self.process = None
+
+    # Unique string used to detect the end of a command output. It is regenerated
+    # at each start of the session
+    self.marker = None
+
+    # Thread in charge of draining stderr, and the event used to synchronize it with the
+    # end of each command
+    self.stderr_thread = None
+    self.stderr_done = threading.Event()
+
+    # Circular buffer storing the last lines of output of the current command
+    self.tail = deque(maxlen=self.tail_size)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # start
+  #
+  # -------------------------------------------------------------------------
+  def start(self):
+    """This method starts the helper shell in the chrooted environment. It
+    has to be called once qemu is installed (if needed) and the chrooted
+    environment is setup.
+    """
+
+    # Generate a marker which cannot appear in commands output
+    self.marker = "__DFT_CHROOT_SESSION_" + uuid.uuid4().hex + "__"
+
+    # Force the C locale in the session, as it was done in the previous chroot commands
+    env = dict(os.environ)
+    env["LANG"] = "C"
+
+    # Start the shell inside the rootfs
+    self.logging.debug("starting chroot session in " + self.rootfs)
+    self.process = subprocess.Popen(["chroot", self.rootfs, "/bin/sh"], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+
+    # Start the thread draining stderr
+    self.stderr_thread = threading.Thread(target=self.__drain_stderr, daemon=True)
+    self.stderr_thread.start()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # is_running
+  #
+  # -------------------------------------------------------------------------
+  def is_running(self):
+    """This method returns True if the helper shell is running.
+    """
+
+    # The session is running if the process exist and has not exited yet
+    return self.process is not None and self.process.poll() is None
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # run
+  #
+  # -------------------------------------------------------------------------
+  def run(self, command, capture_output=True):
+    """This method runs a command in the session and waits for its
+    completion. It returns a CommandResult object containing the return code
+    and the output of the command. It does not raise on non zero exit code.
+    """
+
+    # Create the object used to store the result
+    result = CommandResult(command)
+    self.tail.clear()
+    self.stderr_done.clear()
+
+    # Store the start time before sending the command
+    start_time = time.perf_counter()
+
+    # Generate the script sent to the session. The command runs in a subshell with stdin
+    # redirected, so it cannot read the session pipe. Then the return code is sent with the
+    # marker on stdout, and the marker alone on stderr to synchronize the stderr thread
+    script = "( " + command + "\n) </dev/null\n"
+    script += "printf '%s %d\\n' '" + self.marker + "' $?\n"
+    script += "printf '%s\\n' '" + self.marker + "' >&2\n"
+
+    # Chunks of stdout kept for the caller when capture is requested
+    captured = []
+
+    try:
+      # Send the script to the shell
+      self.process.stdin.write(script.encode(Key.UTF8.value))
+      self.process.stdin.flush()
+
+      # Read stdout until the marker is found
+      marker = self.marker.encode(Key.UTF8.value)
+      pending = b""
+      while True:
+        chunk = os.read(self.process.stdout.fileno(), self.READ_SIZE)
+
+        # An empty chunk means the helper has exited. It should not happen unless the
+        # command killed the session
+        if not chunk:
+          self.logging.error("chroot session terminated unexpectedly")
+          result.returncode = -1
+          self.stop()
+          break
+
+        # Search for the marker in pending data
+        pending += chunk
+        index = pending.find(marker)
+        if index >= 0:
+          # Wait for the end of the line containing the return code
+          end = pending.find(b"\n", index)
+          if end < 0:
+            continue
+
+          # Extract the return code, and output the remaining data
+          result.returncode = int(pending[index + len(marker):end].decode(Key.UTF8.value))
+          self.__output_data(pending[:index], captured, capture_output, True)
+          break
+
+        # Output the complete lines, and keep the last incomplete line in the buffer since the
+        # marker can be split between chunks
+        end = pending.rfind(b"\n")
+        if end >= 0:
+          self.__output_data(pending[:end + 1], captured, capture_output, False)
+          pending = pending[end + 1:]
+
+    except OSError as exception:
+      # The pipe is broken, the session is no longer usable
+      self.logging.error("chroot session error : " + str(exception))
+      result.returncode = -1
+      self.stop()
+
+    # Wait for the stderr of this command to be drained
+    if result.returncode >= 0:
+      self.stderr_done.wait(self.STDERR_SYNC_TIMEOUT)
+
+    # Store the results
+    result.wall_time = time.perf_counter() - start_time
+    result.stdout = b"".join(captured)
+    result.tail = list(self.tail)
+    self.logging.debug("completed with code " + str(result.returncode) + " : " +
+                       "wall time %.2fs" % result.wall_time)
+
+    # And return the result to the caller
+    return result
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # stop
+  #
+  # -------------------------------------------------------------------------
+  def stop(self):
+    """This method stops the helper shell. Closing stdin is enough to make
+    the shell exit.
+    """
+
+    # Nothing to do if the session was not started
+    if self.process is None:
+      return
+
+    self.logging.debug("stopping chroot session in " + self.rootfs)
+
+    # Close stdin, the shell will exit on end of file
+    try:
+      self.process.stdin.close()
+    except OSError:
+      pass
+
+    # Wait for the process, and kill it if it does not exit
+    try:
+      self.process.wait(timeout=self.STDERR_SYNC_TIMEOUT)
+    except subprocess.TimeoutExpired:
+      self.process.kill()
+      self.process.wait()
+
+    # Release the pipes
+    self.process.stdout.close()
+    if self.stderr_thread is not None:
+      self.stderr_thread.join()
+    self.process.stderr.close()
+
+    # Session is no longer usable
+    self.process = None
+    self.stderr_thread = None
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __output_data
+  #
+  # -------------------------------------------------------------------------
+  def __output_data(self, data, captured, capture_output, last):
+    """This method outputs the data read from stdout to the logs, and keep
+    it for the caller if needed. If last is True, the trailing incomplete
+    line is also output.
+    """
+
+    # Nothing to do on empty data
+    if len(data) == 0:
+      return
+
+    # Keep the data if stdout has to be returned to the caller
+    if capture_output:
+      captured.append(data)
+
+    # Split the data into lines and output them
+    lines = data.split(b"\n")
+    if lines[-1] == b"" or not last:
+      lines.pop()
+    for line in lines:
+      text = "stdout: " + line.decode(Key.UTF8.value, errors="replace").rstrip("\r")
+      self.tail.append(text)
+      self.logging.debug(text)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __drain_stderr
+  #
+  # -------------------------------------------------------------------------
+  def __drain_stderr(self):
+    """This method is run in a thread. It reads the stderr of the session and
+    outputs each line to the logs. It sets the stderr_done event when the
+    marker is received.
+    """
+
+    # Marker used to detect the end of a command
+    marker = self.marker.encode(Key.UTF8.value)
+
+    # Read stderr line by line until the end of file
+    for line in iter(self.process.stderr.readline, b""):
+      line = line.rstrip(b"\n")
+
+      # Check if the line is the end of command marker. It may be preceded by an incomplete
+      # line from the command
+      if line.endswith(marker):
+        line = line[:-len(marker)]
+        if len(line) > 0:
+          self.__output_stderr_line(line)
+        self.stderr_done.set()
+      else:
+        self.__output_stderr_line(line)
+
+    # Unlock any pending wait when the session exits
+    self.stderr_done.set()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __output_stderr_line
+  #
+  # -------------------------------------------------------------------------
+  def __output_stderr_line(self, line):
+    """This method outputs a line read from stderr to the logs and the tail.
+    """
+
+    # Decode the line and output it
+    text = "stderr: " + line.decode(Key.UTF8.value, errors="replace").rstrip("\r")
+    self.tail.append(text)
+    self.logging.debug(text)
+
+
+
 # -----------------------------------------------------------------------------
 #
 #    Class CliCommand
@@ -144,6 +465,19 @@ class CliCommand(object):
     self.right_align = 80
     self.len_str_code = 6
 
+    # Runner used to execute external commands and stream their output to the logs
+    self.command_runner = CommandRunner(self.project.logging,
+                                        self.project.get_command_log_file(),
+                                        self.project.get_command_log_tail_size())
+
+    # Persistent session used to run commands inside the chrooted environment. It is started
+    # on first use and stopped when qemu or the chrooted environment are torn down
+    self.chroot_session = None
+
+    # Local server used to download packages through the host package cache. It is started
+    # on first catalog update, if the package cache is activated
+    self.package_cache = None
+
 
 
   # -------------------------------------------------------------------------
@@ -151,34 +485,265 @@ class CliCommand(object):
   # execute_command
   #
   # -------------------------------------------------------------------------
-  def execute_command(self, command):
+  def execute_command(self, command, capture_output=True):
     """ This method run a command as a subprocess. Typical use case is
     running commands.
 
-    This method is a wrapper to subprocess.run , and will be moved soon
-    in a helper object. It provides mutalisation of error handling
+    This method is a wrapper to the command runner. Output is streamed to
+    the logs while the command is running. It provides mutalisation of error
+    handling. The output of the command is returned to the caller, unless
+    capture_output is False (used for verbose commands whose output is not
+    parsed, such as debootstrap or ansible).
     """
 
     self.project.logging.debug("running : " + command)
 
-    try:
-      # Execute the subprocess, output ans errors are piped
-      completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                 shell=True, check=True, universal_newlines=False)
-
-      # Return the output of the process to the caller
-      return completed.stdout
+    # Execute the subprocess, output and errors are streamed to the logs
+    result = self.command_runner.run(command, capture_output)
 
-    except subprocess.CalledProcessError as exception:
+    # Check the return code, and report the error with the tail of the output
+    if not result.succeeded():
       self.cleanup()
       self.project.logging.critical("Error %d occured when executing %s",
-                                    exception.returncode, exception.cmd)
-      self.project.logging.debug("stdout was :")
-      self.project.logging.debug(exception.stdout)
-      self.project.logging.debug("stderr was :")
-      self.project.logging.debug(exception.stderr)
+                                    result.returncode, command)
+      self.project.logging.error("last lines of output were :")
+      for line in result.tail:
+        self.project.logging.error(line)
+      exit(1)
+
+    # Return the output of the process to the caller
+    return result.stdout
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # execute_in_chroot
+  #
+  # -------------------------------------------------------------------------
+  def execute_in_chroot(self, command, capture_output=True):
+    """ This method runs a command inside the chrooted environment, using
+    the persistent chroot session. The session is started on first call,
+    thus qemu has to be installed (if needed) before calling this method.
+
+    Error handling and returned value are the same as execute_command.
+    """
+
+    # Start the session if it is not running yet
+    if self.chroot_session is None or not self.chroot_session.is_running():
+      self.chroot_session = ChrootSession(self.project.logging,
+                                          self.project.get_rootfs_mountpoint(),
+                                          self.project.get_command_log_tail_size())
+      self.chroot_session.start()
+
+    self.project.logging.debug("running in chroot : " + command)
+
+    # Execute the command in the session
+    result = self.chroot_session.run(command, capture_output)
+
+    # Check the return code, and report the error with the tail of the output
+    if not result.succeeded():
+      self.cleanup()
+      self.project.logging.critical("Error %d occured when executing %s in chroot",
+                                    result.returncode, command)
+      self.project.logging.error("last lines of output were :")
+      for line in result.tail:
+        self.project.logging.error(line)
       exit(1)
 
+    # Return the output of the process to the caller
+    return result.stdout
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # stop_chroot_session
+  #
+  # -------------------------------------------------------------------------
+  def stop_chroot_session(self):
+    """ This method stops the persistent chroot session if it is running. It
+    has to be called before removing qemu or umounting the chrooted
+    environment.
+    """
+
+    # Stop the session if it has been started
+    if self.chroot_session is not None:
+      self.chroot_session.stop()
+      self.chroot_session = None
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_package_cache_url
+  #
+  # -------------------------------------------------------------------------
+  def get_package_cache_url(self, url):
+    """ This method returns the url to use to download from a repository. It
+    is the url of the package cache server if the cache is activated, and the
+    given url otherwise.
+    """
+
+    # Check if the cache is activated
+    if not self.project.get_use_package_cache():
+      return url
+
+    # Start the server if needed, then rewrite the url
+    self.start_package_cache()
+    return self.package_cache.redirect_url(url)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # start_package_cache
+  #
+  # -------------------------------------------------------------------------
+  def start_package_cache(self):
+    """ This method starts the package cache server if it is activated and not
+    yet running.
+    """
+
+    # Check if the cache is activated and not running
+    if not self.project.get_use_package_cache() or self.package_cache is not None:
+      return
+
+    # Create and start the server
+    self.package_cache = PackageCacheProxy(self.project.logging,
+                                           self.project.get_package_cachedir())
+    self.package_cache.start()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # stop_package_cache
+  #
+  # -------------------------------------------------------------------------
+  def stop_package_cache(self):
+    """ This method restores the APT sources of the rootfs to the upstream
+    repositories, then stops the package cache server if it is running.
+
+    Sources are restored even if the server is not running, since a rootfs
+    restored from the cache may contain sources redirected by the build which
+    created the snapshot. Restoring is a no-op on upstream sources.
+    """
+
+    # Restore the sources
+    self.restore_apt_sources()
+
+    # Then stop the server if it is running
+    if self.package_cache is not None:
+      self.package_cache.stop()
+      self.package_cache = None
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # redirect_apt_sources
+  #
+  # -------------------------------------------------------------------------
+  def redirect_apt_sources(self):
+    """ This method rewrites the APT sources files of the rootfs, so that APT
+    downloads packages and indexes through the package cache. It does nothing
+    if the cache is not activated.
+    """
+
+    # Check if the cache is activated
+    if not self.project.get_use_package_cache():
+      return
+
+    # Start the server if needed, and rewrite all the sources
+    self.start_package_cache()
+    for filepath in self.__get_apt_sources_files():
+      self.__rewrite_apt_sources_file(filepath, self.package_cache.redirect_sources)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # restore_apt_sources
+  #
+  # -------------------------------------------------------------------------
+  def restore_apt_sources(self):
+    """ This method reverts the rewriting of the APT sources files of the
+    rootfs. The lists files downloaded through the package cache are renamed
+    as if they had been downloaded from the upstream repositories.
+    """
+
+    self.project.logging.debug("Restoring APT sources to upstream repositories")
+
+    # Restore the sources
+    for filepath in self.__get_apt_sources_files():
+      self.__rewrite_apt_sources_file(filepath, PackageCacheProxy.restore_sources)
+
+    # Then rename the lists files
+    lists_dir = self.project.get_rootfs_mountpoint() + "/var/lib/apt/lists"
+    if os.path.isdir(lists_dir):
+      for filename in os.listdir(lists_dir):
+        upstream_filename = PackageCacheProxy.restore_lists_filename(filename)
+        if upstream_filename is not None:
+          os.rename(os.path.join(lists_dir, filename), os.path.join(lists_dir, upstream_filename))
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __get_apt_sources_files
+  #
+  # -------------------------------------------------------------------------
+  def __get_apt_sources_files(self):
+    """ This method returns the list of the APT sources files of the rootfs.
+    """
+
+    # Main sources file
+    files = []
+    filepath = self.project.get_rootfs_mountpoint() + "/etc/apt/sources.list"
+    if os.path.isfile(filepath):
+      files.append(filepath)
+
+    # And the files under sources.list.d, both one line and deb822 formats
+    sources_dir = self.project.get_rootfs_mountpoint() + "/etc/apt/sources.list.d"
+    if os.path.isdir(sources_dir):
+      for filename in sorted(os.listdir(sources_dir)):
+        if filename.endswith(".list") or filename.endswith(".sources"):
+          files.append(os.path.join(sources_dir, filename))
+
+    # Return the list of files
+    return files
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __rewrite_apt_sources_file
+  #
+  # -------------------------------------------------------------------------
+  def __rewrite_apt_sources_file(self, filepath, rewrite):
+    """ This method applies the rewrite function to the content of an APT
+    sources file. The file is replaced only if the content has changed.
+    """
+
+    # Read the current content and rewrite it
+    with open(filepath, "r") as working_file:
+      content = working_file.read()
+    new_content = rewrite(content)
+    if new_content == content:
+      return
+
+    # Generate the new file and move it under the rootfs tree
+    with tempfile.NamedTemporaryFile(mode='w+', delete=False) as working_file:
+      working_file.write(new_content)
+    working_file.close()
+
+    command = "mv -f " + working_file.name + " " + filepath
+    self.execute_command(command)
+
+    command = "chmod a+r " + filepath
+    self.execute_command(command)
+
+
 
   # -------------------------------------------------------------------------
   #
@@ -232,6 +797,11 @@ class CliCommand(object):
                                     qemu_target_arch)
       exit(1)
 
+    # QEMU may have been installed by the sequence for concurrent steps, then it is used as is
+    if self.dft.shared_qemu:
+      self.project.logging.debug("using QEMU installed by the sequence")
+      return
+
     # Generate the qemu binary name
 
     self.project.logging.info("setting up QEMU for arch " + self.project.get_target_arch() +
@@ -250,11 +820,27 @@ class CliCommand(object):
     """This method copy the QEMU static binary to the target
     """
 
+    # The chroot session may run through qemu, thus it has to be stopped first
+    self.stop_chroot_session()
+
+    # APT sources have to point to the real repositories once the work is done
+    self.stop_package_cache()
+
     # We should not execute if the flag is not set. Should have already
     # been tested, but double check by security
     if self.use_qemu_static != True:
       return
 
+    # Nothing to remove if QEMU has not been installed
+    if self.qemu_binary is None:
+      self.project.logging.debug("QEMU has not been installed, nothing to clean")
+      return
+
+    # QEMU installed by the sequence is removed by the sequence itself
+    if self.dft.shared_qemu:
+      self.project.logging.debug("QEMU installed by the sequence, keeping it")
+      return
+
     if self.project.dft.keep_bootstrap_files or self.project.dft.force_keep_bootstrap_files:
       self.project.logging.debug("keep_bootstrap_files is activated, keeping QEMU in " +
                                  self.project.get_rootfs_mountpoint())
@@ -293,9 +879,8 @@ class CliCommand(object):
     """
 
     self.project.logging.debug("Remove package : " + target)
-    command = "chroot " + self.project.get_rootfs_mountpoint()
-    command += " /usr/bin/apt-get autoremove --purge --yes " + target
-    self.execute_command(command)
+    command = "/usr/bin/apt-get autoremove --purge --yes " + target
+    self.execute_in_chroot(command)
 
 
   # -------------------------------------------------------------------------
@@ -312,10 +897,9 @@ class CliCommand(object):
     """
 
     self.project.logging.debug("Install package(s) : " + target)
-    command = "chroot " + self.project.get_rootfs_mountpoint()
-    command += " /usr/bin/apt-get install --no-install-recommends --yes "
+    command = "/usr/bin/apt-get install --no-install-recommends --yes "
     command += " --allow-unauthenticated  " + target
-    self.execute_command(command)
+    self.execute_in_chroot(command)
 
 
 
@@ -329,9 +913,8 @@ class CliCommand(object):
     """
 
 #TODO keyserver should be a configuration value
-    command = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-    command += " apt-key adv --recv-keys --keyserver hkp://keyserver.ubuntu.com " + key
-    self.execute_command(command)
+    command = "apt-key adv --recv-keys --keyserver hkp://keyserver.ubuntu.com " + key
+    self.execute_in_chroot(command)
 
     # Import the key into GnuPG - It has to be done in three step because
     # the apt-key recv does not work without a terminal and a stdout
@@ -367,10 +950,12 @@ class CliCommand(object):
     have qemu installed.
     """
 
+    # Download through the package cache if it is activated
+    self.redirect_apt_sources()
+
     self.project.logging.debug("Updating APT catalog")
-    command = "chroot " + self.project.get_rootfs_mountpoint()
-    command += " /usr/bin/apt-get update --yes --allow-unauthenticated "
-    self.execute_command(command)
+    command = "/usr/bin/apt-get update --yes --allow-unauthenticated "
+    self.execute_in_chroot(command)
 
 
 
@@ -387,14 +972,13 @@ class CliCommand(object):
     """
 
     self.project.logging.debug("Upgrading packages")
-    command = "chroot " + self.project.get_rootfs_mountpoint()
-    command += " /usr/bin/apt full-upgrade --yes"
+    command = "/usr/bin/apt full-upgrade --yes"
 
     # Check if the allow downgrades flag is set
     if allow_downgrades:
       command += " --allow-downgrades "
 
-    self.execute_command(command)
+    self.execute_in_chroot(command, capture_output=False)
 
 
 
@@ -447,6 +1031,12 @@ class CliCommand(object):
     # Set the flag used to prevent multiple call
     self.cleanup_in_progress = True
 
+    # Stop the chroot session before umounting the special filesystems
+    self.stop_chroot_session()
+
+    # APT sources have to point to the real repositories once the work is done
+    self.stop_package_cache()
+
     # Check if /proc is mounted, then umount it
     if self.proc_is_mounted:
       command = "umount " + self.project.get_rootfs_mountpoint() + "/dev/pts"
@@ -646,11 +1236,10 @@ class CliCommand(object):
             logging.debug("retrieving public key : " + key_url)
 
             # Generate the retrieve and add command
-            command = "chroot " + self.project.get_rootfs_mountpoint() + " bash -c "
-            command += "'/usr/bin/wget -qO - "
+            command = "/usr/bin/wget -qO - "
             command += target[Key.PUBKEY_URL.value]
-            command += " | /usr/bin/apt-key add -'"
-            self.execute_command(command)
+            command += " | /usr/bin/apt-key add -"
+            self.execute_in_chroot(command)
 
           # Public key is not available, installation is likely to fail
           else:
@@ -0,0 +1,283 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the command runner used by all the cli commands to
+execute external programs. Output is streamed line by line to the logger (and
+optionally to a log file) while the program is running, instead of being
+buffered until the end of the execution.
+"""
+
+import os
+import time
+import selectors
+import subprocess
+from collections import deque
+from datetime import datetime
+from dft.enumkey import Key
+
+# -----------------------------------------------------------------------------
+#
+#    Class CommandResult
+#
+# -----------------------------------------------------------------------------
+class CommandResult(object):
+  """This class stores the result of a command executed by the command runner.
+  It contains the exit code, the captured output (if requested), the tail of
+  the output used to build error reports, and the resource usage statistics.
+  """
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, command):
+    """Default constructor
+    """
+
+    # The command line which has been executed
+    self.command = command
+
+    # Exit code of the command. None until the process has been waited for
+    self.returncode = None
+
+    # Captured standard output, as bytes. It is only filled when output capture
+    # has been requested by the caller, otherwise it stays empty
+    self.stdout = b""
+
+    # Last lines of the output (both stdout and stderr, in arrival order). The
+    # size of this list is capped by the runner tail size
+    self.tail = []
+
+    # Wall clock time elapsed during execution, in seconds
+    self.wall_time = 0.0
+
+    # CPU time (user and system) consumed by the command and its children, in seconds
+    self.cpu_time = 0.0
+
+    # Peak resident set size of the command (or of its biggest child) in KiB
+    self.max_rss = 0
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # succeeded
+  #
+  # -------------------------------------------------------------------------
+  def succeeded(self):
+    """This method returns True if the command exited with a zero return
+    code.
+    """
+
+    # Zero is the only valid success code
+    return self.returncode == 0
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_statistics
+  #
+  # -------------------------------------------------------------------------
+  def get_statistics(self):
+    """This method returns a human readable string describing the resources
+    used by the command.
+    """
+
+    # Format the statistics in a single line
+    return "wall time %.2fs, cpu time %.2fs, peak rss %d KiB" % (self.wall_time, self.cpu_time,
+                                                                 self.max_rss)
+
+
+
+# -----------------------------------------------------------------------------
+#
+#    Class CommandRunner
+#
+# -----------------------------------------------------------------------------
+class CommandRunner(object):
+  """This class implements the execution of external commands. The command
+  is run through a shell, and its stdout and stderr are read as soon as data
+  is available. Each complete line is sent to the logger and to the command
+  log file if one is defined.
+
+  Only a bounded tail of the output is kept in memory for error reporting.
+  The full stdout is kept only when the caller needs to parse it.
+  """
+
+  # Default number of lines kept in memory for error reporting
+  DEFAULT_TAIL_SIZE = 200
+
+  # Size of the chunks read from the pipes
+  READ_SIZE = 65536
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, logger, log_filename=None, tail_size=None):
+    """Default constructor
+    """
+
+    # Logger used to output the command output
+    self.logging = logger
+
+    # Path to the file receiving the output of all the commands. None means no log file
+    self.log_filename = log_filename
+
+    # Number of output lines kept for error reporting
+    if tail_size is None:
+      self.tail_size = self.DEFAULT_TAIL_SIZE
+    else:
+      self.tail_size = tail_size
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # run
+  #
+  # -------------------------------------------------------------------------
+  def run(self, command, capture_output=True):
+    """This method executes the command given as argument in a shell, and
+    streams its output. It waits for the end of the command and returns a
+    CommandResult object. It does not raise on non zero exit code, the
+    caller is in charge of checking the return code.
+
+    If capture_output is False, stdout is only streamed to the logs and not
+    kept in memory (except for the tail).
+    """
+
+    # Create the object used to store the result
+    result = CommandResult(command)
+
+    # Circular buffer storing the last lines of output
+    tail = deque(maxlen=self.tail_size)
+
+    # Open the log file if needed. It is opened in append mode since it contains the output
+    # of all the commands executed during the run
+    log_file = None
+    if self.log_filename is not None:
+      os.makedirs(os.path.dirname(os.path.abspath(self.log_filename)), exist_ok=True)
+      log_file = open(self.log_filename, "ab")
+      log_file.write(("# " + datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " running : " +
+                      command + "\n").encode(Key.UTF8.value))
+
+    # Store the start time before forking the process
+    start_time = time.perf_counter()
+
+    # Start the process, output and errors are piped and will be read as a stream
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               stdin=subprocess.DEVNULL, shell=True)
+
+    # Chunks of stdout kept for the caller when capture is requested
+    captured = []
+
+    # Register both pipes in the selector. Each pipe has its own buffer used to store the
+    # incomplete line received at the end of a chunk
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ, {"name": "stdout", "buffer": b""})
+    selector.register(process.stderr, selectors.EVENT_READ, {"name": "stderr", "buffer": b""})
+
+    try:
+      # Read the pipes until both are closed
+      while len(selector.get_map()) > 0:
+        for key, _ in selector.select():
+          # Read what is available. Using os.read prevents blocking on partial lines
+          chunk = os.read(key.fd, self.READ_SIZE)
+
+          # An empty chunk means end of file. Flush the pending data and unregister the pipe
+          if not chunk:
+            if len(key.data["buffer"]) > 0:
+              self.__output_line(key.data["name"], key.data["buffer"], tail, log_file)
+              key.data["buffer"] = b""
+            selector.unregister(key.fileobj)
+            continue
+
+          # Keep the data if stdout has to be returned to the caller
+          if capture_output and key.data["name"] == "stdout":
+            captured.append(chunk)
+
+          # Split the data into lines, the last item is an incomplete line (or empty)
+          lines = (key.data["buffer"] + chunk).split(b"\n")
+          key.data["buffer"] = lines.pop()
+          for line in lines:
+            self.__output_line(key.data["name"], line, tail, log_file)
+    finally:
+      # Release the selector and the pipes
+      selector.close()
+      process.stdout.close()
+      process.stderr.close()
+
+      # Wait for the process and retrieve its resource usage. Usage of wait4 gives the
+      # figures of this very process (and its children) instead of all the children
+      _, status, rusage = os.wait4(process.pid, 0)
+
+      # Compute the return code the same way as subprocess does
+      if os.WIFSIGNALED(status):
+        result.returncode = -os.WTERMSIG(status)
+      else:
+        result.returncode = os.WEXITSTATUS(status)
+      process.returncode = result.returncode
+
+      # Store the statistics
+      result.wall_time = time.perf_counter() - start_time
+      result.cpu_time = rusage.ru_utime + rusage.ru_stime
+      result.max_rss = rusage.ru_maxrss
+      result.stdout = b"".join(captured)
+      result.tail = list(tail)
+
+      # Output the statistics and close the log file
+      self.logging.debug("completed with code " + str(result.returncode) + " : " +
+                         result.get_statistics())
+      if log_file is not None:
+        log_file.write(("# exit code " + str(result.returncode) + ", " +
+                        result.get_statistics() + "\n").encode(Key.UTF8.value))
+        log_file.close()
+
+    # And return the result to the caller
+    return result
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __output_line
+  #
+  # -------------------------------------------------------------------------
+  def __output_line(self, name, line, tail, log_file):
+    """This method outputs a line of the command output to the logger, the
+    tail buffer and the log file.
+    """
+
+    # Decode the line, invalid bytes should not abort the build
+    text = line.decode(Key.UTF8.value, errors="replace").rstrip("\r")
+
+    # Push the line to the tail buffer, oldest lines are dropped automatically
+    tail.append(name + ": " + text)
+
+    # Stream the line to the logs
+    self.logging.debug(name + ": " + text)
+
+    # And to the log file if defined
+    if log_file is not None:
+      log_file.write(line + b"\n")
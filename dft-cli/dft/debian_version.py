@@ -0,0 +1,262 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the comparison of Debian package versions, as
+defined by the Debian policy (section 5.6.12) and implemented by dpkg. It is
+used instead of running dpkg --compare-versions, thus versions can be
+compared without forking a process, and on hosts without dpkg.
+"""
+
+import string
+import functools
+
+# -----------------------------------------------------------------------------
+#
+#    Class DebianVersion
+#
+# -----------------------------------------------------------------------------
+@functools.total_ordering
+class DebianVersion(object):
+  """This class stores a Debian version, split into epoch, upstream version
+  and revision. Instances are compared with the usual operators.
+  """
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, version):
+    """Default constructor. The version is parsed as dpkg does, the epoch is
+    what comes before the first colon, and the revision what comes after the
+    last hyphen. Both are optional.
+    """
+
+    # Keep the original string, used for output
+    self.version = version.strip()
+
+    # Extract the epoch, which defaults to 0
+    self.epoch = 0
+    upstream = self.version
+    if ':' in upstream:
+      epoch, upstream = upstream.split(':', 1)
+      if not epoch.isdigit():
+        raise ValueError("Invalid epoch in version " + self.version)
+      self.epoch = int(epoch)
+
+    # Extract the revision, which defaults to empty (compares as 0)
+    self.revision = ""
+    if '-' in upstream:
+      upstream, self.revision = upstream.rsplit('-', 1)
+    self.upstream = upstream
+
+    # Upstream version must start with a digit, but dpkg only warns about it
+    if len(self.upstream) == 0:
+      raise ValueError("Empty upstream version in version " + self.version)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __str__
+  #
+  # -------------------------------------------------------------------------
+  def __str__(self):
+    """Returns the version as it was given
+    """
+
+    return self.version
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __eq__
+  #
+  # -------------------------------------------------------------------------
+  def __eq__(self, other):
+    """Returns True if the two versions are equal according to Debian rules
+    (for instance 1.0 and 0:1.0-0 are equal).
+    """
+
+    return self.compare(other) == 0
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __lt__
+  #
+  # -------------------------------------------------------------------------
+  def __lt__(self, other):
+    """Returns True if this version is older than the other one
+    """
+
+    return self.compare(other) < 0
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __hash__
+  #
+  # -------------------------------------------------------------------------
+  def __hash__(self):
+    """Returns a hash consistent with equality. Trailing zeros are not
+    significant, thus only the epoch is used.
+    """
+
+    return hash(self.epoch)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # compare
+  #
+  # -------------------------------------------------------------------------
+  def compare(self, other):
+    """This method returns a negative number if this version is older than
+    the other one, zero if they are equal, and a positive number if it is
+    newer. The other version can be a string.
+    """
+
+    # Parse the other version if needed
+    if not isinstance(other, DebianVersion):
+      other = DebianVersion(other)
+
+    # Epoch first, then upstream version, and finally revision
+    if self.epoch != other.epoch:
+      return self.epoch - other.epoch
+    result = self.compare_part(self.upstream, other.upstream)
+    if result != 0:
+      return result
+    return self.compare_part(self.revision, other.revision)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # compare_part
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def compare_part(part_a, part_b):
+    """This method compares upstream versions or revisions. Strings are
+    compared alternating their non digit and digit parts. Non digit parts
+    are compared by character with the modified order (~ first, then end
+    of string, then letters, then the other characters). Digit parts are
+    compared numerically.
+    """
+
+    index_a = 0
+    index_b = 0
+    while index_a < len(part_a) or index_b < len(part_b):
+      # Compare the non digit parts, character by character
+      first_diff = 0
+      while (index_a < len(part_a) and part_a[index_a] not in string.digits) or \
+            (index_b < len(part_b) and part_b[index_b] not in string.digits):
+        order_a = DebianVersion.order(part_a[index_a] if index_a < len(part_a) else None)
+        order_b = DebianVersion.order(part_b[index_b] if index_b < len(part_b) else None)
+        if order_a != order_b:
+          return order_a - order_b
+        index_a += 1
+        index_b += 1
+
+      # Skip the leading zeros of the digit parts
+      while index_a < len(part_a) and part_a[index_a] == '0':
+        index_a += 1
+      while index_b < len(part_b) and part_b[index_b] == '0':
+        index_b += 1
+
+      # Compare the digit parts. The first different digit is kept, and used only if both
+      # numbers have the same length
+      while index_a < len(part_a) and part_a[index_a] in string.digits and \
+            index_b < len(part_b) and part_b[index_b] in string.digits:
+        if first_diff == 0:
+          first_diff = ord(part_a[index_a]) - ord(part_b[index_b])
+        index_a += 1
+        index_b += 1
+
+      # The longest number is the greatest
+      if index_a < len(part_a) and part_a[index_a] in string.digits:
+        return 1
+      if index_b < len(part_b) and part_b[index_b] in string.digits:
+        return -1
+      if first_diff != 0:
+        return first_diff
+
+    # Both strings have been completely compared
+    return 0
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # order
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def order(character):
+    """This method returns the weight of a character in non digit parts. None
+    stands for the end of the part. Digits are considered as the end, since
+    the non digit part is over.
+    """
+
+    if character is None or character in string.digits:
+      return 0
+    elif character in string.ascii_letters:
+      return ord(character)
+    elif character == '~':
+      return -1
+    return ord(character) + 256
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # compare_versions
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def compare_versions(version_a, operator, version_b):
+    """This method compares two versions strings, as dpkg --compare-versions
+    does. operator is one of lt, le, eq, ne, ge, gt. As with dpkg, the
+    comparison is false if one of the versions is invalid.
+    """
+
+    # Compare the versions then apply the operator
+    try:
+      result = DebianVersion(str(version_a)).compare(str(version_b))
+    except ValueError:
+      return False
+    if operator == "lt":
+      return result < 0
+    elif operator == "le":
+      return result <= 0
+    elif operator == "eq":
+      return result == 0
+    elif operator == "ne":
+      return result != 0
+    elif operator == "ge":
+      return result >= 0
+    elif operator == "gt":
+      return result > 0
+    raise ValueError("Unknown version comparison operator " + operator)
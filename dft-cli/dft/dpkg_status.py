@@ -0,0 +1,341 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the index of the packages known by dpkg inside a
+rootfs. The dpkg database is parsed directly from the host, instead of
+running dpkg -l in the chrooted environment (which is emulated on foreign
+architectures, and truncates columns according to the terminal width).
+"""
+
+import os
+import glob
+import bz2
+import gzip
+import lzma
+
+# -----------------------------------------------------------------------------
+#
+#    Class DpkgStatusIndex
+#
+# -----------------------------------------------------------------------------
+class DpkgStatusIndex(object):
+  """This class parses the status file of dpkg (var/lib/dpkg/status) and
+  stores one record per package. Records are dictionnaries of the fields of
+  the package stanza (Package, Status, Version, Architecture, etc.).
+
+  Archive metadata (Size, MD5sum, SHA256) is not stored in the status file.
+  It is read from the dpkg available file and the APT lists, the first time
+  it is requested.
+  """
+
+  # Path of the dpkg and APT files, relative to the rootfs
+  STATUS_FILE = "/var/lib/dpkg/status"
+  AVAILABLE_FILE = "/var/lib/dpkg/available"
+  APT_LISTS_PATTERN = "/var/lib/apt/lists/*_Packages*"
+
+  # Functions used to open compressed APT lists
+  COMPRESSED_OPENERS = {".gz": gzip.open,
+                        ".bz2": bz2.open,
+                        ".xz": lzma.open,
+                        ".lzma": lzma.open}
+
+  # Fields retrieved from the archive metadata
+  ARCHIVE_FIELDS = ["Size", "MD5sum", "SHA1", "SHA256", "Filename"]
+
+  # Abbreviations used by dpkg -l for the selection and the status of the packages
+  SELECTION_FLAGS = {"unknown": "u",
+                     "install": "i",
+                     "hold": "h",
+                     "deinstall": "r",
+                     "purge": "p"}
+  STATUS_FLAGS = {"not-installed": "n",
+                  "config-files": "c",
+                  "half-installed": "H",
+                  "unpacked": "U",
+                  "half-configured": "F",
+                  "triggers-awaited": "W",
+                  "triggers-pending": "t",
+                  "installed": "i"}
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, rootfs):
+    """Default constructor. The index is empty until load is called.
+    """
+
+    # Path to the rootfs containing the dpkg database
+    self.rootfs = rootfs
+
+    # Records indexed by package name. Packages installed for several architectures
+    # (multiarch) are also indexed by name:arch
+    self.records = {}
+
+    # Modification time of the status file when it was loaded. It is used to detect that
+    # the index is outdated
+    self.status_mtime = None
+
+    # Flag set once the archive metadata has been merged into the records
+    self.archive_metadata_loaded = False
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # load
+  #
+  # -------------------------------------------------------------------------
+  def load(self):
+    """This method parses the status file in a single streaming pass, and
+    replaces the content of the index.
+    """
+
+    # Reset the index
+    self.records = {}
+    self.archive_metadata_loaded = False
+
+    # Stat the file before reading it, thus a modification during the parsing makes the
+    # index outdated
+    status_path = self.rootfs + self.STATUS_FILE
+    self.status_mtime = os.stat(status_path).st_mtime_ns
+
+    # Parse the stanzas and index them. As dpkg -l does, packages not installed and without
+    # configuration files left are ignored
+    for record in self.parse_stanzas(status_path):
+      if "Package" not in record or record.get("Status", "").endswith("not-installed"):
+        continue
+      name = record["Package"]
+      arch = record.get("Architecture", "")
+
+      # The first record of a name is indexed by name, others by name:arch
+      if name in self.records:
+        self.records[name + ":" + arch] = record
+      else:
+        self.records[name] = record
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # is_outdated
+  #
+  # -------------------------------------------------------------------------
+  def is_outdated(self):
+    """This method returns True if the status file has been modified since
+    it has been loaded (or if it was never loaded).
+    """
+
+    try:
+      return self.status_mtime != os.stat(self.rootfs + self.STATUS_FILE).st_mtime_ns
+    except OSError:
+      return True
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get
+  #
+  # -------------------------------------------------------------------------
+  def get(self, name):
+    """This method returns the record of a package, or None if the package
+    is unknown.
+    """
+
+    return self.records.get(name)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __contains__
+  #
+  # -------------------------------------------------------------------------
+  def __contains__(self, name):
+    """Returns True if the package is known by dpkg
+    """
+
+    return name in self.records
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __iter__
+  #
+  # -------------------------------------------------------------------------
+  def __iter__(self):
+    """Iterates the records, in the order of the status file
+    """
+
+    return iter(self.records.values())
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_metadata
+  #
+  # -------------------------------------------------------------------------
+  def get_metadata(self, record, field):
+    """This method returns a field of a package record (as returned by get or
+    by iterating the index), or None if it is not defined. Archive fields
+    (Size, MD5sum, SHA256, etc.) are loaded from the available file and the
+    APT lists when first requested.
+    """
+
+    # Load the archive metadata if needed
+    if field in self.ARCHIVE_FIELDS and not self.archive_metadata_loaded:
+      self.load_archive_metadata()
+
+    # Return the value of the field
+    return record.get(field)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # load_archive_metadata
+  #
+  # -------------------------------------------------------------------------
+  def load_archive_metadata(self):
+    """This method merges the archive fields into the records. The available
+    file and the APT lists are parsed once, and only the stanzas matching an
+    indexed package (same name, version and architecture) are used.
+    """
+
+    # Build the lookup table of the indexed packages
+    packages = {}
+    for record in self.records.values():
+      packages[(record.get("Package"), record.get("Version"),
+                record.get("Architecture"))] = record
+
+    # Parse the available file then the APT lists. Files are compressed if APT is
+    # configured to keep them compressed
+    paths = [self.rootfs + self.AVAILABLE_FILE]
+    paths += sorted(glob.glob(self.rootfs + self.APT_LISTS_PATTERN))
+    for path in paths:
+      if not os.path.isfile(path):
+        continue
+      for stanza in self.parse_stanzas(path):
+        record = packages.get((stanza.get("Package"), stanza.get("Version"),
+                               stanza.get("Architecture")))
+        if record is None:
+          continue
+
+        # Fields already known are kept
+        for field in self.ARCHIVE_FIELDS:
+          if field in stanza and field not in record:
+            record[field] = stanza[field]
+
+    # Archive metadata is now loaded
+    self.archive_metadata_loaded = True
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_status_flags
+  #
+  # -------------------------------------------------------------------------
+  def get_status_flags(self, record):
+    """This method returns the status of a package, abbreviated as dpkg -l
+    does (for instance ii for an installed package, or rc for a removed
+    package which still has configuration files).
+    """
+
+    # Status field is made of the selection, the error flag and the status
+    status = record.get("Status", "unknown ok not-installed").split()
+    if len(status) != 3:
+      return "??"
+
+    # Build the flags, with the error flag only if the package needs to be reinstalled
+    flags = self.SELECTION_FLAGS.get(status[0], "?") + self.STATUS_FLAGS.get(status[2], "?")
+    if status[1] == "reinstreq":
+      flags += "R"
+    return flags
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_short_description
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def get_short_description(record):
+    """This method returns the first line of the description of a package
+    """
+
+    return record.get("Description", "").split("\n", 1)[0]
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # parse_stanzas
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def parse_stanzas(path):
+    """This method is a generator returning the stanzas of a control file
+    (status, available, Packages) as dictionnaries. The file is read line by
+    line, thus it is never completely loaded in memory. Continuation lines
+    are appended to the value of the field, separated by a new line.
+    """
+
+    # Select the way to open the file according to its compression. Other compressions
+    # (lz4, zstd) are not supported and the file is ignored
+    opener = open
+    for suffix, compressed_opener in DpkgStatusIndex.COMPRESSED_OPENERS.items():
+      if path.endswith(suffix):
+        opener = compressed_opener
+    if path.endswith(".lz4") or path.endswith(".zst"):
+      return
+
+    # Parse the file
+    stanza = {}
+    field = None
+    with opener(path, "rt", encoding="utf-8", errors="replace") as control_file:
+      for line in control_file:
+        line = line.rstrip("\n")
+
+        # An empty line ends the stanza
+        if len(line.strip()) == 0:
+          if len(stanza) > 0:
+            yield stanza
+          stanza = {}
+          field = None
+
+        # A line starting with a space continues the current field
+        elif line[0] in " \t":
+          if field is not None:
+            stanza[field] += "\n" + line[1:]
+
+        # Otherwise a new field starts
+        elif ":" in line:
+          field, value = line.split(":", 1)
+          stanza[field] = value.strip()
+
+    # The last stanza may not be followed by an empty line
+    if len(stanza) > 0:
+      yield stanza
@@ -44,8 +44,11 @@ class Key(Enum):
 
   ABSENT = "absent"
   ACTION = "action"
+  ACTIVATE_DEBOOTSTRAP_SNAPSHOT = "activate_debootstrap_snapshot"
   ACTIVATE_DEFAULT_BSP_REPOSITORY = "activate_default_bsp_repository"
   ACTIVATE_DEBOOTSTRAP_CACHEDIR = "activate_debootstrap_cachedir"
+  ACTIVATE_PACKAGE_CACHE = "activate_package_cache"
+  ACTIVATE_ROOTFS_CACHE = "activate_rootfs_cache"
   ADDITIONAL_BINARIES = "additional_binaries"
   ADDITIONAL_MODULES = "additional_modules"
   ADDITIONAL_ROLES = "additional_roles"
@@ -55,6 +58,7 @@ class Key(Enum):
   ALLOWED = "allowed"
   ALLOWED_ARCH = "allowed_arch"
   ALLOWED_VERSION = "allowed_version"
+  ALL_TARGETS = "all_targets"
   ANTIVIRUS = "antivirus"
   ARCH = "arch"
   ARCHITECTURE = "architecture"
@@ -68,11 +72,19 @@ class Key(Enum):
   ARMHF = "armhf"
   ASSEMBLE_FIRMWARE = "assemble_firmware"
   AUFS = "aufs"
+  AUTO = "auto"
   BANK_0 = "bank_0"
   BANK_1 = "bank_1"
+  BASE = "base"
+  BASE_SHA256 = "base_sha256"
   BLACKLISTED_ARCH = "blacklisted_arch"
   BLACKLISTED_VERSION = "blacklisted_version"
+  BLAKE2B = "blake2b"
+  BLOCK = "block"
+  BLOCK_HASH_METHOD = "block_hash_method"
+  BLOCK_HASH_SIZE = "block_hash_size"
   BLOCK_SIZE = "block_size"
+  BMAP = "bmap"
   BOARD = "board"
   BOOTCHAIN = "bootchain"
   BOOTCHAIN_WORKDIR = "bootchain"
@@ -87,10 +99,17 @@ class Key(Enum):
   BUILD_ROOTFS = "build_rootfs"
   BUILDING_SEQUENCES = "building_sequences"
   BZIP2 = "bzip2"
+  CACHE = "cache"
+  CACHE_ACTION = "cache_action"
   CHECK = "check"
   CHECK_ROOTFS = "check_rootfs"
+  CLONE_BANKS = "clone_banks"
+  COMMAND_LOG_FILE = "command_log_file"
+  COMMAND_LOG_TAIL_SIZE = "command_log_tail_size"
   COMPRESSION = "compression"
+  COMPRESSION_BACKEND = "compression_backend"
   COMPRESSION_OPTIONS = "compression_options"
+  COMPRESSION_THREADS = "compression_threads"
   COMPRESSOR = "compressor"
   CONFIG_FILE = "config_file"
   CONFIGURATION = "configuration"
@@ -105,10 +124,15 @@ class Key(Enum):
   CONTENT_SECURITY = "content_security"
   CONTENT_VULNERABILITIES = "content_vulnerabilities"
   CONTENT_WORKDIR = "content"
+  COPY_CONCURRENCY = "copy_concurrency"
+  CREATED = "created"
   CSV = "csv"
   CUSTOM = "custom"
   DEBIAN = "debian"
   DEBOOTSTRAP_REPOSITORY = "debootstrap_repository"
+  DEBOOTSTRAP_SNAPSHOT_DIR = "debootstrap_snapshot_dir"
+  DEBOOTSTRAP_SNAPSHOT_MAX_AGE = "debootstrap_snapshot_max_age"
+  DEBOOTSTRAP_SNAPSHOT_MAX_SIZE = "debootstrap_snapshot_max_size"
   DEBOOTSTRAP_TARGET = "minbase"
   DEBOOTSTRAP_CACHEDIR = "deboostrap_cachedir"
   DEFAULT_BSP_REPOSITORY_FILENAME = "default_bsp_repository_filename"
@@ -116,6 +140,9 @@ class Key(Enum):
   DEFAULT_CONFIGURATION_FILE = "~/.dftrc"
   DEFAULT_PROJECT_FILE = "project.yml"
   DEFAULT_SEQUENCE_NAME = "__dft_default_sequence__"
+  DELTA_BASE = "delta_base"
+  DELTA_BLOCK_SIZE = "delta_block_size"
+  DELTA_METHOD = "delta_method"
   DESCRIPTION = "description"
   DEVICE_NUMBER = "device_number"
   DEVICE_NUMBER_UBOOT = "device_number_uboot"
@@ -126,18 +153,22 @@ class Key(Enum):
   DEVUAN = "devuan"
   DEVUAN_SIGNING_PUBKEY = "FA1B0274"
   DFT_BASE = "dft_base"
+  DIGESTS = "digests"
   DIRECTORIES = "directories"
   DIRECTORY = "directory"
   DISTRIBUTIONS = "distributions"
   DUAL_BANKS = "dual_banks"
   DUMP = "dump"
   EMPTY = "empty"
+  EXCLUDE = "exclude"
   EXPECTED_RESULT = "expected_result"
   EXT_FS_TUNE = "ext_fs_tune"
   EXTENDED = "extended"
   FAILOVER = "failover"
+  FIELD_SEPARATOR = "field_separator"
   FILE = "file"
   FILENAME = "filename"
+  FILENAME_PREFIX = "filename_prefix"
   FILENAME_SUFFIX = "filename_suffix"
   FILENAME_TIMESTAMP = "filename_timestamp"
   FILENAME_TIMESTAMP_FORMAT = "filename_timestamp_format"
@@ -158,6 +189,7 @@ class Key(Enum):
   GENERATE_DEB = "generate_deb"
   GENERATE_SRC = "generate_src"
   GENERATE_VALIDITY_CHECK = "generate_validity_check"
+  GID = "gid"
   GPG_ARMOR_SIGNATURE = "gpg_armor_signature"
   GPG_KEY = "gpg_key"
   GPG = "gpg"
@@ -165,18 +197,24 @@ class Key(Enum):
   GROUP = "group"
   GRUB = "grub"
   GZIP = "gzip"
+  HARDLINK_GROUP = "hardlink_group"
   HASH_METHOD = "hash_method"
   IMAGE = "image"
   IMAGE_WORKDIR = "image"
+  INCLUDE = "include"
+  INCREMENTAL = "incremental"
   INIT_FILENAME = "init_filename"
   INITRAMFS = "initramfs"
+  INPUTS = "inputs"
   INSTALL_BOOTCHAIN = "install_bootchain"
   INSTALL_MISSING_SOFTWARE = "install_missing_software"
   INSTALL_MSSING_SOFTWARE = "install_mssing_software"
   INSTALLATION = "installation"
   INSTALLATION_CONSTRAINT = "installation_constraint"
   INSTALLED_SIZE = "installed_size"
+  JOBS = "jobs"
   JSON = "json"
+  JSONL = "jsonl"
   FORCE_KEEP_BOOTSTRAP_FILES = "force_keep_bootstrap_files"
   KEEP_BOOTSTRAP_FILES = "keep_bootstrap_files"
   KEEP_ROOTFS_HISTORY = "keep_rootfs_history"
@@ -185,22 +223,28 @@ class Key(Enum):
   LABEL = "label"
   LABEL_RESULT_FAIL = "[FAIL]"
   LABEL_RESULT_OK = "[ OK ]"
+  LAST_USED = "last_used"
   LAYOUT = "layout"
+  LIST = "list"
   LOG_LEVEL = "log_level"
   LOG_LEVEL_INFO = "INFO"
   LOGICAL = "logical"
+  LOOP_FREE = "loop_free"
   LYNIS = "lynis"
   LZ4 = "lz4"
   LZMA = "lzma"
   LZO = "lzo"
   MANDATORY = "mandatory"
   MANDATORY_ONLY = "mandatory_only"
+  MAX_AGE = "max_age"
+  MAX_SIZE = "max_size"
   MAX_VERSION = "max_version"
   MD5 = "md5"
   MESSAGE_END = "message_end"
   MESSAGE_START = "message_start"
   METHOD = "method"
   MIN_VERSION = "min_version"
+  MIRROR = "mirror"
   MKIMAGE = "mkimage"
   MKIMAGE_ARCH = "mkimage_arch"
   MKIMAGE_COMPRESSION = "mkimage_compression"
@@ -220,6 +264,8 @@ class Key(Enum):
   NONE = "none"
   NOPAD = "nopad"
   OPENSSL = "openssl"
+  OPERATION = "operation"
+  OPT_ALL_TARGETS = "--all-targets"
   OPT_CONFIG_FILE = "--config-file"
   OPT_CONTENT_ANTIVIRUS = "--generate-antivirus-information"
   OPT_CONTENT_FILES = "--generate-files-information"
@@ -227,16 +273,22 @@ class Key(Enum):
   OPT_CONTENT_ROOTKIT = "--generate-rootkit-information"
   OPT_CONTENT_SECURITY = "--generate-security-information"
   OPT_CONTENT_VULNERABILITIES = "--generate-vulnerabilities-information"
+  OPT_DELTA_BASE = "--delta-base"
   OPT_HELP_LABEL = "Command to execute"
+  OPT_JOBS = "--jobs"
   OPT_KEEP_BOOTSTRAP_FILES = "--keep-bootstrap-files"
   OPT_FORCE_KEEP_BOOTSTRAP_FILES = "--force-keep-bootstrap-files"
   OPT_LOG_LEVEL = "--log-level"
+  OPT_MAX_AGE = "--max-age"
+  OPT_MAX_SIZE = "--max-size"
   OPT_OVERRIDE_DEBIAN_MIRROR = "--override-debian-mirror"
   OPT_PROJECT_FILE = "--project"
+  OPT_RESUME = "--resume"
   OPT_SEQUENCE_NAME = "--sequence"
   OPTIONS = "options"
   ORIGIN = "origin"
   OUTPUT = "output"
+  OUTPUTS = "outputs"
   OUTPUT_PKG_ARCHITECTURE = "output_pkg_architecture"
   OUTPUT_PKG_DESCRIPTION = "output_pkg_description"
   OUTPUT_PKG_INSTALLED_SIZE = "output_pkg_installed_size"
@@ -251,10 +303,14 @@ class Key(Enum):
   OWNER = "owner"
   PACKAGE = "package"
   PACKAGES = "packages"
+  PACKAGE_CACHEDIR = "package_cachedir"
   PARTITION = "partition"
   PARTITIONS = "partitions"
+  PARTITION_CONCURRENCY = "partition_concurrency"
   PASS = "pass"
   PATH = "path"
+  PAYLOAD = "payload"
+  PAYLOAD_SIZE = "payload_size"
   PIN = "Pin"
   PIN_PRIORITY = "Pin-Priority"
   PINNING = "pinning"
@@ -264,9 +320,13 @@ class Key(Enum):
   PROJECT_NAME = "project_name"
   PROJECT_PATH = "project_path"
   PROJECT_WORKDIR = "project_base_workdir"
+  PRUNE = "prune"
   PUBKEY = "pubkey"
   PUBKEY_GPG = "pubkey_gpg"
   PUBKEY_URL = "pubkey_url"
+  PUNCH_HOLES = "punch_holes"
+  PYTHON = "python"
+  REMOVED = "removed"
   REMOVE_DOWNLOADED_ARCHIVES = "remove_downloaded_archives"
   REMOVE_VALIDITY_CHECK = "remove_validity_check"
   REPOSITORIES = "repositories"
@@ -274,13 +334,16 @@ class Key(Enum):
   RESCUE_IMAGE = "rescue_image"
   RESERVED_SIZE = "reserved_size"
   RESILIENCE = "resilience"
+  RESUME = "resume"
   RKHUNTER = "rkhunter"
   ROLES = "roles"
   ROOTFS = "rootfs"
+  ROOTFS_CACHEDIR = "rootfs_cachedir"
   ROOTFS_DIR = "rootfs"
   ROOTKIT = "rootkit"
   RUN_SEQUENCE = "run_sequence"
   SCAN = "scan"
+  SCAN_CONCURRENCY = "scan_concurrency"
   SECTIONS = "sections"
   SECURITY = "security"
   SEQUENCE_NAME = "sequence_name"
@@ -293,25 +356,35 @@ class Key(Enum):
   SIZE = "size"
   SKIP_MISSING_SOFTWARE = "skip_missing_software"
   SOURCE = "source"
+  SPARSE = "sparse"
   SQUASHFS = "squashfs"
   SQUASHFS_CONFIGURATION = "squashfs_configuration"
   SQUASHFS_FILE = "squashfs_file"
+  STAGE = "stage"
   STACK_DEFINITION = "stack_definition"
   STACK_ITEM = "stack_item"
   START_SECTOR = "start_sector"
+  STATE_FILE = "state_file"
   STATUS = "status"
   STDOUT = "stdout"
   STEPS = "steps"
+  STEP_CONCURRENCY = "step_concurrency"
+  STREAMING_COMPRESSION = "streaming_compression"
+  STREAMING_SIGNATURE = "streaming_signature"
   STRIP_ROOTFS = "strip_rootfs"
   STRIPPING = "stripping"
   SUITE = "suite"
   SYMLINK = "symlink"
   TARGET = "target"
+  TARGET_CONCURRENCY = "target_concurrency"
   TARGET_PATH = "target_path"
   TARGETS = "targets"
+  TARGET_SHA256 = "target_sha256"
+  TIMESTAMP = "timestamp"
   TMPFS = "tmpfs"
   TYPE = "type"
   UBOOT = "u-boot"
+  UID = "uid"
   UNIT = "unit"
   UNKNOWN = "unknown"
   UPDATE = "update"
@@ -323,8 +396,15 @@ class Key(Enum):
   UTF8 = "utf-8"
   VALUE = "value"
   VARIABLES = "variables"
+  VARIANT = "variant"
+  VERIFY = "verify"
+  VERITY = "verity"
+  VERITY_BLOCK_SIZE = "verity_block_size"
+  VERITY_HASH_METHOD = "verity_hash_method"
+  VERITY_SALT = "verity_salt"
   VERSION = "version"
   VULNERABILITIES = "vulnerabilities"
+  WINDOW_LOG = "window_log"
   WORKING_DIR = "working_dir"
   XATTRS = "xattrs"
   XML = "xml"
@@ -354,3 +434,4 @@ class Key(Enum):
   X86_64 = "x86_64"
   XTENSA = "xtensa"
   XZ = "xz"
+  ZSTD = "zstd"
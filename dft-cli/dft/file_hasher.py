@@ -0,0 +1,167 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the computation of file digests. All the digests
+requested for a file are computed in a single read pass, and the results
+are kept in memory, thus a file checked by several rules is read only once.
+"""
+
+import os
+import mmap
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# -----------------------------------------------------------------------------
+#
+#    Class FileHasher
+#
+# -----------------------------------------------------------------------------
+class FileHasher(object):
+  """This class computes the digests of files. Results are memoized by
+  (device, inode, modification time, size), thus a modified file is hashed
+  again.
+
+  Files can be hashed in advance by a pool of threads using prefetch.
+  hashlib releases the GIL while hashing, thus threads use all the CPU.
+  """
+
+  # Files larger than this size are mapped in memory instead of being read
+  MMAP_THRESHOLD = 1024 * 1024
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, block_size=65536, threads=None, memoize=True):
+    """Default constructor. If memoize is False, digests are not kept once
+    returned, which suits files hashed only once.
+    """
+
+    # Size of block used to read files, or to feed the hashers from the mapping
+    self.block_size = block_size
+
+    # Number of threads used by prefetch, default is the number of CPU
+    if threads is None or threads <= 0:
+      threads = os.cpu_count()
+    self.threads = threads
+
+    # Computed digests, indexed by file identity. Values are dictionnaries of digests by
+    # algorithm name. The lock protects the dictionnary when prefetching
+    self.memoize = memoize
+    self.digests = {}
+    self.lock = threading.Lock()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # hash_file
+  #
+  # -------------------------------------------------------------------------
+  def hash_file(self, path, algorithms):
+    """This method returns the dictionnary of the hex digests of the file,
+    for all the requested algorithms (hashlib names such as md5, sha1,
+    sha256). Symlinks are followed.
+    """
+
+    # Without memoization, the digests are computed and returned
+    file_stat = os.stat(path)
+    if not self.memoize:
+      return self.__compute_digests(path, algorithms, file_stat.st_size)
+
+    # Identify the file and retrieve what has already been computed
+    identity = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+    with self.lock:
+      known = self.digests.get(identity, {})
+    missing = [algorithm for algorithm in algorithms if algorithm not in known]
+
+    # Compute the missing digests in a single pass
+    if len(missing) > 0:
+      computed = self.__compute_digests(path, missing, file_stat.st_size)
+      with self.lock:
+        known = self.digests.setdefault(identity, {})
+        known.update(computed)
+
+    # Return the requested digests
+    return {algorithm: known[algorithm] for algorithm in algorithms}
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # prefetch
+  #
+  # -------------------------------------------------------------------------
+  def prefetch(self, requests):
+    """This method hashes in advance a list of (path, algorithms) using a
+    pool of threads. Files which cannot be read are ignored, the error will
+    be reported when the result is requested.
+    """
+
+    # Hash a file, ignoring errors
+    def hash_request(request):
+      try:
+        self.hash_file(request[0], request[1])
+      except OSError:
+        pass
+
+    # Run the pool and wait for all the files
+    with ThreadPoolExecutor(max_workers=self.threads) as executor:
+      list(executor.map(hash_request, requests))
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __compute_digests
+  #
+  # -------------------------------------------------------------------------
+  def __compute_digests(self, path, algorithms, size):
+    """This method reads the file once, and feeds all the hashers.
+    """
+
+    # Create one hasher per algorithm
+    hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+
+    with open(path, 'rb') as file_to_hash:
+      # Large files are mapped, the hashers are fed with views on the mapping without copy
+      if size >= self.MMAP_THRESHOLD:
+        with mmap.mmap(file_to_hash.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+          view = memoryview(mapping)
+          try:
+            for offset in range(0, size, self.block_size * 16):
+              block = view[offset:offset + self.block_size * 16]
+              for hasher in hashers.values():
+                hasher.update(block)
+              block.release()
+          finally:
+            view.release()
+      else:
+        # Small files are read by blocks
+        buffer = file_to_hash.read(self.block_size)
+        while len(buffer) > 0:
+          for hasher in hashers.values():
+            hasher.update(buffer)
+          buffer = file_to_hash.read(self.block_size)
+
+    # Return the hex digests
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
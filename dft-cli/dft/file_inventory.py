@@ -0,0 +1,381 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the inventory of the files of a rootfs. The tree
+is walked by a pool of threads using scandir, and the digests of the files
+are computed by the same pool. Each entry is given to the caller as soon as
+it is complete, thus the inventory can be streamed to the output.
+"""
+
+import os
+import stat
+import json
+import fnmatch
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait
+from dft.enumkey import Key
+from dft.file_hasher import FileHasher
+
+# -----------------------------------------------------------------------------
+#
+#    Class FileInventory
+#
+# -----------------------------------------------------------------------------
+class FileInventory(object):
+  """This class walks a tree and produces one record per entry. Records are
+  dictionnaries containing path (relative to the root of the tree, starting
+  with /), type, size, mode, uid, gid, symlink target, hardlink group
+  and optionally digests.
+
+  In incremental mode, the digests of the previous inventory are stored in
+  a state file, and reused for files whose inode, size and modification
+  time did not change. Thus the inventory of an unchanged tree does not
+  read any file.
+  """
+
+  # Names of the types of entries
+  TYPES = {stat.S_IFREG: "file",
+           stat.S_IFDIR: "directory",
+           stat.S_IFLNK: "symlink",
+           stat.S_IFCHR: "char",
+           stat.S_IFBLK: "block",
+           stat.S_IFIFO: "fifo",
+           stat.S_IFSOCK: "socket"}
+
+  # Maximum number of files waiting for their digests, per thread. Directories are not
+  # listed while it is reached, which bounds the memory used when digests are slower than
+  # the walk
+  PENDING_FILES_PER_THREAD = 64
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, root, threads=None, digests=None, include=None, exclude=None,
+               state_file=None):
+    """Default constructor. include and exclude are lists of glob patterns
+    matched against the paths relative to the root (for instance /usr/* or
+    *.pyc). Excluded directories are not walked. state_file activates the
+    incremental mode.
+    """
+
+    # Root of the tree, and settings of the inventory
+    self.root = root.rstrip("/")
+    self.digests = digests or []
+    self.include = include or ["*"]
+    self.exclude = exclude or []
+    self.state_file = state_file
+
+    # Number of threads walking and hashing, default is the number of CPU
+    if threads is None or threads <= 0:
+      threads = os.cpu_count()
+    self.threads = threads
+    self.file_hasher = FileHasher(threads=threads, memoize=False)
+
+    # Digests of the previous and current inventories, indexed by path. Values are lists
+    # [inode, size, modification time, digests]
+    self.previous_state = {}
+    self.current_state = {}
+
+    # Statistics of the last inventory
+    self.entry_count = 0
+    self.hashed_count = 0
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # scan
+  #
+  # -------------------------------------------------------------------------
+  def scan(self, callback):
+    """This method walks the tree, and calls callback with each record. The
+    callback is always called from the calling thread, thus it does not need
+    to be thread safe. Order of the records is not specified.
+    """
+
+    # Reset statistics and load the previous state if incremental mode is activated
+    self.entry_count = 0
+    self.hashed_count = 0
+    self.current_state = {}
+    self.load_state()
+
+    # Directories and files waiting for digests are queued, and submitted to the pool within
+    # the limit of pending tasks. Directories are not listed while too many files are waiting,
+    # thus the records are not accumulated when digests are slower than the walk
+    directory_futures = set()
+    file_futures = set()
+    waiting_directories = collections.deque(["/"])
+    waiting_files = collections.deque()
+    max_pending_files = self.threads * self.PENDING_FILES_PER_THREAD
+
+    with ThreadPoolExecutor(max_workers=self.threads) as executor:
+      while len(directory_futures) > 0 or len(file_futures) > 0 or \
+            len(waiting_directories) > 0 or len(waiting_files) > 0:
+        # Submit the files waiting for digests
+        while len(waiting_files) > 0 and len(file_futures) < max_pending_files:
+          file_futures.add(executor.submit(self.compute_digests, *waiting_files.popleft()))
+
+        # Submit the directories, if the files are not late
+        while len(waiting_directories) > 0 and len(directory_futures) < self.threads and \
+              len(waiting_files) < max_pending_files:
+          directory_futures.add(executor.submit(self.scan_directory,
+                                                waiting_directories.popleft()))
+
+        # Wait for at least one task
+        done = wait(directory_futures | file_futures, return_when=FIRST_COMPLETED)[0]
+
+        # A directory listing returns the entries and the sub directories to walk
+        for future in done & directory_futures:
+          directory_futures.remove(future)
+          entries, directories = future.result()
+          waiting_directories.extend(directories)
+          for record, identity in entries:
+            if identity is not None and len(self.digests) > 0 and \
+               not self.reuse_digests(record, identity):
+              waiting_files.append((record, identity))
+            else:
+              self.emit(record, identity, callback)
+
+        # A file task returns the record completed with the digests
+        for future in done & file_futures:
+          file_futures.remove(future)
+          self.hashed_count += 1
+          self.emit(*future.result(), callback=callback)
+
+    # Save the state for the next inventory
+    self.save_state()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # scan_directory
+  #
+  # -------------------------------------------------------------------------
+  def scan_directory(self, directory):
+    """This method lists a directory (path relative to the root). It returns
+    the (record, identity) of the included entries, and the list of the sub
+    directories which are not excluded. Directories which cannot be read
+    are considered as empty.
+    """
+
+    entries = []
+    directories = []
+    try:
+      with os.scandir(self.root + directory) as iterator:
+        for entry in iterator:
+          path = directory.rstrip("/") + "/" + entry.name
+
+          # Skip excluded entries, and do not walk excluded directories
+          if self.is_excluded(path):
+            continue
+          entry_stat = entry.stat(follow_symlinks=False)
+          if stat.S_ISDIR(entry_stat.st_mode):
+            directories.append(path)
+
+          # Build the record of included entries
+          if self.is_included(path):
+            entries.append(self.build_record(path, entry, entry_stat))
+    except OSError:
+      pass
+
+    return entries, directories
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # build_record
+  #
+  # -------------------------------------------------------------------------
+  def build_record(self, path, entry, entry_stat):
+    """This method builds the record of an entry from its stat. It returns
+    the record, and the identity of the content of regular files (inode,
+    size and modification time) or None.
+    """
+
+    record = {Key.PATH.value: path,
+              Key.TYPE.value: self.TYPES.get(stat.S_IFMT(entry_stat.st_mode), "unknown"),
+              Key.SIZE.value: entry_stat.st_size,
+              Key.MODE.value: "%04o" % stat.S_IMODE(entry_stat.st_mode),
+              Key.UID.value: entry_stat.st_uid,
+              Key.GID.value: entry_stat.st_gid,
+              Key.TARGET.value: "",
+              Key.HARDLINK_GROUP.value: ""}
+
+    # All the records have the same fields, digests are empty for entries other than files.
+    # Writers such as CSV build their header from the first record
+    for algorithm in self.digests:
+      record[algorithm] = ""
+
+    # Add the link target for symlinks
+    if stat.S_ISLNK(entry_stat.st_mode):
+      record[Key.TARGET.value] = os.readlink(entry.path)
+
+    # Files with several links share the same group, made of the inode number
+    elif stat.S_ISREG(entry_stat.st_mode) and entry_stat.st_nlink > 1:
+      record[Key.HARDLINK_GROUP.value] = str(entry_stat.st_ino)
+
+    # Identity of the file content, used by the incremental mode
+    identity = None
+    if stat.S_ISREG(entry_stat.st_mode):
+      identity = [entry_stat.st_ino, entry_stat.st_size, entry_stat.st_mtime_ns]
+
+    return record, identity
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # compute_digests
+  #
+  # -------------------------------------------------------------------------
+  def compute_digests(self, record, identity):
+    """This method adds the digests to the record of a file, and returns the
+    record and its identity. Files which cannot be read have empty digests.
+    """
+
+    try:
+      record.update(self.file_hasher.hash_file(self.root + record[Key.PATH.value],
+                                               self.digests))
+    except OSError:
+      for algorithm in self.digests:
+        record[algorithm] = ""
+    return record, identity
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # reuse_digests
+  #
+  # -------------------------------------------------------------------------
+  def reuse_digests(self, record, identity):
+    """This method fills the digests of a file from the previous state, if
+    the file did not change. It returns True if the digests were reused.
+    """
+
+    # Check the file is known, unchanged, and that all the digests are available
+    previous = self.previous_state.get(record[Key.PATH.value])
+    if previous is None or previous[:3] != identity:
+      return False
+    if any(algorithm not in previous[3] for algorithm in self.digests):
+      return False
+
+    # Copy the digests
+    for algorithm in self.digests:
+      record[algorithm] = previous[3][algorithm]
+    return True
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # emit
+  #
+  # -------------------------------------------------------------------------
+  def emit(self, record, identity, callback):
+    """This method records the state of a file, and gives the record to the
+    callback.
+    """
+
+    # Keep the identity and the digests for the next inventory
+    if identity is not None and self.state_file is not None and len(self.digests) > 0:
+      self.current_state[record[Key.PATH.value]] = \
+                        identity + [{algorithm: record[algorithm] for algorithm in self.digests}]
+
+    # Output the record
+    self.entry_count += 1
+    callback(record)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # is_included
+  #
+  # -------------------------------------------------------------------------
+  def is_included(self, path):
+    """Returns True if the path matches one of the include patterns
+    """
+
+    return any(fnmatch.fnmatch(path, pattern) for pattern in self.include)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # is_excluded
+  #
+  # -------------------------------------------------------------------------
+  def is_excluded(self, path):
+    """Returns True if the path matches one of the exclude patterns
+    """
+
+    return any(fnmatch.fnmatch(path, pattern) for pattern in self.exclude)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # load_state
+  #
+  # -------------------------------------------------------------------------
+  def load_state(self):
+    """This method loads the state of the previous inventory. A missing or
+    invalid state file is ignored, all the files are then hashed.
+    """
+
+    self.previous_state = {}
+    if self.state_file is None or not os.path.isfile(self.state_file):
+      return
+
+    try:
+      with open(self.state_file, "r") as state_file:
+        for line in state_file:
+          path, state = json.loads(line)
+          self.previous_state[path] = state
+    except (OSError, ValueError):
+      self.previous_state = {}
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # save_state
+  #
+  # -------------------------------------------------------------------------
+  def save_state(self):
+    """This method saves the state of the inventory, one file per line. It is
+    written to a temporary file then renamed.
+    """
+
+    if self.state_file is None:
+      return
+
+    os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+    with open(self.state_file + ".tmp", "w") as state_file:
+      for path, state in self.current_state.items():
+        state_file.write(json.dumps([path, state]) + "\n")
+    os.replace(self.state_file + ".tmp", self.state_file)
@@ -0,0 +1,170 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the computation of the checksums of the firmware
+files. Several digests and a list of block digests are computed in a single
+read of the file.
+"""
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# -----------------------------------------------------------------------------
+#
+#    Class FirmwareChecksums
+#
+# -----------------------------------------------------------------------------
+class FirmwareChecksums(object):
+  """This class computes the digests of a file for several algorithms, and
+  optionally the digest of each block of the file. Each algorithm runs in
+  its own thread (hashlib releases the GIL), while the next chunk of the
+  file is read.
+
+  Checksum files are written in the format of the <method>sum tools, thus
+  they can be checked on the device using sha256sum -c (b2sum -c for
+  blake2b).
+
+  The block list allows to check the file in chunks. Its first line
+  contains the algorithm, the block size and the file size, separated by
+  spaces. Then each line contains the digest of a block, in the order of the
+  file. The last block is hashed as is, without padding.
+  """
+
+  # Supported algorithms, which are the hashlib names
+  ALGORITHMS = ["md5", "sha1", "sha224", "sha256", "sha384", "sha512", "blake2b"]
+
+  # Size of the chunks read from the file. It is rounded to a multiple of the block size
+  READ_SIZE = 1024 * 1024
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, algorithms, block_size=0, block_algorithm="sha256"):
+    """Default constructor. Block digests are computed only if block_size is
+    greater than 0.
+    """
+
+    # Algorithms of the whole file digests, and of the block digests
+    self.algorithms = algorithms
+    self.block_size = block_size
+    self.block_algorithm = block_algorithm
+
+    # Results of the last computation
+    self.digests = {}
+    self.block_digests = []
+    self.file_size = 0
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # compute
+  #
+  # -------------------------------------------------------------------------
+  def compute(self, path):
+    """This method reads the file once, and returns the dictionnary of the
+    hex digests by algorithm. Block digests are stored in block_digests.
+    """
+
+    # Create one hasher per algorithm
+    hashers = [hashlib.new(algorithm) for algorithm in self.algorithms]
+    self.block_digests = []
+    self.file_size = 0
+
+    # Chunks contain a whole number of blocks
+    read_size = self.READ_SIZE
+    if self.block_size > 0:
+      read_size = max(1, read_size // self.block_size) * self.block_size
+
+    # Each chunk is hashed by all the tasks while the next one is read
+    with open(path, "rb") as source_file, \
+         ThreadPoolExecutor(max_workers=len(hashers) + 1) as executor:
+      futures = []
+      chunk = source_file.read(read_size)
+      while len(chunk) > 0:
+        futures = [executor.submit(hasher.update, chunk) for hasher in hashers]
+        if self.block_size > 0:
+          futures.append(executor.submit(self.hash_blocks, chunk))
+        self.file_size += len(chunk)
+
+        # Read the next chunk, then wait for the current one to be hashed
+        chunk = source_file.read(read_size)
+        for future in futures:
+          future.result()
+
+    # Return the digests
+    self.digests = {algorithm: hasher.hexdigest()
+                    for algorithm, hasher in zip(self.algorithms, hashers)}
+    return self.digests
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # hash_blocks
+  #
+  # -------------------------------------------------------------------------
+  def hash_blocks(self, chunk):
+    """This method appends the digests of the blocks of a chunk to the block
+    list. Chunks are given in the order of the file.
+    """
+
+    view = memoryview(chunk)
+    for offset in range(0, len(chunk), self.block_size):
+      block = view[offset:offset + self.block_size]
+      self.block_digests.append(hashlib.new(self.block_algorithm, block).hexdigest())
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # write_checksum_files
+  #
+  # -------------------------------------------------------------------------
+  def write_checksum_files(self, path):
+    """This method writes the checksum files of the last computation, named
+    after the file and the algorithm (for instance firmware.squashfs.sha256).
+    It returns the list of the files written.
+    """
+
+    checksum_files = []
+    for algorithm in self.algorithms:
+      with open(path + "." + algorithm, "w") as checksum_file:
+        checksum_file.write(self.digests[algorithm] + "  " + path + "\n")
+      checksum_files.append(path + "." + algorithm)
+    return checksum_files
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # write_block_list
+  #
+  # -------------------------------------------------------------------------
+  def write_block_list(self, block_list_path):
+    """This method writes the block digests of the last computation
+    """
+
+    with open(block_list_path, "w") as block_list:
+      block_list.write("%s %d %d\n" % (self.block_algorithm, self.block_size, self.file_size))
+      for digest in self.block_digests:
+        block_list.write(digest + "\n")
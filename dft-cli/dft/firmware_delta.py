@@ -0,0 +1,450 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the delta firmware updates. A delta is computed
+between the content of a previous firmware (the base) and the content of the
+new one (the target). Only the differences are shipped, with a manifest
+recording the digests of the base and target files, thus the device (or the
+host verifier) can check the base before applying the delta, and the result
+once reconstructed.
+"""
+
+import os
+import lzma
+import shutil
+import struct
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import yaml
+from dft.enumkey import Key
+from dft.file_hasher import FileHasher
+
+# -----------------------------------------------------------------------------
+#
+#    Class FirmwareDelta
+#
+# -----------------------------------------------------------------------------
+class FirmwareDelta(object):
+  """This class creates and applies deltas between two firmware content
+  directories. Two methods are available :
+  . zstd uses zstd --patch-from, the base file is used as a dictionary. It
+    handles data moved at any offset, as in squashfs files
+  . block is a block level delta computed in process. Target blocks found
+    anywhere in the base (at block aligned offsets) are copied, others are
+    stored compressed. It suits uncompressed images
+
+  Each file of the target is stored as unchanged, delta or full (when it is
+  new, or when the delta is not smaller than the file).
+  """
+
+  # Name of the manifest file, at the root of the delta directory, and its format version
+  MANIFEST_NAME = "delta-manifest.yml"
+  MANIFEST_VERSION = 1
+
+  # Directory containing the patches and the full files
+  PAYLOAD_DIRECTORY = "payload"
+
+  # Operations stored in the manifest
+  UNCHANGED = "unchanged"
+  DELTA = "delta"
+  FULL = "full"
+  SYMLINK = "symlink"
+
+  # Header of the block patches, and operations of the block patches
+  BLOCK_MAGIC = b"DFTBLKD1"
+  BLOCK_COPY = b"C"
+  BLOCK_DATA = b"D"
+
+  # Suffix of the patch files for each method
+  PATCH_SUFFIXES = {Key.ZSTD.value: ".zstpatch",
+                    Key.BLOCK.value: ".blkpatch"}
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, logger, method=None, block_size=65536, threads=None):
+    """Default constructor. Default method is zstd
+    """
+
+    # Logger used to output messages
+    self.logging = logger
+
+    # Delta method and block size used by the block method
+    if method is None:
+      method = Key.ZSTD.value
+    self.method = method
+    self.block_size = block_size
+
+    # Number of files processed at the same time, default is the number of CPU
+    if threads is None or threads <= 0:
+      threads = os.cpu_count()
+    self.threads = threads
+    self.file_hasher = FileHasher(threads=threads)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # create
+  #
+  # -------------------------------------------------------------------------
+  def create(self, base_directory, target_directory, delta_directory, base_name=""):
+    """This method computes the delta between the base and the target
+    directories, and stores the payload and the manifest into the delta
+    directory. base_name identifies the base in the manifest (usually the
+    previous firmware artifact). It returns the manifest.
+    """
+
+    # List the entries of both trees
+    base_entries = self.list_entries(base_directory)
+    target_entries = self.list_entries(target_directory)
+
+    # Process the files concurrently, each one is independent
+    def process(path):
+      return self.create_entry(path, base_directory, target_directory, delta_directory,
+                               path in base_entries)
+
+    with ThreadPoolExecutor(max_workers=self.threads) as executor:
+      entries = list(executor.map(process, sorted(target_entries)))
+
+    # Generate the manifest
+    manifest = {Key.VERSION.value: self.MANIFEST_VERSION,
+                Key.METHOD.value: self.method,
+                Key.BASE.value: base_name,
+                Key.FILES.value: entries,
+                Key.REMOVED.value: sorted(set(base_entries) - set(target_entries))}
+    with open(os.path.join(delta_directory, self.MANIFEST_NAME), "w") as manifest_file:
+      yaml.safe_dump(manifest, manifest_file, default_flow_style=False)
+
+    # Output the statistics
+    target_size = sum(entry.get(Key.SIZE.value, 0) for entry in entries)
+    delta_size = sum(entry.get(Key.PAYLOAD_SIZE.value, 0) for entry in entries)
+    self.logging.info("Delta payload is %d bytes for %d bytes of firmware (%.1f%%)" %
+                      (delta_size, target_size, 100.0 * delta_size / max(target_size, 1)))
+
+    return manifest
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # create_entry
+  #
+  # -------------------------------------------------------------------------
+  def create_entry(self, path, base_directory, target_directory, delta_directory, in_base):
+    """This method processes one entry of the target, and returns its
+    manifest entry. The payload (patch or full file) is written under the
+    payload directory.
+    """
+
+    target_file = os.path.join(target_directory, path)
+    base_file = os.path.join(base_directory, path)
+
+    # Symbolic links are stored in the manifest
+    if os.path.islink(target_file):
+      return {Key.PATH.value: path,
+              Key.OPERATION.value: self.SYMLINK,
+              Key.TARGET.value: os.readlink(target_file)}
+
+    # Compute the digests of the target and of the base
+    entry = {Key.PATH.value: path,
+             Key.SIZE.value: os.path.getsize(target_file),
+             Key.MODE.value: "%04o" % (os.stat(target_file).st_mode & 0o7777),
+             Key.TARGET_SHA256.value: self.sha256(target_file)}
+    if in_base and os.path.isfile(base_file) and not os.path.islink(base_file):
+      entry[Key.BASE_SHA256.value] = self.sha256(base_file)
+
+    # Unchanged files have no payload
+    if entry.get(Key.BASE_SHA256.value) == entry[Key.TARGET_SHA256.value]:
+      entry[Key.OPERATION.value] = self.UNCHANGED
+      return entry
+
+    # Try to compute the delta if the file exists in the base
+    payload = os.path.join(delta_directory, self.PAYLOAD_DIRECTORY, path)
+    os.makedirs(os.path.dirname(payload), exist_ok=True)
+    if Key.BASE_SHA256.value in entry:
+      patch = payload + self.PATCH_SUFFIXES[self.method]
+      if self.method == Key.ZSTD.value:
+        entry[Key.WINDOW_LOG.value] = self.create_zstd_patch(base_file, target_file, patch)
+      else:
+        self.create_block_patch(base_file, target_file, patch)
+
+      # Keep the delta only if it is smaller than the file
+      if os.path.getsize(patch) < entry[Key.SIZE.value]:
+        entry[Key.OPERATION.value] = self.DELTA
+        entry[Key.PAYLOAD.value] = os.path.relpath(patch, delta_directory)
+        entry[Key.PAYLOAD_SIZE.value] = os.path.getsize(patch)
+        return entry
+      os.remove(patch)
+      entry.pop(Key.WINDOW_LOG.value, None)
+
+    # Otherwise the whole file is shipped
+    shutil.copyfile(target_file, payload)
+    entry[Key.OPERATION.value] = self.FULL
+    entry[Key.PAYLOAD.value] = os.path.relpath(payload, delta_directory)
+    entry[Key.PAYLOAD_SIZE.value] = entry[Key.SIZE.value]
+    return entry
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # apply
+  #
+  # -------------------------------------------------------------------------
+  def apply(self, base_directory, delta_directory, output_directory):
+    """This method reconstructs the target from the base and the delta into
+    the output directory. The digest of each base file is checked before
+    applying the delta, and the digest of each reconstructed file is checked
+    against the manifest. It returns the list of the errors, empty if the
+    target has been reconstructed successfully.
+    """
+
+    # Load the manifest
+    with open(os.path.join(delta_directory, self.MANIFEST_NAME), "r") as manifest_file:
+      manifest = yaml.safe_load(manifest_file)
+    if manifest.get(Key.VERSION.value) != self.MANIFEST_VERSION:
+      return ["Unsupported delta manifest version " + str(manifest.get(Key.VERSION.value))]
+    method = manifest[Key.METHOD.value]
+
+    # Reconstruct the files concurrently, and gather the errors
+    def process(entry):
+      try:
+        return self.apply_entry(entry, method, base_directory, delta_directory,
+                                output_directory)
+      except (OSError, ValueError, lzma.LZMAError, subprocess.CalledProcessError) as exception:
+        return entry[Key.PATH.value] + " : " + str(exception)
+
+    with ThreadPoolExecutor(max_workers=self.threads) as executor:
+      results = list(executor.map(process, manifest[Key.FILES.value]))
+    return [result for result in results if result is not None]
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # apply_entry
+  #
+  # -------------------------------------------------------------------------
+  def apply_entry(self, entry, method, base_directory, delta_directory, output_directory):
+    """This method reconstructs one file. It returns an error message, or
+    None if the file is valid.
+    """
+
+    path = entry[Key.PATH.value]
+    base_file = os.path.join(base_directory, path)
+    output_file = os.path.join(output_directory, path)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    # Symbolic links are created from the manifest
+    if entry[Key.OPERATION.value] == self.SYMLINK:
+      os.symlink(entry[Key.TARGET.value], output_file)
+      return None
+
+    # Check the base before using it
+    if entry[Key.OPERATION.value] in [self.UNCHANGED, self.DELTA]:
+      if not os.path.isfile(base_file) or \
+         self.sha256(base_file) != entry[Key.BASE_SHA256.value]:
+        return path + " : base file is missing or does not match the manifest"
+
+    # Reconstruct the file
+    if entry[Key.OPERATION.value] == self.UNCHANGED:
+      shutil.copyfile(base_file, output_file)
+    elif entry[Key.OPERATION.value] == self.FULL:
+      shutil.copyfile(os.path.join(delta_directory, entry[Key.PAYLOAD.value]), output_file)
+    elif entry[Key.OPERATION.value] == self.DELTA:
+      patch = os.path.join(delta_directory, entry[Key.PAYLOAD.value])
+      if method == Key.ZSTD.value:
+        # Manifests without window log are decoded with a window covering both files
+        window_log = entry.get(Key.WINDOW_LOG.value)
+        if window_log is None:
+          window_log = self.get_window_log(max(os.path.getsize(base_file),
+                                               entry[Key.SIZE.value]))
+        self.apply_zstd_patch(base_file, patch, output_file, window_log)
+      else:
+        self.apply_block_patch(base_file, patch, output_file)
+    else:
+      return path + " : unknown operation " + entry[Key.OPERATION.value]
+
+    # Restore the mode and check the result
+    os.chmod(output_file, int(entry[Key.MODE.value], 8))
+    if self.sha256(output_file) != entry[Key.TARGET_SHA256.value]:
+      return path + " : reconstructed file does not match the manifest"
+    return None
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # create_zstd_patch
+  #
+  # -------------------------------------------------------------------------
+  def create_zstd_patch(self, base_file, target_file, patch):
+    """This method creates a patch using the base file as a zstd dictionary.
+    The long distance matching window has to cover the whole base, and the
+    whole target since zstd uses the target size as frame window. It returns
+    the window log, which has to be given to apply_zstd_patch (it is stored
+    in the manifest).
+    """
+
+    window_log = self.get_window_log(max(os.path.getsize(base_file),
+                                         os.path.getsize(target_file)))
+    command = ["zstd", "-q", "-f", "-19", "--long=" + str(window_log),
+               "--patch-from=" + base_file, target_file, "-o", patch]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return window_log
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # apply_zstd_patch
+  #
+  # -------------------------------------------------------------------------
+  def apply_zstd_patch(self, base_file, patch, output_file, window_log):
+    """This method applies a patch created by create_zstd_patch, with the
+    window log it returned
+    """
+
+    command = ["zstd", "-q", "-f", "-d", "--long=" + str(window_log),
+               "--patch-from=" + base_file, patch, "-o", output_file]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # create_block_patch
+  #
+  # -------------------------------------------------------------------------
+  def create_block_patch(self, base_file, target_file, patch):
+    """This method creates a block level patch. Blocks of the base are
+    indexed by digest, then each block of the target is either copied from
+    the base or stored. The patch is compressed with xz.
+    """
+
+    # Index the blocks of the base by digest. The first occurrence is kept
+    base_blocks = {}
+    with open(base_file, "rb") as base:
+      offset = 0
+      while True:
+        block = base.read(self.block_size)
+        if len(block) == 0:
+          break
+        base_blocks.setdefault(hashlib.sha256(block).digest(), offset)
+        offset += len(block)
+
+    # Generate the operations. Copies are checked against the base content since the index
+    # only stores the digests
+    with open(target_file, "rb") as target, open(base_file, "rb") as base, \
+         lzma.open(patch, "wb", preset=6) as output:
+      output.write(self.BLOCK_MAGIC + struct.pack("<I", self.block_size))
+      while True:
+        block = target.read(self.block_size)
+        if len(block) == 0:
+          break
+        offset = base_blocks.get(hashlib.sha256(block).digest())
+        if offset is not None and os.pread(base.fileno(), len(block), offset) == block:
+          output.write(self.BLOCK_COPY + struct.pack("<QI", offset, len(block)))
+        else:
+          output.write(self.BLOCK_DATA + struct.pack("<I", len(block)) + block)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # apply_block_patch
+  #
+  # -------------------------------------------------------------------------
+  def apply_block_patch(self, base_file, patch, output_file):
+    """This method applies a patch created by create_block_patch
+    """
+
+    with lzma.open(patch, "rb") as source, open(base_file, "rb") as base, \
+         open(output_file, "wb") as output:
+      # Check the header
+      if source.read(len(self.BLOCK_MAGIC)) != self.BLOCK_MAGIC:
+        raise ValueError("invalid block patch header")
+      source.read(4)
+
+      # Process the operations until the end of the patch
+      while True:
+        operation = source.read(1)
+        if len(operation) == 0:
+          break
+        if operation == self.BLOCK_COPY:
+          offset, length = struct.unpack("<QI", source.read(12))
+          output.write(os.pread(base.fileno(), length, offset))
+        elif operation == self.BLOCK_DATA:
+          length = struct.unpack("<I", source.read(4))[0]
+          output.write(source.read(length))
+        else:
+          raise ValueError("invalid block patch operation")
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # list_entries
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def list_entries(directory):
+    """This method returns the set of the files and symbolic links of a
+    tree, as paths relative to its root.
+    """
+
+    entries = set()
+    for root, dirnames, filenames in os.walk(directory):
+      for name in filenames + [name for name in dirnames
+                               if os.path.islink(os.path.join(root, name))]:
+        entries.add(os.path.relpath(os.path.join(root, name), directory))
+    return entries
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_window_log
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def get_window_log(size):
+    """This method returns the zstd window log needed to reference size bytes
+    (between 10 and 31).
+    """
+
+    return min(max(size.bit_length(), 10), 31)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # sha256
+  #
+  # -------------------------------------------------------------------------
+  def sha256(self, path):
+    """This method returns the sha256 hex digest of a file
+    """
+
+    return self.file_hasher.hash_file(path, [Key.SHA256.value])[Key.SHA256.value]
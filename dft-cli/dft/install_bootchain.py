@@ -96,6 +96,10 @@ class InstallBootChain(CliCommand):
       logging.error("The '" + Key.TARGETS.value + "' key is not defined in the project file")
       exit(1)
 
+    # All the commands have been executed, stop the chroot session and restore the APT sources
+    self.stop_chroot_session()
+    self.stop_package_cache()
+
     # Remove QEMU if it has been isntalled. It has to be done in the end
     # since some cleanup tasks could need QEMU
     if self.use_qemu_static:
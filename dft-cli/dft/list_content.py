@@ -22,11 +22,22 @@
 content. Information ca be output to different format such as csv, yaml, xml, or json.
 """
 
-import logging
+import io
 import os
+import sys
+import bz2
+import csv
+import gzip
+import json
+import hashlib
+import lzma
+import logging
 import tempfile
+import xml.sax.saxutils
+import yaml
 from dft.cli_command import CliCommand
 from dft.enumkey import Key
+from dft.file_inventory import FileInventory
 
 #
 #    Class ContentOutputWriter
@@ -34,27 +45,48 @@ from dft.enumkey import Key
 class ContentOutputWriter(object):
   """This class implements the writer in charge of doing real output to the
   target defined in the configuration file. It can eithertarget a stream
-  (stdout) or a file, using different format (csv yaml json xml).
+  (stdout) or a file, using different format (csv, yaml, json, json lines
+  or xml).
+
+  Items are written as soon as they are appended, thus memory usage does not
+  depend on the size of the report. Output can optionally be compressed.
   """
 
+  # Functions used to open the compressed output streams, and suffixes of the files
+  COMPRESSORS = {Key.GZIP.value: (gzip.open, ".gz"),
+                 Key.BZIP2.value: (bz2.open, ".bz2"),
+                 Key.XZ.value: (lzma.open, ".xz")}
+
+  # Supported output formats
+  FORMATS = [Key.CSV.value, Key.JSON.value, Key.JSONL.value, Key.YAML.value, Key.XML.value]
+
   # -------------------------------------------------------------------------
   #
   # __init__
   #
   # -------------------------------------------------------------------------
-  def __init__(self, configuration):
-    """Default constructor
+  def __init__(self, configuration, base_directory=None):
+    """Default constructor. Relative output paths are computed from the
+    base_directory (the content working dir of the project).
     """
 
     # Store the configuration dictionnary
     self.configuration = configuration
+    self.base_directory = base_directory
+
+    # Output stream, and the file and temporary file used when target is a file
+    self.output_stream = None
     self.output_file = None
+    self.output_filename = None
 
-    # Defines the object storing the items used for output. This variable is
-    # a list of dictionnaries. Each item in the list is a line to output. The
-    # item content is a dictionnaries. The keys are used when producing output
-    # to format such as XML, JSON or YAML
-    self.__output_buffer = list()
+    # Current kind of output (packages, files, etc.), format and compression
+    self.target = None
+    self.format = None
+    self.compression = None
+
+    # CSV writer, created with the fields of the first item, and count of items written
+    self.csv_writer = None
+    self.item_count = 0
 
   # -------------------------------------------------------------------------
   #
@@ -68,44 +100,69 @@ class ContentOutputWriter(object):
     etc. If configuration is valid, it opens the file or stream for output.
     """
 
+    # Retrieve the output configuration
+    output = self.configuration[Key.CONFIGURATION.value][Key.OUTPUT.value]
+
     # Control output configuration parameters
-    if self.configuration[Key.CONFIGURATION.value][Key.OUTPUT.value][Key.FORMAT.value] \
-                                                                           == Key.CSV.value:
-      logging.debug("Content information is output to CSV format")
-    elif self.configuration[Key.CONFIGURATION.value][Key.OUTPUT.value][Key.FORMAT.value] \
-                                                                           == Key.YAML.value:
-      logging.debug("Content information is output to YAML format")
-    elif self.configuration[Key.CONFIGURATION.value][Key.OUTPUT.value][Key.FORMAT.value] \
-                                                                           == Key.JSON.value:
-      logging.debug("Content information is output to JSON format")
-      logging.error("Format is not yet available")
+    if output[Key.FORMAT.value] not in self.FORMATS:
+      logging.error("Unknow output format " + output[Key.FORMAT.value])
       exit(1)
-    elif self.configuration[Key.CONFIGURATION.value][Key.OUTPUT.value][Key.FORMAT.value] \
-                                                                           == Key.XML.value:
-      logging.debug("Content information is output to XML format")
-      logging.error("Format is not yet available")
-      exit(1)
-    else:
-      logging.error("Unknow output format " +
-                    self.configuration[Key.CONFIGURATION.value][Key.OUTPUT.value][Key.FORMAT.value])
+    logging.debug("Content information is output to " + output[Key.FORMAT.value] + " format")
+
+    # Check the compression if defined
+    compression = output.get(Key.COMPRESSION.value)
+    if compression is not None and compression not in self.COMPRESSORS:
+      logging.error("Unknow output compression " + compression)
       exit(1)
 
+    # Reset the state of the writer
+    self.target = target
+    self.format = output[Key.FORMAT.value]
+    self.compression = compression
+    self.csv_writer = None
+    self.item_count = 0
+
     # Select and create the output
-    if self.configuration[Key.CONFIGURATION.value][Key.OUTPUT.value][Key.TARGET.value] \
-                                                                           == Key.FILE.value:
-      # Create a temporary file for output
-      self.output_file = tempfile.NamedTemporaryFile(mode='w+', delete=False)
-      logging.debug("Content information is output to a file")
-    elif self.configuration[Key.CONFIGURATION.value][Key.OUTPUT.value][Key.TARGET.value] \
-                                                                           == Key.STDOUT.value:
+    if output[Key.TARGET.value] == Key.FILE.value:
+      # Compute the path of the file : <prefix><content-type><suffix>.<format>
+      directory = output.get(Key.PATH.value) or ""
+      if not os.path.isabs(directory) and self.base_directory is not None:
+        directory = os.path.join(self.base_directory, directory)
+      self.output_filename = os.path.join(directory, output.get(Key.FILENAME_PREFIX.value, "") +
+                                          target + output.get(Key.FILENAME_SUFFIX.value, "") +
+                                          "." + self.format)
+      if compression is not None:
+        self.output_filename += self.COMPRESSORS[compression][1]
+
+      # Output is written to a temporary file in the same directory, moved in place once
+      # complete. Thus an interrupted generation does not leave a truncated report
+      os.makedirs(directory or ".", exist_ok=True)
+      self.output_file = tempfile.NamedTemporaryFile(mode='wb', dir=directory or ".",
+                                                     prefix=".dft-content-", delete=False)
+      raw_stream = self.output_file
+      logging.debug("Content information is output to the file " + self.output_filename)
+    elif output[Key.TARGET.value] == Key.STDOUT.value:
+      raw_stream = sys.stdout.buffer
       logging.debug("Content information is output to stdout")
-      logging.error("Output to stdout is not yet available")
-      exit(1)
     else:
-      logging.error("Unknow output TARGET " + self.configuration[Key.CONFIGURATION.value]\
-                                                       [Key.OUTPUT.value][Key.TARGET.value])
+      logging.error("Unknow output TARGET " + output[Key.TARGET.value])
       exit(1)
 
+    # Create the text stream, through the compressor if needed. Compressors and wrappers
+    # do not close the underlying stream, thus stdout stays open
+    if compression is not None:
+      self.output_stream = self.COMPRESSORS[compression][0](raw_stream, "wt",
+                                                            encoding=Key.UTF8.value,
+                                                            newline="")
+    else:
+      self.output_stream = io.TextIOWrapper(raw_stream, encoding=Key.UTF8.value, newline="")
+
+    # Output the header of the document
+    if self.format == Key.JSON.value:
+      self.output_stream.write("[")
+    elif self.format == Key.XML.value:
+      self.output_stream.write('<?xml version="1.0" encoding="UTF-8"?>\n<' + target + '>\n')
+
 
 
   # -------------------------------------------------------------------------
@@ -114,11 +171,46 @@ class ContentOutputWriter(object):
   #
   # -------------------------------------------------------------------------
   def append_item(self, item):
-    """Append an item to the output buffer. This method is provided to hide internals
+    """Writes an item to the output. Item is a dictionnary, its keys are used
+    as field names.
     """
 
-    # print(output)
-    self.__output_buffer.append(item)
+    # CSV header is generated from the fields of the first item
+    if self.format == Key.CSV.value:
+      if self.csv_writer is None:
+        separator = self.configuration[Key.CONFIGURATION.value][Key.OUTPUT.value]\
+                                                      .get(Key.FIELD_SEPARATOR.value, ";")
+        self.csv_writer = csv.DictWriter(self.output_stream, fieldnames=list(item.keys()),
+                                         delimiter=separator, restval="",
+                                         extrasaction="ignore")
+        self.csv_writer.writeheader()
+      self.csv_writer.writerow(item)
+
+    # JSON items are separated by commas
+    elif self.format == Key.JSON.value:
+      if self.item_count > 0:
+        self.output_stream.write(",")
+      self.output_stream.write("\n  " + json.dumps(item, ensure_ascii=False))
+
+    # JSON Lines is one document per line
+    elif self.format == Key.JSONL.value:
+      self.output_stream.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+    # YAML output is a sequence, each item is dumped as a sequence of one element
+    elif self.format == Key.YAML.value:
+      yaml.safe_dump([item], self.output_stream, default_flow_style=False,
+                     allow_unicode=True, sort_keys=False)
+
+    # XML items are elements, with one child element per field
+    elif self.format == Key.XML.value:
+      self.output_stream.write("  <item>\n")
+      for key, value in item.items():
+        self.output_stream.write("    <" + key + ">" + xml.sax.saxutils.escape(str(value)) +
+                                 "</" + key + ">\n")
+      self.output_stream.write("  </item>\n")
+
+    # Update the count of items written
+    self.item_count += 1
 
 
 
@@ -132,16 +224,39 @@ class ContentOutputWriter(object):
     files
     """
 
-    print(self.__output_buffer)
-
-    # Test if the output file has been opened
-    if self.output_file != None:
-      # Yes then close it
+    # Test if the output has been opened
+    if self.output_stream is None:
+      return
+
+    # Output the footer of the document. Empty YAML is an empty sequence
+    if self.format == Key.JSON.value:
+      self.output_stream.write("\n]\n")
+    elif self.format == Key.XML.value:
+      self.output_stream.write("</" + self.target + ">\n")
+    elif self.format == Key.YAML.value and self.item_count == 0:
+      self.output_stream.write("[]\n")
+
+    # Close the text stream (and the compressor, which does not close stdout). When output
+    # is uncompressed stdout, the stream is only detached to keep stdout open
+    if self.output_file is None:
+      if self.compression is None:
+        self.output_stream.detach()
+      else:
+        self.output_stream.close()
+      sys.stdout.buffer.flush()
+    else:
+      self.output_stream.close()
       self.output_file.close()
-      self.output_file = None
 
-    # Move the target file to the right place ?
-    # Depends on how we handle temp files
+      # Move the temporary file in place. Temporary files are only readable by the owner
+      os.chmod(self.output_file.name, 0o644)
+      os.replace(self.output_file.name, self.output_filename)
+      logging.info("Content information written to " + self.output_filename)
+
+    # Reset the streams
+    self.output_stream = None
+    self.output_file = None
+    self.output_filename = None
 
 
 
@@ -166,7 +281,8 @@ class ListContent(CliCommand):
     CliCommand.__init__(self, dft, project)
 
     # Create the output writer object
-    self.output_writer = ContentOutputWriter(self.project.list_content)
+    self.output_writer = ContentOutputWriter(self.project.list_content,
+                                             self.project.content_base_workdir)
 
 
 
@@ -261,6 +377,10 @@ class ListContent(CliCommand):
       else:
         logging.info("Anti-virus information generation is deactivated")
 
+    # All the commands have been executed, stop the chroot session and restore the APT sources
+    self.stop_chroot_session()
+    self.stop_package_cache()
+
     # Remove QEMU if it has been isntalled. It has to be done in the end
     # since some cleanup tasks could need QEMU
     if self.use_qemu_static:
@@ -275,31 +395,25 @@ class ListContent(CliCommand):
   # -------------------------------------------------------------------------
   def gen_packages_info(self):
     """This method implement the generation of information about packages.
-    It relies on calls to dpkg and apt-cache in the chrooted environment.
+    It reads the dpkg database of the rootfs and the APT lists, which are
+    parsed once for all the packages.
     """
 
     # Initialize the output writer for packages content generation
     self.output_writer.initialize(Key.PACKAGES.value)
 
-    # Generate the dpkg command to retrieve the list of installed packages
-    command = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-    command += " dpkg -l | tail -n +6"
-    command_output = self.execute_command(command)
+    # Retrieve the index of the dpkg database of the rootfs
+    dpkg_index = self.project.get_dpkg_status_index()
 
-    # Iterate the output of the dpkg process:
-    for binaryline in command_output.splitlines():
+    # Iterate the packages known by dpkg
+    for record in dpkg_index:
       # Each fields is stored into a variable to easy manipulation and
-      # simplify code. First get the array of words converted to UTF-8
-      line = binaryline.decode(Key.UTF8.value).split()
-
-      # Extract each fields
-      pkg_status = line[0]
-      pkg_name = line[1]
-      pkg_version = line[2]
-      pkg_arch = line[3]
-
-      # Space is used as a separator to rebuild the description
-      pkg_description = " ".join(line[4:])
+      # simplify code
+      pkg_status = dpkg_index.get_status_flags(record)
+      pkg_name = record["Package"]
+      pkg_version = record.get("Version", "")
+      pkg_arch = record.get("Architecture", "")
+      pkg_description = dpkg_index.get_short_description(record)
 
       # Initialize and empty dictionnaries. It is use to stores the key/value
       # pair used processed during output
@@ -330,45 +444,29 @@ class ListContent(CliCommand):
       # Test if we have to generate the package md5 in the output
       if Key.OUTPUT_PKG_MD5.value in self.project.list_content[Key.PACKAGES.value]:
         if self.project.list_content[Key.PACKAGES.value][Key.OUTPUT_PKG_MD5.value]:
-          # Generate the apt-cache show command to retrieve the MD5sum
-          # Grp the keyword and print second word
-          command = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-          command += " apt-cache show " + pkg_name + " | grep ^MD5sum | awk '{ print $2 }'"
-          command_output = self.execute_command(command)
-          output_item[Key.MD5.value] = command_output.decode(Key.UTF8.value)
+          # Retrieve the MD5sum from the archive metadata index
+          output_item[Key.MD5.value] = dpkg_index.get_metadata(record, "MD5sum") or ""
 
       # Test if we have to generate the package sha256 in the output
       if Key.OUTPUT_PKG_SHA256.value in self.project.list_content[Key.PACKAGES.value]:
         if self.project.list_content[Key.PACKAGES.value][Key.OUTPUT_PKG_SHA256.value]:
-          # Generate the apt-cache show command to retrieve the SHA256
-          # Grp the keyword and print second word
-          command = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-          command += " apt-cache show " + pkg_name + " | grep ^SHA256 | awk '{ print $2 }'"
-          command_output = self.execute_command(command)
-          output_item[Key.SHA256.value] = command_output.decode(Key.UTF8.value)
+          # Retrieve the SHA256 from the archive metadata index
+          output_item[Key.SHA256.value] = dpkg_index.get_metadata(record, "SHA256") or ""
 
       # Test if we have to generate the package size in the output
       if Key.OUTPUT_PKG_SIZE.value in self.project.list_content[Key.PACKAGES.value]:
         if self.project.list_content[Key.PACKAGES.value][Key.OUTPUT_PKG_SIZE.value]:
-          # Generate the apt-cache show command to retrieve the Size
-          # Grp the keyword and print second word
-          command = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-          command += " apt-cache show " + pkg_name + " | grep ^Size | awk '{ print $2 }'"
-          command_output = self.execute_command(command)
-          output_item[Key.SIZE.value] = command_output.decode(Key.UTF8.value)
+          # Retrieve the Size from the archive metadata index
+          output_item[Key.SIZE.value] = dpkg_index.get_metadata(record, "Size") or ""
 
       # Test if we have to generate the package installed-size in the output
       if Key.OUTPUT_PKG_INSTALLED_SIZE.value in \
                                           self.project.list_content[Key.PACKAGES.value]:
         if self.project.list_content[Key.PACKAGES.value]\
                                                [Key.OUTPUT_PKG_INSTALLED_SIZE.value]:
-          # Generate the apt-cache show command to retrieve the Installed-SizeMD5sum
-          # Grp the keyword and print second word
-          command = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-          command += " apt-cache show " + pkg_name
-          command += " | grep ^Installed-Size | awk '{ print $2 }'"
-          command_output = self.execute_command(command)
-          output_item[Key.INSTALLED_SIZE.value] = command_output.decode(Key.UTF8.value)
+          # Installed-Size is stored in the dpkg database
+          output_item[Key.INSTALLED_SIZE.value] = dpkg_index.get_metadata(record,
+                                                                          "Installed-Size") or ""
 
       # Test if we have to generate the package description in the output
       if Key.OUTPUT_PKG_DESCRIPTION.value in \
@@ -393,11 +491,41 @@ class ListContent(CliCommand):
   def gen_files_info(self):
     """This method implement the generation of information about files.
     Informationare extracted from the host information, not the chroot.
+
+    The rootfs is walked by a pool of threads, which also computes the
+    digests, and each entry is streamed to the output writer.
     """
 
-    # Initialize the output writer for packages content generation
+    # Retrieve the files configuration. Digests are not computed by default
+    configuration = self.project.list_content[Key.FILES.value]
+    digests = configuration.get(Key.DIGESTS.value) or []
+    for algorithm in digests:
+      if algorithm not in hashlib.algorithms_guaranteed:
+        logging.critical("Unknown digest algorithm " + algorithm)
+        exit(1)
+
+    # In incremental mode, digests of unchanged files are retrieved from the previous inventory
+    state_file = None
+    if configuration.get(Key.INCREMENTAL.value, False):
+      state_file = configuration.get(Key.STATE_FILE.value)
+      if state_file is None:
+        state_file = self.project.content_base_workdir + "/" + \
+                     self.project.get_target_name() + "-files.state"
+
+    # Initialize the output writer for files content generation
     self.output_writer.initialize(Key.FILES.value)
 
+    # Walk the rootfs and stream the entries to the output
+    inventory = FileInventory(self.project.get_rootfs_mountpoint(),
+                              threads=self.project.get_scan_concurrency(),
+                              digests=digests,
+                              include=configuration.get(Key.INCLUDE.value),
+                              exclude=configuration.get(Key.EXCLUDE.value),
+                              state_file=state_file)
+    inventory.scan(self.output_writer.append_item)
+    logging.info("Files inventory generated for %d entries (%d files hashed)" %
+                 (inventory.entry_count, inventory.hashed_count))
+
     # Flush all pending output and close stream or file
     self.output_writer.flush_and_close()
 
@@ -436,6 +564,9 @@ class ListContent(CliCommand):
 
     # Now generation platform is identfied, we can generation the coommands
     if use_host_av:
+      # Commands are executed on the host
+      run_antivirus = self.execute_command
+
       # Generate the version command
       antivirus_cmd_version = "LANG=C clamscan --version"
 
@@ -446,17 +577,17 @@ class ListContent(CliCommand):
       antivirus_cmd_scan = "LANG=C clamscan --infected --recursive "
       antivirus_cmd_scan += self.project.get_rootfs_mountpoint()
     else:
+      # Commands are executed in the chroot session
+      run_antivirus = self.execute_in_chroot
+
       # Generate the version command
-      antivirus_cmd_version = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-      antivirus_cmd_version += " clamscan --version"
+      antivirus_cmd_version = "clamscan --version"
 
       # Generate the update command
-      antivirus_cmd_update = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-      antivirus_cmd_update += " freshclam"
+      antivirus_cmd_update = "freshclam"
 
       # Generate the scan command
-      antivirus_cmd_scan = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-      antivirus_cmd_scan += " clamscan --infected --recursive /"
+      antivirus_cmd_scan = "clamscan --infected --recursive /"
 
     # Log the generated commands
     logging.debug("Antivirus version command : " + antivirus_cmd_version)
@@ -497,7 +628,7 @@ class ListContent(CliCommand):
     # for offline systems
     if self.project.list_content[Key.ANTIVIRUS.value][Key.UPDATE_DATABASE.value]:
       logging.debug("Starting to update Clamav database")
-      command_output = self.execute_command(antivirus_cmd_update)
+      command_output = run_antivirus(antivirus_cmd_update)
 
       # Parse the results and add lines to the output buffer
       for binaryline in command_output.splitlines():
@@ -515,12 +646,12 @@ class ListContent(CliCommand):
 
     # Generate the dpkg command to retrieve the list of installed packages
     logging.debug("Starting Clamav version command")
-    command_output = self.execute_command(antivirus_cmd_version)
+    command_output = run_antivirus(antivirus_cmd_version)
     output_item[Key.VERSION.value] = command_output.decode(Key.UTF8.value)
 
     # Generate the dpkg command to retrieve the list of installed packages
     logging.debug("Starting Clamav scan")
-    command_output = self.execute_command(antivirus_cmd_scan)
+    command_output = run_antivirus(antivirus_cmd_scan)
     output_item[Key.SCAN.value] = command_output.decode(Key.UTF8.value)
 
     # print(output)
@@ -564,9 +695,8 @@ class ListContent(CliCommand):
       need_to_remove_package = self.check_install_missing_package(Key.LYNIS.value)
 
     # Generate the debsecan execution command
-    command = "chroot " + self.project.get_rootfs_mountpoint()
-    command += " /usr/sbin/lynis audit system"
-    command_output = self.execute_command(command)
+    command = "/usr/sbin/lynis audit system"
+    command_output = self.execute_in_chroot(command)
     output_item[Key.LYNIS.value] = command_output.decode(Key.UTF8.value)
 
     # print(output)
@@ -613,9 +743,8 @@ class ListContent(CliCommand):
       need_to_remove_package = self.check_install_missing_package(Key.RKHUNTER.value)
 
     # Generate the debsecan execution command
-    command = "chroot " + self.project.get_rootfs_mountpoint()
-    command += " /usr/bin/rkhunter --check --skip-keypress"
-    command_output = self.execute_command(command)
+    command = "/usr/bin/rkhunter --check --skip-keypress"
+    command_output = self.execute_in_chroot(command)
     output_item[Key.RKHUNTER.value] = command_output.decode(Key.UTF8.value)
 
     # print(output)
@@ -659,9 +788,8 @@ class ListContent(CliCommand):
       need_to_remove_package = self.check_install_missing_package("debsecan")
 
     # Generate the debsecan execution command
-    command = "chroot " + self.project.get_rootfs_mountpoint()
-    command += " /usr/bin/debsecan"
-    command_output = self.execute_command(command)
+    command = "/usr/bin/debsecan"
+    command_output = self.execute_in_chroot(command)
     output_item["debsecan"] = command_output.decode(Key.UTF8.value)
 
     # Test if debsecan has to be removed
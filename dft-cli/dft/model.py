@@ -25,12 +25,14 @@ their content and definition fom yaml configuration file.
 """
 
 import os
+import copy
 import subprocess
 import logging
 from datetime import datetime
 import yaml
 from yaml.loader import SafeLoader
 from dft.enumkey import Key
+from dft.dpkg_status import DpkgStatusIndex
 
 # -----------------------------------------------------------------------------
 #
@@ -100,6 +102,13 @@ class Configuration(object):
     # Name of the sequence to run
     self.sequence_name = None
 
+    # Flag used to skip the steps of the sequence completed by a previous run
+    self.resume_sequence = False
+
+    # Flag set by the sequence when QEMU has been installed for concurrent steps. Commands
+    # neither install nor remove QEMU themselves when it is set
+    self.shared_qemu = False
+
   # ---------------------------------------------------------------------------
   #
   # load_configuration
@@ -231,6 +240,10 @@ class Project(object):
     self.use_debootstrap_cachedir = False
     self.debootstrap_cachedir = None
 
+    # Index of the dpkg database of each rootfs, indexed by rootfs path. Indexes are kept
+    # during the whole life of the project, and reloaded when outdated
+    self.dpkg_status_indexes = {}
+
     # Use a default APT  repository if not defined to retrieve BSP when chrooted
     # into image under generation
     self.activate_default_bsp_repository = False
@@ -314,6 +327,70 @@ class Project(object):
 
 
 
+  # ---------------------------------------------------------------------------
+  #
+  # get_target_count
+  #
+  # ---------------------------------------------------------------------------
+  def get_target_count(self):
+    """ Simple getter to retrieve the number of items in the targets to
+    produce list.
+    """
+
+    # Return the size of the list
+    return len(self.project[Key.PROJECT_DEFINITION.value][Key.TARGETS.value])
+
+
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_target_name
+  #
+  # ---------------------------------------------------------------------------
+  def get_target_name(self, index=0):
+    """ Simple getter to retrieve the name of the n-th item in the targets to
+    produce list. The name is made of board, arch and version, it is the name
+    of the target working directories.
+    """
+
+    # Name is the target directory component
+    return self.__get_target_directory(index)
+
+
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_target_project
+  #
+  # ---------------------------------------------------------------------------
+  def get_target_project(self, index):
+    """ This method returns a copy of the project whose targets list only
+    contains the n-th target. Since all the commands work on the first target,
+    this copy is used to run a command for any target. The command log file,
+    if defined, is suffixed by the target name.
+    """
+
+    # Copy the project object, and the definition since it is modified
+    target_project = copy.copy(self)
+    target_project.project = copy.deepcopy(self.project)
+
+    # Keep only the selected target
+    target_project.project[Key.PROJECT_DEFINITION.value][Key.TARGETS.value] = \
+                  [self.project[Key.PROJECT_DEFINITION.value][Key.TARGETS.value][index]]
+
+    # Each target has its own command log file, since targets may run concurrently
+    log_file = self.get_command_log_file()
+    if log_file is not None:
+      if target_project.project.get(Key.CONFIGURATION.value) is None:
+        target_project.project[Key.CONFIGURATION.value] = {}
+      target_project.project[Key.CONFIGURATION.value][Key.COMMAND_LOG_FILE.value] = \
+                  log_file + "." + self.get_target_name(index)
+
+    # Return the restricted project
+    return target_project
+
+
+
   # ---------------------------------------------------------------------------
   #
   # generate_def_file_path
@@ -397,6 +474,329 @@ class Project(object):
     # reading parameters from config files
     return path
 
+  # ---------------------------------------------------------------------------
+  #
+  # get_configuration_value
+  #
+  # ---------------------------------------------------------------------------
+  def get_configuration_value(self, key, default=None):
+    """ Simple getter to retrieve a value from the tool configuration section.
+    The value from the project configuration section overrides the value from
+    the tool configuration. If the key is defined nowhere, default is returned.
+    """
+
+    # Start with the default value, then override it with tool configuration
+    value = default
+    if self.dft.configuration is not None and \
+       Key.CONFIGURATION.value in self.dft.configuration and \
+       self.dft.configuration[Key.CONFIGURATION.value] is not None and \
+       key in self.dft.configuration[Key.CONFIGURATION.value]:
+      value = self.dft.configuration[Key.CONFIGURATION.value][key]
+
+    # And finally with project configuration if defined
+    if self.project is not None and Key.CONFIGURATION.value in self.project and \
+       self.project[Key.CONFIGURATION.value] is not None and \
+       key in self.project[Key.CONFIGURATION.value]:
+      value = self.project[Key.CONFIGURATION.value][key]
+
+    # Return what has been found
+    return value
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_command_log_file
+  #
+  # ---------------------------------------------------------------------------
+  def get_command_log_file(self):
+    """ Simple getter to retrieve the path to the file receiving the output of
+    all the executed commands. It returns None if the log file is not defined.
+    """
+
+    # Retrieve the path from the configuration and expand it
+    path = self.get_configuration_value(Key.COMMAND_LOG_FILE.value)
+    if path is not None:
+      path = os.path.expanduser(path)
+
+    # Return the path, or None if undefined
+    return path
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_command_log_tail_size
+  #
+  # ---------------------------------------------------------------------------
+  def get_command_log_tail_size(self):
+    """ Simple getter to retrieve the number of output lines kept in memory to
+    report command errors. It returns None if not defined, meaning the runner
+    default value is used.
+    """
+
+    # Retrieve the value from the configuration
+    size = self.get_configuration_value(Key.COMMAND_LOG_TAIL_SIZE.value)
+
+    # Check it is a valid number
+    if size is not None:
+      try:
+        size = int(size)
+      except ValueError:
+        self.logging.critical("command_log_tail_size is not a number : " + str(size))
+        exit(1)
+
+    # Return the value to the caller
+    return size
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_use_rootfs_cache
+  #
+  # ---------------------------------------------------------------------------
+  def get_use_rootfs_cache(self):
+    """ Simple getter to retrieve if the rootfs stage cache is activated or not.
+    Default is deactivated.
+    """
+
+    # Return the boolean flag
+    return bool(self.get_configuration_value(Key.ACTIVATE_ROOTFS_CACHE.value, False))
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_rootfs_cachedir
+  #
+  # ---------------------------------------------------------------------------
+  def get_rootfs_cachedir(self):
+    """ Simple getter to retrieve the directory storing the rootfs stages
+    snapshots. It defaults to a directory under the project working dir.
+    """
+
+    # Retrieve the path from the configuration and expand it
+    path = self.get_configuration_value(Key.ROOTFS_CACHEDIR.value)
+    if path is None:
+      path = self.project_base_workdir + "/rootfs-cache"
+
+    # Return the expanded path
+    return os.path.expanduser(path)
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_use_package_cache
+  #
+  # ---------------------------------------------------------------------------
+  def get_use_package_cache(self):
+    """ Simple getter to retrieve if the local package cache is activated or
+    not. Default is deactivated.
+    """
+
+    # Return the boolean flag
+    return bool(self.get_configuration_value(Key.ACTIVATE_PACKAGE_CACHE.value, False))
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_package_cachedir
+  #
+  # ---------------------------------------------------------------------------
+  def get_package_cachedir(self):
+    """ Simple getter to retrieve the directory storing the packages and
+    indexes downloaded through the package cache. It defaults to a directory
+    under the project working dir.
+    """
+
+    # Retrieve the path from the configuration and expand it
+    path = self.get_configuration_value(Key.PACKAGE_CACHEDIR.value)
+    if path is None:
+      path = self.project_base_workdir + "/package-cache"
+
+    # Return the expanded path
+    return os.path.expanduser(path)
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_use_debootstrap_snapshot
+  #
+  # ---------------------------------------------------------------------------
+  def get_use_debootstrap_snapshot(self):
+    """ Simple getter to retrieve if the debootstrap snapshots are activated or
+    not. Default is deactivated.
+    """
+
+    # Return the boolean flag
+    return bool(self.get_configuration_value(Key.ACTIVATE_DEBOOTSTRAP_SNAPSHOT.value, False))
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_debootstrap_snapshot_dir
+  #
+  # ---------------------------------------------------------------------------
+  def get_debootstrap_snapshot_dir(self):
+    """ Simple getter to retrieve the directory storing the debootstrap
+    snapshots. It defaults to a directory under the project working dir.
+    """
+
+    # Retrieve the path from the configuration and expand it
+    path = self.get_configuration_value(Key.DEBOOTSTRAP_SNAPSHOT_DIR.value)
+    if path is None:
+      path = self.project_base_workdir + "/debootstrap-snapshots"
+
+    # Return the expanded path
+    return os.path.expanduser(path)
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_debootstrap_snapshot_max_size
+  #
+  # ---------------------------------------------------------------------------
+  def get_debootstrap_snapshot_max_size(self):
+    """ Simple getter to retrieve the maximum size of the debootstrap snapshots
+    storage, in MB. It returns None if there is no limit.
+    """
+
+    # Retrieve the value from the configuration and check it is a number
+    return self.__get_numeric_configuration_value(Key.DEBOOTSTRAP_SNAPSHOT_MAX_SIZE.value)
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_debootstrap_snapshot_max_age
+  #
+  # ---------------------------------------------------------------------------
+  def get_debootstrap_snapshot_max_age(self):
+    """ Simple getter to retrieve the maximum number of days a debootstrap
+    snapshot is kept without being used. It returns None if there is no limit.
+    """
+
+    # Retrieve the value from the configuration and check it is a number
+    return self.__get_numeric_configuration_value(Key.DEBOOTSTRAP_SNAPSHOT_MAX_AGE.value)
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_target_concurrency
+  #
+  # ---------------------------------------------------------------------------
+  def get_target_concurrency(self):
+    """ Simple getter to retrieve the maximum number of targets processed at
+    the same time when running a command for all targets. It defaults to the
+    number of CPU of the host.
+    """
+
+    # Retrieve the value from the configuration and check it is a number
+    concurrency = self.__get_numeric_configuration_value(Key.TARGET_CONCURRENCY.value)
+    if concurrency is None:
+      concurrency = os.cpu_count()
+
+    # Return the value to the caller
+    return concurrency
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_step_concurrency
+  #
+  # ---------------------------------------------------------------------------
+  def get_step_concurrency(self):
+    """ Simple getter to retrieve the maximum number of steps of a sequence
+    running at the same time. It defaults to the number of CPU of the host.
+    """
+
+    # Retrieve the value from the configuration and check it is a number
+    concurrency = self.__get_numeric_configuration_value(Key.STEP_CONCURRENCY.value)
+    if concurrency is None:
+      concurrency = os.cpu_count()
+
+    # Return the value to the caller
+    return concurrency
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_partition_concurrency
+  #
+  # ---------------------------------------------------------------------------
+  def get_partition_concurrency(self):
+    """ Simple getter to retrieve the maximum number of partitions formatted,
+    labeled or checked at the same time. It defaults to the number of CPU of
+    the host.
+    """
+
+    # Retrieve the value from the configuration and check it is a number
+    concurrency = self.__get_numeric_configuration_value(Key.PARTITION_CONCURRENCY.value)
+    if concurrency is None:
+      concurrency = os.cpu_count()
+
+    # Return the value to the caller
+    return concurrency
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_copy_concurrency
+  #
+  # ---------------------------------------------------------------------------
+  def get_copy_concurrency(self):
+    """ Simple getter to retrieve the number of threads copying files when
+    a tree is copied (rootfs into the image, bootchain, toolkit). It
+    defaults to the number of CPU of the host.
+    """
+
+    # Retrieve the value from the configuration and check it is a number
+    concurrency = self.__get_numeric_configuration_value(Key.COPY_CONCURRENCY.value)
+    if concurrency is None:
+      concurrency = os.cpu_count()
+
+    # Return the value to the caller
+    return concurrency
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_scan_concurrency
+  #
+  # ---------------------------------------------------------------------------
+  def get_scan_concurrency(self):
+    """ Simple getter to retrieve the number of threads walking the rootfs
+    and computing digests when the files inventory is generated. It
+    defaults to the number of CPU of the host.
+    """
+
+    # Retrieve the value from the configuration and check it is a number
+    concurrency = self.__get_numeric_configuration_value(Key.SCAN_CONCURRENCY.value)
+    if concurrency is None:
+      concurrency = os.cpu_count()
+
+    # Return the value to the caller
+    return concurrency
+
+  # ---------------------------------------------------------------------------
+  #
+  # get_sequence_state_file
+  #
+  # ---------------------------------------------------------------------------
+  def get_sequence_state_file(self, sequence_name):
+    """ This method compute and return the path to the file storing the
+    completed steps of a sequence, for the current target.
+    """
+
+    # File is stored under the project working dir, named after target and sequence
+    return self.project_base_workdir + "/sequences/" + self.get_target_name() + "-" + \
+           sequence_name + ".yml"
+
+  # ---------------------------------------------------------------------------
+  #
+  # __get_numeric_configuration_value
+  #
+  # ---------------------------------------------------------------------------
+  def __get_numeric_configuration_value(self, key):
+    """ This method retrieves a configuration value which has to be an integer.
+    It returns None if the value is not defined, and exits if it is invalid.
+    """
+
+    # Retrieve the value from the configuration
+    value = self.get_configuration_value(key)
+
+    # Check it is a valid number
+    if value is not None:
+      try:
+        value = int(value)
+      except ValueError:
+        self.logging.critical(key + " is not a number : " + str(value))
+        exit(1)
+
+    # Return the value to the caller
+    return value
+
   # ---------------------------------------------------------------------------
   #
   # load_definition
@@ -706,6 +1106,32 @@ class Project(object):
     return self.rootfs_base_workdir + "/" +  self.__get_target_directory(0)
 
 
+  # ---------------------------------------------------------------------------
+  #
+  # get_dpkg_status_index
+  #
+  # ---------------------------------------------------------------------------
+  def get_dpkg_status_index(self, rootfs=None):
+    """ This method returns the index of the packages known by dpkg in the
+    rootfs (default is the rootfs mountpoint). The index is loaded once, and
+    loaded again only if the dpkg status file has been modified.
+    """
+
+    # Default is the rootfs of the current target
+    if rootfs is None:
+      rootfs = self.get_rootfs_mountpoint()
+
+    # Load the index if it is not yet known or outdated
+    index = self.dpkg_status_indexes.get(rootfs)
+    if index is None or index.is_outdated():
+      index = DpkgStatusIndex(rootfs)
+      index.load()
+      self.dpkg_status_indexes[rootfs] = index
+
+    # Return the index to the caller
+    return index
+
+
   # ---------------------------------------------------------------------------
   #
   # get_image_directory
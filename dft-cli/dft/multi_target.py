@@ -0,0 +1,162 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the execution of a DFT command for all the targets
+defined in the project. Each target is processed in its own process, using a
+copy of the project restricted to this target. Thus the commands, which all
+work on the first target of the project, do not need any modification.
+"""
+
+import time
+import logging
+import multiprocessing
+from dft.ansi_colors import Colors
+from dft.cli_command import Code
+
+# -----------------------------------------------------------------------------
+#
+#    Class MultiTargetRunner
+#
+# -----------------------------------------------------------------------------
+class MultiTargetRunner(object):
+  """This class runs a function for each target of the project, in a pool of
+  processes whose size is the concurrency limit. The function receives the
+  project restricted to the target. Once all the targets are done, a report
+  is displayed.
+
+  Processes are forked, thus the function can be any callable, including a
+  bound method.
+  """
+
+  # Interval between two checks of the running processes (in seconds)
+  POLL_INTERVAL = 0.5
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, project, concurrency=None):
+    """Default constructor
+    """
+
+    # Object storing the project definition
+    self.project = project
+
+    # Maximum number of targets processed at the same time
+    if concurrency is None:
+      concurrency = project.get_target_concurrency()
+    self.concurrency = max(1, concurrency)
+
+    # Result of each target. List of tuples (target name, exit code, elapsed time)
+    self.results = []
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # run
+  #
+  # -------------------------------------------------------------------------
+  def run(self, function):
+    """This method runs the function for each target, and waits for all the
+    targets to be done. It returns True if all targets succeeded.
+    """
+
+    # Processes are forked to inherit the whole state of the parent (configuration, logger)
+    context = multiprocessing.get_context("fork")
+
+    # List of targets waiting to be started, and dictionnary of running processes
+    pending = list(range(self.project.get_target_count()))
+    running = {}
+
+    self.project.logging.info("running " + str(len(pending)) + " targets, " +
+                              str(self.concurrency) + " at a time")
+
+    # Loop until all targets are done
+    while len(pending) > 0 or len(running) > 0:
+      # Start new processes while the limit is not reached
+      while len(pending) > 0 and len(running) < self.concurrency:
+        index = pending.pop(0)
+        name = self.project.get_target_name(index)
+        process = context.Process(target=self.__run_target, args=(function, index), name=name)
+        process.start()
+        running[process] = (name, time.time())
+        self.project.logging.info("target " + name + " started")
+
+      # Then check the running processes
+      for process in list(running):
+        if process.is_alive():
+          continue
+        process.join()
+        name, start_time = running.pop(process)
+        self.results.append((name, process.exitcode, time.time() - start_time))
+        self.project.logging.info("target " + name + " completed with code " +
+                                  str(process.exitcode))
+
+      # Wait a bit before next check
+      if len(running) > 0:
+        time.sleep(self.POLL_INTERVAL)
+
+    # Output the report and return the global status
+    self.display_report()
+    return all(exitcode == 0 for _, exitcode, _ in self.results)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # display_report
+  #
+  # -------------------------------------------------------------------------
+  def display_report(self):
+    """This method displays the result of each target.
+    """
+
+    print("")
+    print("Targets report :")
+    for name, exitcode, elapsed in self.results:
+      if exitcode == 0:
+        code = Colors.FG_GREEN.value + Colors.BOLD.value + Code.SUCCESS.value
+      else:
+        code = Colors.FG_RED.value + Colors.BOLD.value + Code.FAILURE.value
+      print("[" + code + Colors.RESET.value + "] " + name +
+            " (%.2f seconds, exit code %s)" % (elapsed, str(exitcode)))
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __run_target
+  #
+  # -------------------------------------------------------------------------
+  def __run_target(self, function, index):
+    """This method is the entry point of the processes. It restricts the
+    project to the target, prefixes the logs with the target name, and runs
+    the function.
+    """
+
+    # Prefix the log messages with the target name, since all outputs are mixed
+    name = self.project.get_target_name(index)
+    for handler in logging.getLogger().handlers:
+      handler.setFormatter(logging.Formatter("%(levelname)s:" + name + ":%(message)s"))
+
+    # Then run the function on the restricted project
+    function(self.project.get_target_project(index))
@@ -0,0 +1,467 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the local package cache used during builds. It is
+made of a content addressed store on the host, and of a small HTTP server
+used by APT (in the chrooted environment) and debootstrap (on the host) to
+download packages and indexes through the store.
+
+Repository urls are rewritten to point to the local server. The original
+scheme and host are kept in the path, thus the rewriting can be reverted
+once the build is done, and the rootfs does not keep any reference to the
+local server.
+"""
+
+import os
+import re
+import hashlib
+import tempfile
+import threading
+import shutil
+import urllib.request
+import urllib.error
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from dft.enumkey import Key
+
+# -----------------------------------------------------------------------------
+#
+#    Class PackageStore
+#
+# -----------------------------------------------------------------------------
+class PackageStore(object):
+  """This class implements the content addressed store. Files are stored
+  under objects/ and named after the sha256 of their content. The url of
+  each downloaded file is mapped to its content digest by a small file
+  stored under urls/.
+
+  All the files are written to temporary files then renamed. Thus several
+  builds running on the same host can share the store safely.
+  """
+
+  # Size of the chunks used when downloading and hashing files
+  BLOCK_SIZE = 65536
+
+  # Pattern matching the files which never change once published (packages, sources
+  # and indexes retrieved by hash). Other files (Release, InRelease, indexes retrieved
+  # by name) are revalidated on each download
+  IMMUTABLE_PATTERN = re.compile(r"(/pool/|/by-hash/|\.u?deb$|\.dsc$|\.tar\.[a-z0-9]+$)")
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, logger, store_dir):
+    """Default constructor
+    """
+
+    # Logger used to output messages
+    self.logging = logger
+
+    # Path to the root of the store, and to its sub directories
+    self.store_dir = store_dir
+    self.objects_dir = os.path.join(store_dir, "objects")
+    self.urls_dir = os.path.join(store_dir, "urls")
+
+    # Ensure the directories exist
+    os.makedirs(self.objects_dir, exist_ok=True)
+    os.makedirs(self.urls_dir, exist_ok=True)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # lookup
+  #
+  # -------------------------------------------------------------------------
+  def lookup(self, url):
+    """This method returns the path to the object stored for the given url,
+    or None if the url has never been downloaded.
+    """
+
+    # Read the digest of the content mapped to this url
+    url_path = self.__get_url_path(url)
+    if not os.path.isfile(url_path):
+      return None
+    with open(url_path, "r") as working_file:
+      digest = working_file.read().strip()
+
+    # Check the object still exist (it may have been removed by hand)
+    object_path = self.__get_object_path(digest)
+    if not os.path.isfile(object_path):
+      return None
+    return object_path
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # fetch
+  #
+  # -------------------------------------------------------------------------
+  def fetch(self, url):
+    """This method returns the path to the object containing the content of
+    the url. Immutable files are downloaded only once. Other files are
+    downloaded each time, but the stored copy is used if the upstream server
+    cannot be reached.
+
+    urllib.error.HTTPError is raised if upstream server returns an error and
+    there is no stored copy.
+    """
+
+    # Serve immutable files from the store if they are available
+    object_path = self.lookup(url)
+    if object_path is not None and self.IMMUTABLE_PATTERN.search(url):
+      self.logging.debug("package cache hit : " + url)
+      return object_path
+
+    # Download the file. Fallback to the stored copy if server is not reachable
+    try:
+      return self.__download(url)
+    except urllib.error.HTTPError:
+      raise
+    except (urllib.error.URLError, OSError) as exception:
+      if object_path is None:
+        raise
+      self.logging.warning("cannot reach " + url + " (" + str(exception) +
+                           "), using the stored copy")
+      return object_path
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __download
+  #
+  # -------------------------------------------------------------------------
+  def __download(self, url):
+    """This method downloads the url into the store, and returns the path to
+    the stored object.
+    """
+
+    self.logging.debug("package cache miss : " + url)
+
+    # Download to a temporary file in the store (same filesystem, thus rename is atomic)
+    # while computing the digest
+    hasher = hashlib.sha256()
+    temp_fd, temp_path = tempfile.mkstemp(dir=self.objects_dir, prefix=".download-")
+    try:
+      with urllib.request.urlopen(url) as response, os.fdopen(temp_fd, "wb") as working_file:
+        for block in iter(lambda: response.read(self.BLOCK_SIZE), b""):
+          hasher.update(block)
+          working_file.write(block)
+
+      # Move the content to its final location. If the object already exist, it is the same
+      # content, thus replacing it is harmless
+      digest = hasher.hexdigest()
+      object_path = self.__get_object_path(digest)
+      os.makedirs(os.path.dirname(object_path), exist_ok=True)
+      os.rename(temp_path, object_path)
+    finally:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    # Then map the url to the content
+    url_path = self.__get_url_path(url)
+    temp_fd, temp_path = tempfile.mkstemp(dir=self.urls_dir, prefix=".url-")
+    with os.fdopen(temp_fd, "w") as working_file:
+      working_file.write(digest + "\n")
+    os.rename(temp_path, url_path)
+
+    # Return the path to the object
+    return object_path
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __get_object_path
+  #
+  # -------------------------------------------------------------------------
+  def __get_object_path(self, digest):
+    """This method returns the path to the object of the given digest. Objects
+    are spread into sub directories named after the two first chars.
+    """
+
+    # Path is made of objects dir, prefix and digest
+    return os.path.join(self.objects_dir, digest[:2], digest)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __get_url_path
+  #
+  # -------------------------------------------------------------------------
+  def __get_url_path(self, url):
+    """This method returns the path to the file mapping an url to an object.
+    """
+
+    # File is named after the digest of the url
+    return os.path.join(self.urls_dir, hashlib.sha256(url.encode(Key.UTF8.value)).hexdigest())
+
+
+
+# -----------------------------------------------------------------------------
+#
+#    Class PackageCacheHandler
+#
+# -----------------------------------------------------------------------------
+class PackageCacheHandler(BaseHTTPRequestHandler):
+  """This class handles the requests sent to the package cache server. The
+  requested path is /<scheme>/<host>/<path>, it is converted back to the
+  upstream url and served from the store.
+  """
+
+  # -------------------------------------------------------------------------
+  #
+  # do_GET
+  #
+  # -------------------------------------------------------------------------
+  def do_GET(self):
+    """This method handles GET requests.
+    """
+
+    # Rebuild the upstream url from the path
+    match = re.match(r"^/(https?)/(.+)$", self.path)
+    if match is None:
+      self.send_error(404)
+      return
+    url = match.group(1) + "://" + match.group(2)
+
+    # Retrieve the content through the store
+    try:
+      object_path = self.server.store.fetch(url)
+    except urllib.error.HTTPError as exception:
+      self.send_error(exception.code)
+      return
+    except (urllib.error.URLError, OSError) as exception:
+      self.server.store.logging.debug("package cache cannot retrieve " + url + " : " +
+                                      str(exception))
+      self.send_error(502)
+      return
+
+    # And send it
+    self.send_response(200)
+    self.send_header("Content-Length", str(os.path.getsize(object_path)))
+    self.end_headers()
+    with open(object_path, "rb") as working_file:
+      shutil.copyfileobj(working_file, self.wfile)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # log_message
+  #
+  # -------------------------------------------------------------------------
+  def log_message(self, format, *args):
+    """This method sends the server logs to the DFT logger instead of stderr.
+    """
+
+    # pylint: disable=redefined-builtin
+    self.server.store.logging.debug("package cache : " + (format % args))
+
+
+
+# -----------------------------------------------------------------------------
+#
+#    Class PackageCacheProxy
+#
+# -----------------------------------------------------------------------------
+class PackageCacheProxy(object):
+  """This class implements the HTTP server giving access to the store. It
+  listens on the loopback interface, on a port chosen by the system, thus
+  several builds can run their own server on the same host. The chrooted
+  environment shares the network of the host, thus APT can reach it.
+  """
+
+  # Address the server is listening on
+  LISTEN_ADDRESS = "127.0.0.1"
+
+  # Pattern matching the urls rewritten to the server, whatever the port is
+  REWRITTEN_URL_PATTERN = re.compile(r"http://127\.0\.0\.1:[0-9]+/(https?)/")
+
+  # Pattern matching the lines of APT sources files containing urls
+  SOURCES_LINE_PATTERN = re.compile(r"^\s*(deb|deb-src|URIs:)\s")
+
+  # Pattern matching the prefix of lists files downloaded through the server
+  LISTS_PREFIX_PATTERN = re.compile(r"^127\.0\.0\.1:[0-9]+_(https?)_")
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, logger, store_dir):
+    """Default constructor
+    """
+
+    # Logger used to output messages
+    self.logging = logger
+
+    # Store used to keep downloaded files
+    self.store = PackageStore(logger, store_dir)
+
+    # Server and the thread running it. None until started
+    self.server = None
+    self.thread = None
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # start
+  #
+  # -------------------------------------------------------------------------
+  def start(self):
+    """This method starts the server in a background thread.
+    """
+
+    # Port 0 means the system chooses a free port
+    self.server = ThreadingHTTPServer((self.LISTEN_ADDRESS, 0), PackageCacheHandler)
+    self.server.daemon_threads = True
+    self.server.store = self.store
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+    self.logging.info("package cache is listening on " + self.get_url_prefix())
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # stop
+  #
+  # -------------------------------------------------------------------------
+  def stop(self):
+    """This method stops the server.
+    """
+
+    # Nothing to do if server is not running
+    if self.server is None:
+      return
+
+    # Stop serving and release the socket
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+    self.server = None
+    self.thread = None
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_url_prefix
+  #
+  # -------------------------------------------------------------------------
+  def get_url_prefix(self):
+    """This method returns the url of the server.
+    """
+
+    # Url is made of address and port chosen by the system
+    return "http://" + self.LISTEN_ADDRESS + ":" + str(self.server.server_address[1]) + "/"
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # redirect_url
+  #
+  # -------------------------------------------------------------------------
+  def redirect_url(self, url):
+    """This method rewrites an upstream url to be downloaded through the
+    server. Urls using other schemes than http and https are not modified.
+    """
+
+    # Remove a previous rewriting, then rewrite
+    url = self.restore_url(url)
+    return re.sub(r"^(https?)://", self.get_url_prefix() + r"\1/", url)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # redirect_sources
+  #
+  # -------------------------------------------------------------------------
+  def redirect_sources(self, content):
+    """This method rewrites all the urls of an APT sources file content to be
+    downloaded through the server.
+    """
+
+    # Process only the lines defining repositories. Previous rewriting (from another
+    # build with another port) are removed first
+    lines = []
+    for line in self.restore_sources(content).split("\n"):
+      if self.SOURCES_LINE_PATTERN.match(line):
+        line = re.sub(r"(?<=\s)(https?)://", self.get_url_prefix() + r"\1/", line)
+      lines.append(line)
+    return "\n".join(lines)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # restore_url
+  #
+  # -------------------------------------------------------------------------
+  @classmethod
+  def restore_url(cls, url):
+    """This method reverts the rewriting of an url.
+    """
+
+    # Replace the server prefix by the original scheme
+    return cls.REWRITTEN_URL_PATTERN.sub(r"\1://", url)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # restore_sources
+  #
+  # -------------------------------------------------------------------------
+  @classmethod
+  def restore_sources(cls, content):
+    """This method reverts the rewriting of an APT sources file content.
+    """
+
+    # Urls can be replaced everywhere, the pattern cannot match anything else
+    return cls.REWRITTEN_URL_PATTERN.sub(r"\1://", content)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # restore_lists_filename
+  #
+  # -------------------------------------------------------------------------
+  @classmethod
+  def restore_lists_filename(cls, filename):
+    """This method returns the name APT would have given to a lists file if
+    it had been downloaded from upstream server. It returns None if the file
+    has not been downloaded through the server.
+    """
+
+    # Remove the server part of the name if present
+    if not cls.LISTS_PREFIX_PATTERN.match(filename):
+      return None
+    return cls.LISTS_PREFIX_PATTERN.sub("", filename)
@@ -0,0 +1,351 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the compression of images in Python, using a pool
+of threads. The image is split into independent blocks, each block is
+compressed as a separate member (gzip), stream (bzip2) or stream (xz), and the
+results are concatenated. The decompression tools handle such files as a
+single stream.
+
+Compression is sparse aware : the holes of the image are not read, and the
+compressed representation of a block of zeros is computed only once. The image
+can also be piped into an external compression tool, and released from the
+disk while it is read.
+"""
+
+import os
+import zlib
+import bz2
+import lzma
+import gzip
+import ctypes
+import ctypes.util
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dft.enumkey import Key
+from dft.block_map import BlockMap
+
+# -----------------------------------------------------------------------------
+#
+#    Class ParallelCompressor
+#
+# -----------------------------------------------------------------------------
+class ParallelCompressor(object):
+  """This class implements the compression of a file by independent blocks.
+  zlib, bz2 and lzma release the GIL while compressing, thus threads are
+  enough to use all the CPU.
+
+  lzma (alone) format cannot be made of several streams, thus it is
+  compressed in a single stream, by the calling thread.
+  """
+
+  # List of the formats supported by this class
+  FORMATS = [Key.GZIP.value, Key.BZIP2.value, Key.XZ.value, Key.LZMA.value]
+
+  # Size of the blocks compressed independently
+  BLOCK_SIZE = 16 * 1024 * 1024
+
+  # Flags of fallocate used to release the blocks of the source file
+  FALLOC_FL_KEEP_SIZE = 0x01
+  FALLOC_FL_PUNCH_HOLE = 0x02
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, logger, compression, threads=None):
+    """Default constructor
+    """
+
+    # Logger used to output messages
+    self.logging = logger
+
+    # Compression format, one of FORMATS
+    self.compression = compression
+
+    # Number of threads used to compress, default is the number of CPU
+    if threads is None or threads <= 0:
+      threads = os.cpu_count()
+    self.threads = threads
+
+    # Compressed block of zeros, indexed by block size. Used for holes
+    self.zero_blocks = {}
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # compress_file
+  #
+  # -------------------------------------------------------------------------
+  def compress_file(self, source, target, punch_holes=False, bmap_path=None):
+    """This method compresses the source file into the target file. If
+    punch_holes is True, the blocks of the source are released once read,
+    thus the raw file does not use space anymore once compressed. If
+    bmap_path is given, the block map of the source is generated.
+    """
+
+    self.logging.debug("compressing " + source + " to " + target + " using " +
+                       str(self.threads) + " threads")
+
+    # Open both files, target is written by blocks in the order of the source
+    with open(source, "rb+") as source_file, open(target, "wb") as target_file:
+      blocks = self.read_blocks(source_file, punch_holes, bmap_path)
+
+      # lzma alone format is a single stream, it is not split
+      if self.compression == Key.LZMA.value:
+        compressor = lzma.LZMACompressor(format=lzma.FORMAT_ALONE)
+        for _, size, data in blocks:
+          target_file.write(compressor.compress(data if data is not None else bytes(size)))
+        target_file.write(compressor.flush())
+        return
+
+      # Other formats are compressed by blocks in the pool. The number of blocks in memory
+      # is bounded by submitting a window of blocks at once
+      window = self.threads * 2
+      with ThreadPoolExecutor(max_workers=self.threads) as executor:
+        futures = []
+        for _, size, data in blocks:
+          # Holes are not read, their compressed representation is computed once
+          if data is None:
+            futures.append(self.__get_zero_block(executor, size))
+          else:
+            futures.append(executor.submit(self.compress_block, data))
+
+          # Write the completed blocks when the window is full
+          while len(futures) >= window:
+            target_file.write(futures.pop(0).result())
+
+        # Write the last blocks
+        for future in futures:
+          target_file.write(future.result())
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # pipe_file
+  #
+  # -------------------------------------------------------------------------
+  def pipe_file(self, source, target, command, punch_holes=False, bmap_path=None):
+    """This method compresses the source file into the target file, by piping
+    it into a compression command which outputs to stdout. punch_holes and
+    bmap_path have the same meaning as in compress_file. The return code of
+    the command is returned.
+    """
+
+    self.logging.debug("piping " + source + " to " + target + " through " + command)
+
+    # Start the command, its output is the target file
+    with open(source, "rb+") as source_file, open(target, "wb") as target_file:
+      process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                                 stdout=target_file)
+      try:
+        # Feed the command, holes are sent as zeros but never read from the disk
+        for _, size, data in self.read_blocks(source_file, punch_holes, bmap_path):
+          process.stdin.write(data if data is not None else bytes(size))
+      except BrokenPipeError:
+        # The command died, its return code reports the error
+        pass
+      finally:
+        try:
+          process.stdin.close()
+        except BrokenPipeError:
+          pass
+
+      # Wait for the command to complete and return its code
+      return process.wait()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # read_blocks
+  #
+  # -------------------------------------------------------------------------
+  def read_blocks(self, source_file, punch_holes=False, bmap_path=None):
+    """This method generates the blocks of the file, as tuples (offset,
+    size, data). data is None if the block is a hole, which is not read.
+
+    Blocks read are dropped from the page cache since they are not used
+    again, and released from the disk if punch_holes is True. The block map
+    is written once the whole file has been read.
+    """
+
+    # Retrieve the data extents of the file
+    file_size = os.fstat(source_file.fileno()).st_size
+    extents = self.get_data_extents(source_file.fileno(), file_size)
+
+    # The block map is computed from the data read
+    block_map = None
+    if bmap_path is not None:
+      block_map = BlockMap(file_size, extents)
+
+    # Read the blocks
+    for offset, size, is_hole in self.iterate_blocks(file_size, extents):
+      # Holes are not read
+      if is_hole:
+        yield (offset, size, None)
+        continue
+
+      # Read the data and hash it for the block map
+      source_file.seek(offset)
+      data = source_file.read(size)
+      if block_map is not None:
+        block_map.update(offset, data)
+
+      # Data has been read, free the page cache, and the disk if requested
+      if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(source_file.fileno(), offset, size, os.POSIX_FADV_DONTNEED)
+      if punch_holes:
+        punch_holes = self.punch_hole(source_file.fileno(), offset, size)
+        if not punch_holes:
+          self.logging.warning("Cannot punch holes in " + source_file.name +
+                               ", raw image is kept until compression is done")
+      yield (offset, size, data)
+
+    # Output the block map
+    if block_map is not None:
+      block_map.write(bmap_path)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # compress_block
+  #
+  # -------------------------------------------------------------------------
+  def compress_block(self, data):
+    """This method compresses a block as a standalone member of the output
+    stream.
+    """
+
+    # Each format has its own standalone representation
+    if self.compression == Key.GZIP.value:
+      return gzip.compress(data)
+    elif self.compression == Key.BZIP2.value:
+      return bz2.compress(data)
+    elif self.compression == Key.XZ.value:
+      return lzma.compress(data, format=lzma.FORMAT_XZ)
+    return zlib.compress(data)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # iterate_blocks
+  #
+  # -------------------------------------------------------------------------
+  def iterate_blocks(self, file_size, extents):
+    """This method generates the list of the blocks of the file, as tuples
+    (offset, size, is_hole). A block is a hole if it does not contain any
+    data extent.
+    """
+
+    # Iterate the blocks and check if they intersect an extent. Both lists are sorted
+    extent_index = 0
+    for offset in range(0, file_size, self.BLOCK_SIZE):
+      size = min(self.BLOCK_SIZE, file_size - offset)
+      while extent_index < len(extents) and extents[extent_index][1] <= offset:
+        extent_index += 1
+      is_hole = extent_index >= len(extents) or extents[extent_index][0] >= offset + size
+      yield (offset, size, is_hole)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_data_extents
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def get_data_extents(fileno, file_size):
+    """This method returns the list of the (start, end) ranges of the file
+    containing data. If the system cannot report holes, the whole file is
+    considered as data.
+    """
+
+    # Check the system supports hole detection
+    if not hasattr(os, "SEEK_DATA"):
+      return [(0, file_size)]
+
+    # Walk the file, jumping from data to hole
+    extents = []
+    offset = 0
+    try:
+      while offset < file_size:
+        try:
+          start = os.lseek(fileno, offset, os.SEEK_DATA)
+        except OSError:
+          # ENXIO means there is no more data after offset
+          break
+        end = os.lseek(fileno, start, os.SEEK_HOLE)
+        extents.append((start, end))
+        offset = end
+    except OSError:
+      return [(0, file_size)]
+
+    # Return the extents
+    return extents
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # punch_hole
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def punch_hole(fileno, offset, size):
+    """This method releases a range of the file from the disk, keeping the
+    size of the file. Python does not provide fallocate, thus it is called
+    through the C library. It returns False if the system does not support
+    it.
+    """
+
+    # Call fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, size)
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+      result = libc.fallocate(fileno, ParallelCompressor.FALLOC_FL_PUNCH_HOLE |
+                              ParallelCompressor.FALLOC_FL_KEEP_SIZE,
+                              ctypes.c_longlong(offset), ctypes.c_longlong(size))
+    except (OSError, AttributeError):
+      return False
+
+    # Return the status of the call
+    return result == 0
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __get_zero_block
+  #
+  # -------------------------------------------------------------------------
+  def __get_zero_block(self, executor, size):
+    """This method returns the future of the compressed representation of a
+    block of zeros. It is computed only once for each size.
+    """
+
+    # Compute it if not yet available
+    if size not in self.zero_blocks:
+      self.zero_blocks[size] = executor.submit(self.compress_block, bytes(size))
+    return self.zero_blocks[size]
@@ -0,0 +1,167 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the partition job model used by image building.
+A job gathers everything needed to format, tune, label and check one
+partition. It is computed once from the partition definition, thus the
+operations on different partitions can run concurrently.
+"""
+
+from dft.enumkey import Key
+
+# -----------------------------------------------------------------------------
+#
+#    Class PartitionJob
+#
+# -----------------------------------------------------------------------------
+class PartitionJob(object):
+  """This class stores the definition of a partition of the image, and
+  generates the commands run on its device. Commands are None when there is
+  nothing to do for the partition.
+  """
+
+  # Filesystems handled by e2fsprogs
+  EXT_FILESYSTEMS = ["ext2", "ext3", "ext4"]
+
+  # Format tool of each filesystem
+  FORMAT_TOOLS = {"ext2": "mkfs.ext2",
+                  "ext3": "mkfs.ext3",
+                  "ext4": "mkfs.ext4",
+                  "fat12": "mkfs.vfat -F 12",
+                  "fat16": "mkfs.vfat -F 16",
+                  "fat32": "mkfs.vfat -F 32",
+                  "linux-swap(v0)": "mkswap",
+                  "linux-swap(v1)": "mkswap"}
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, index, partition, device):
+    """Default constructor. index is the partition number, partition its
+    definition from the devices section, and device the path to the device
+    node (or file) of the partition.
+    """
+
+    # Partition number, definition and device node
+    self.index = index
+    self.definition = partition
+    self.device = device
+
+    # Filesystem type, None if not defined
+    self.filesystem = None
+    if Key.FILESYSTEM.value in partition:
+      self.filesystem = partition[Key.FILESYSTEM.value].lower()
+
+    # Format flag. It is None if not defined, since the default value depends on the operation
+    self.format = partition.get(Key.FORMAT.value)
+
+    # Filesystem label, tune2fs options and content mapping
+    self.label = partition.get(Key.NAME.value)
+    self.tune_options = partition.get(Key.EXT_FS_TUNE.value)
+    self.mapping = partition.get(Key.CONTENT_PARTITION_MAPPING.value)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_format_command
+  #
+  # -------------------------------------------------------------------------
+  def get_format_command(self):
+    """This method returns the command creating the filesystem. Partitions
+    are formatted only if the format flag is set.
+    """
+
+    # Check the format flag, and that a tool is known for the filesystem
+    if not self.format or self.filesystem not in self.FORMAT_TOOLS:
+      return None
+    return self.FORMAT_TOOLS[self.filesystem] + ' ' + self.device
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_tune_command
+  #
+  # -------------------------------------------------------------------------
+  def get_tune_command(self):
+    """This method returns the command applying ext filesystems options
+    (according to man tune2fs).
+    """
+
+    # Options apply only to formatted ext filesystems
+    if not self.format or self.tune_options is None or \
+       self.filesystem not in self.EXT_FILESYSTEMS:
+      return None
+    return 'tune2fs ' + self.tune_options + ' ' + self.device
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_label_command
+  #
+  # -------------------------------------------------------------------------
+  def get_label_command(self):
+    """This method returns the command setting the filesystem label. The
+    label is the name of the partition. The caller is in charge of checking
+    is_labelable before.
+    """
+
+    # Select tool according to filesystem
+    if self.filesystem in self.EXT_FILESYSTEMS:
+      return 'e2label ' + self.device + ' ' + self.label
+    elif self.filesystem == "fat32":
+      return 'fatlabel ' + self.device + ' ' + self.label
+    return None
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # is_labelable
+  #
+  # -------------------------------------------------------------------------
+  def is_labelable(self):
+    """This method returns True if a label is defined, and the partition
+    has a filesystem which is not explicitly left unformatted.
+    """
+
+    return self.label is not None and self.filesystem is not None and self.format is not False
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_check_command
+  #
+  # -------------------------------------------------------------------------
+  def get_check_command(self):
+    """This method returns the command checking the filesystem once content
+    has been written. Partitions are checked if they are formatted (default)
+    and receive content.
+    """
+
+    # Check only partitions with content
+    if self.format is False or self.mapping is None:
+      return None
+    return 'fsck -f -y ' + self.device
@@ -0,0 +1,295 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the content addressed cache used to store the
+snapshots of the rootfs after each stage of its generation (debootstrap,
+roles, upgrade).
+
+Each stage is identified by a key computed from the key of the previous
+stage and from the inputs of the stage itself. Thus a snapshot can only be
+restored if all the previous stages had the very same inputs.
+"""
+
+import os
+import json
+import hashlib
+from datetime import datetime
+import yaml
+from dft.enumkey import Key
+from dft import release
+
+# -----------------------------------------------------------------------------
+#
+#    Class RootfsStageCache
+#
+# -----------------------------------------------------------------------------
+class RootfsStageCache(object):
+  """This class implements the storage of the rootfs stages snapshots.
+
+  Snapshots are tarballs created with ownership, permissions, xattrs and
+  acls preserved. They are stored under the cache directory, and named after
+  the stage key. A small yaml file describing the snapshot is stored next to
+  each tarball.
+
+  Tar commands are run through the execute_command method of the cli command
+  using the cache, so error handling is the same as for the other commands.
+  """
+
+  # Suffix of the snapshot files
+  SNAPSHOT_SUFFIX = ".tar"
+
+  # Suffix of the snapshot description files
+  DESCRIPTION_SUFFIX = ".yml"
+
+  # Size of the chunks used when hashing files
+  BLOCK_SIZE = 65536
+
+  # Paths which must not be stored into the snapshots. QEMU binary is copied by setup_qemu,
+  # others are the special filesystems mounted in the chrooted environment
+  EXCLUDED_PATHS = ["./usr/bin/qemu-*", "./proc/*", "./sys/*", "./dev/pts/*", "./dev/shm/*"]
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, project, cache_dir, execute_command):
+    """Default constructor
+    """
+
+    # Object storing the project definition
+    self.project = project
+
+    # Path to the directory storing the snapshots
+    self.cache_dir = cache_dir
+
+    # Method used to run the tar commands
+    self.execute_command = execute_command
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # compute_key
+  #
+  # -------------------------------------------------------------------------
+  def compute_key(self, parent_key, stage, inputs):
+    """This method computes the key of a stage. The key is a sha256 of the
+    parent stage key, the stage name, the dft version and the inputs. Inputs
+    must be serializable to json (dictionnaries, lists and strings).
+    """
+
+    # Serialize the inputs in a stable way (sorted keys)
+    hasher = hashlib.sha256()
+    hasher.update(str(parent_key).encode(Key.UTF8.value))
+    hasher.update(stage.encode(Key.UTF8.value))
+    hasher.update(release.__version__.encode(Key.UTF8.value))
+    hasher.update(json.dumps(inputs, sort_keys=True, default=str).encode(Key.UTF8.value))
+
+    # Key is the hex representation of the digest
+    key = hasher.hexdigest()
+    self.project.logging.debug("rootfs cache key for stage " + stage + " is " + key)
+    return key
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # hash_tree
+  #
+  # -------------------------------------------------------------------------
+  def hash_tree(self, path):
+    """This method computes a digest of a directory tree (or a single file).
+    The digest includes relative paths, modes, symlinks targets and files
+    content. It is used to detect modifications of the ansible roles.
+    """
+
+    # The digest is computed in a stable order (sorted walk)
+    hasher = hashlib.sha256()
+
+    # Nothing to hash if the path does not exist, but it has to be part of the digest
+    if not os.path.exists(path):
+      hasher.update(b"missing")
+      return hasher.hexdigest()
+
+    # Single file case
+    if not os.path.isdir(path):
+      self.__hash_file(hasher, path)
+      return hasher.hexdigest()
+
+    # Walk the tree, sorting directories and files to have a stable digest
+    for root, dirs, files in os.walk(path):
+      dirs.sort()
+      for filename in sorted(files):
+        filepath = os.path.join(root, filename)
+        hasher.update(os.path.relpath(filepath, path).encode(Key.UTF8.value))
+        if os.path.islink(filepath):
+          hasher.update(os.readlink(filepath).encode(Key.UTF8.value))
+        else:
+          hasher.update(str(os.stat(filepath).st_mode).encode(Key.UTF8.value))
+          self.__hash_file(hasher, filepath)
+
+    # Return the digest
+    return hasher.hexdigest()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # has_snapshot
+  #
+  # -------------------------------------------------------------------------
+  def has_snapshot(self, key):
+    """This method returns True if a snapshot exist for the given key.
+    """
+
+    # Check the snapshot file exist
+    return os.path.isfile(self.__get_snapshot_path(key))
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # find_longest_prefix
+  #
+  # -------------------------------------------------------------------------
+  def find_longest_prefix(self, keys):
+    """This method returns the number of stages which can be restored from
+    the cache, given the ordered list of stage keys. Only the last stage of
+    this prefix needs to be restored since snapshots are complete trees.
+    """
+
+    # Search from the last stage to the first one
+    for index in range(len(keys), 0, -1):
+      if self.has_snapshot(keys[index - 1]):
+        return index
+
+    # Nothing found
+    return 0
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # save_snapshot
+  #
+  # -------------------------------------------------------------------------
+  def save_snapshot(self, key, stage, rootfs):
+    """This method stores a snapshot of the rootfs under the given key. The
+    snapshot is first written to a temporary file then renamed, thus a
+    failed or concurrent build cannot leave a partial snapshot.
+    """
+
+    self.project.logging.info("saving rootfs snapshot for stage " + stage)
+
+    # Ensure the cache directory exist
+    os.makedirs(self.cache_dir, exist_ok=True)
+
+    # Generate the tar command
+    snapshot_path = self.__get_snapshot_path(key)
+    temp_path = snapshot_path + "." + str(os.getpid()) + ".tmp"
+    command = "tar --create --file=" + temp_path + " --numeric-owner --preserve-permissions"
+    command += " --xattrs --xattrs-include='*' --acls"
+    for excluded in self.EXCLUDED_PATHS:
+      command += " --exclude='" + excluded + "'"
+    command += " --directory=" + rootfs + " ."
+    self.execute_command(command, capture_output=False)
+
+    # Move the snapshot to its final location
+    os.rename(temp_path, snapshot_path)
+
+    # Write the description of the snapshot
+    description = {Key.STAGE.value: stage,
+                   Key.PROJECT_NAME.value: self.project.project[Key.PROJECT_DEFINITION.value]\
+                                                               [Key.PROJECT_NAME.value],
+                   Key.TARGET.value: self.project.get_target_board() + "-" + \
+                                     self.project.get_target_arch() + "-" + \
+                                     self.project.get_target_version(),
+                   Key.TIMESTAMP.value: datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                   Key.SIZE.value: os.path.getsize(snapshot_path)}
+    with open(self.__get_description_path(key), "w") as working_file:
+      yaml.dump(description, working_file, default_flow_style=False)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # restore_snapshot
+  #
+  # -------------------------------------------------------------------------
+  def restore_snapshot(self, key, stage, rootfs):
+    """This method extracts the snapshot stored under the given key into the
+    rootfs. The rootfs is expected to be empty.
+    """
+
+    self.project.logging.info("restoring rootfs snapshot for stage " + stage)
+
+    # Ensure the target directory exist
+    os.makedirs(rootfs, exist_ok=True)
+
+    # Generate the tar command and extract the snapshot
+    command = "tar --extract --file=" + self.__get_snapshot_path(key)
+    command += " --numeric-owner --preserve-permissions --same-owner"
+    command += " --xattrs --xattrs-include='*' --acls --directory=" + rootfs
+    self.execute_command(command, capture_output=False)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __get_snapshot_path
+  #
+  # -------------------------------------------------------------------------
+  def __get_snapshot_path(self, key):
+    """This method returns the path to the snapshot of the given key.
+    """
+
+    # Path is made of cache dir and key
+    return os.path.join(self.cache_dir, key + self.SNAPSHOT_SUFFIX)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __get_description_path
+  #
+  # -------------------------------------------------------------------------
+  def __get_description_path(self, key):
+    """This method returns the path to the description file of the given key.
+    """
+
+    # Path is made of cache dir and key
+    return os.path.join(self.cache_dir, key + self.DESCRIPTION_SUFFIX)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __hash_file
+  #
+  # -------------------------------------------------------------------------
+  def __hash_file(self, hasher, filepath):
+    """This method feeds the hasher with the content of a file.
+    """
+
+    # Read the file by blocks
+    with open(filepath, "rb") as working_file:
+      for block in iter(lambda: working_file.read(self.BLOCK_SIZE), b""):
+        hasher.update(block)
@@ -21,9 +21,23 @@
 """ This module contains the functionnalities needed to run a sequence of DFT command
 defined in the configuration file. This feature is used to execute in a row the
 different steps needed to build a firmware image from scratch.
+
+Steps are run as a graph. Each step reads (inputs) and writes (outputs) some
+resources (rootfs, firmware, image). A step depends on the previous steps
+writing what it reads or writes, or reading what it writes. Steps which do
+not depend on each other (such as several check_rootfs steps, which only read
+the rootfs) run concurrently, each in its own process.
 """
 
+import os
+import json
+import time
+import hashlib
 import logging
+import tempfile
+import multiprocessing
+from datetime import datetime
+import yaml
 from dft.cli_command import CliCommand
 from dft.enumkey import Key
 from dft import assemble_firmware
@@ -43,6 +57,27 @@ class Sequence(CliCommand):
   sequence of commands
   """
 
+  # Resources read and written by each action. Steps can override them using inputs and
+  # outputs keys. Actions not listed here read and write everything. content_information
+  # installs and removes the scanning tools, and build_firmware installs the bootflag
+  # cleaning script, thus both write the rootfs
+  STEP_RESOURCES = {Key.BUILD_ROOTFS.value: ([], [Key.ROOTFS.value]),
+                    Key.INSTALL_BOOTCHAIN.value: ([Key.ROOTFS.value], [Key.ROOTFS.value]),
+                    Key.STRIP_ROOTFS.value: ([Key.ROOTFS.value], [Key.ROOTFS.value]),
+                    Key.CHECK_ROOTFS.value: ([Key.ROOTFS.value], []),
+                    Key.CONTENT_INFO.value: ([Key.ROOTFS.value], [Key.ROOTFS.value]),
+                    Key.ASSEMBLE_FIRMWARE.value: ([Key.ROOTFS.value, Key.FIRMWARE.value],
+                                                  [Key.ROOTFS.value, Key.FIRMWARE.value]),
+                    Key.BUILD_FIRMWARE.value: ([Key.ROOTFS.value, Key.FIRMWARE.value],
+                                               [Key.ROOTFS.value, Key.FIRMWARE.value]),
+                    Key.BUILD_IMAGE.value: ([Key.ROOTFS.value, Key.FIRMWARE.value],
+                                            [Key.IMAGE.value]),
+                    Key.BUILD_PARTITIONS.value: ([Key.ROOTFS.value, Key.FIRMWARE.value],
+                                                 [Key.IMAGE.value])}
+
+  # Interval between two checks of the running steps (in seconds)
+  POLL_INTERVAL = 0.5
+
   # -------------------------------------------------------------------------
   #
   # __init__
@@ -55,6 +90,15 @@ class Sequence(CliCommand):
     # Initialize ancestor
     CliCommand.__init__(self, dft, project)
 
+    # Path to the file storing the completed steps. Defined once sequence is known
+    self.state_file = None
+
+    # Completed steps loaded from the state file. Key is the step id, value the step fingerprint
+    self.completed_steps = {}
+
+    # Flag set when QEMU has been installed by the sequence for read only steps
+    self.shared_qemu_installed = False
+
   # -------------------------------------------------------------------------
   #
   # run_sequence
@@ -106,11 +150,287 @@ class Sequence(CliCommand):
     if len(sequence) == 0:
       logging.info("Sequence " + self.dft.sequence_name + " is empty. Nothing to do.")
     else:
-      # Some steps are defined in the list. Iterate it and call run_tep method on each step
-      for step in sequence[Key.STEPS.value]:
-        if not self.execute_step(step):
-          logging.error("Execution of step " + step[Key.ACTION.value] + " failed. Aborting")
-          exit(1)
+      # Load the completed steps if resuming, otherwise start from scratch
+      self.state_file = self.project.get_sequence_state_file(self.dft.sequence_name)
+      if self.dft.resume_sequence:
+        self.load_state()
+      else:
+        self.save_state()
+
+      # Some steps are defined in the list. Run them according to their dependencies
+      if not self.run_steps(sequence[Key.STEPS.value]):
+        logging.error("Sequence " + self.dft.sequence_name + " failed. Use --resume to continue "
+                      "from the failed step")
+        exit(1)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # run_steps
+  #
+  # -------------------------------------------------------------------------
+  def run_steps(self, steps):
+    """This method runs the steps of a sequence. A step is started once all
+    the steps it depends on are done, and several independent steps can run
+    at the same time. Steps already completed by a previous run are skipped
+    when resuming, unless they have been modified or depend on a step which
+    is run again. It returns False if a step has failed.
+    """
+
+    # Compute the dependencies of each step
+    dependencies = self.compute_dependencies(steps)
+    concurrency = max(1, self.project.get_step_concurrency())
+
+    # Processes are forked to inherit the whole state of the parent (configuration, logger)
+    context = multiprocessing.get_context("fork")
+
+    # Steps waiting to be started, running steps (process => index), and done steps. Done
+    # steps are stored with a flag telling if they have been skipped
+    pending = list(range(len(steps)))
+    running = {}
+    done = {}
+    failed = False
+
+    # Loop until all steps are done, or a step has failed and running steps are done
+    while (len(pending) > 0 and not failed) or len(running) > 0:
+      # Start the steps whose dependencies are done, while the limit is not reached
+      for index in list(pending):
+        if failed or len(running) >= concurrency:
+          break
+        if not all(dep in done for dep in dependencies[index]):
+          continue
+        pending.remove(index)
+
+        # Skip the step if it has been completed by a previous run, and its dependencies too
+        step_id = self.get_step_id(index, steps[index])
+        if self.completed_steps.get(step_id) == self.get_step_fingerprint(steps[index]) and \
+           all(done[dep] for dep in dependencies[index]):
+          logging.info("Skipping step " + step_id + ", already completed")
+          done[index] = True
+          continue
+
+        # Start the step in its own process
+        self.prepare_step_qemu(steps[index])
+        process = context.Process(target=self.__run_step, args=(steps[index],), name=step_id)
+        process.start()
+        running[process] = index
+        logging.info("Step " + step_id + " started")
+
+      # Then check the running steps
+      for process in list(running):
+        if process.is_alive():
+          continue
+        process.join()
+        index = running.pop(process)
+        step_id = self.get_step_id(index, steps[index])
+
+        # A rootfs writer has removed (or overwritten) the QEMU installed by the sequence
+        if Key.ROOTFS.value in self.get_step_resources(steps[index])[1]:
+          self.shared_qemu_installed = False
+
+        # Record the result
+        if process.exitcode == 0:
+          logging.info("Step " + step_id + " completed")
+          done[index] = False
+          self.completed_steps[step_id] = self.get_step_fingerprint(steps[index])
+          self.save_state()
+        else:
+          logging.error("Execution of step " + step_id + " failed. Waiting for running steps")
+          failed = True
+
+      # Wait a bit before next check
+      if len(running) > 0:
+        time.sleep(self.POLL_INTERVAL)
+
+    # Remove QEMU if it has been installed for the read only steps
+    if self.shared_qemu_installed:
+      self.cleanup_qemu()
+      self.shared_qemu_installed = False
+
+    # Return the global status
+    return not failed
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # compute_dependencies
+  #
+  # -------------------------------------------------------------------------
+  def compute_dependencies(self, steps):
+    """This method returns the list of the steps each step depends on. A
+    step depends on a previous step if the previous one writes a resource
+    the step reads or writes, or reads a resource the step writes.
+    """
+
+    # List of dependencies sets, one per step
+    dependencies = []
+
+    # Compare each step with all the previous ones
+    for index, step in enumerate(steps):
+      inputs, outputs = self.get_step_resources(step)
+      step_dependencies = set()
+      for previous in range(index):
+        previous_inputs, previous_outputs = self.get_step_resources(steps[previous])
+        if set(previous_outputs) & (set(inputs) | set(outputs)) or \
+           set(previous_inputs) & set(outputs):
+          step_dependencies.add(previous)
+      dependencies.append(step_dependencies)
+      logging.debug("step " + self.get_step_id(index, step) + " depends on " +
+                    str(sorted(step_dependencies)))
+
+    # Return the dependencies of all the steps
+    return dependencies
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_step_resources
+  #
+  # -------------------------------------------------------------------------
+  def get_step_resources(self, step):
+    """This method returns the tuple (inputs, outputs) of a step. Values
+    defined in the step override the default values of the action.
+    """
+
+    # Start with default values, unknown actions read and write everything
+    everything = [Key.ROOTFS.value, Key.FIRMWARE.value, Key.IMAGE.value]
+    inputs, outputs = self.STEP_RESOURCES.get(step[Key.ACTION.value], (everything, everything))
+
+    # Override with step definition
+    inputs = step.get(Key.INPUTS.value, inputs)
+    outputs = step.get(Key.OUTPUTS.value, outputs)
+    return (inputs, outputs)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_step_id
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def get_step_id(index, step):
+    """This method returns the identifier of a step, made of its position in
+    the sequence and its action.
+    """
+
+    # Concatenate position and action
+    return str(index) + "-" + step[Key.ACTION.value]
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # get_step_fingerprint
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def get_step_fingerprint(step):
+    """This method returns a digest of the step definition. It is used to
+    detect steps modified since they have been completed.
+    """
+
+    # Hash the serialized definition
+    return hashlib.sha256(json.dumps(step, sort_keys=True, default=str)\
+                          .encode(Key.UTF8.value)).hexdigest()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # prepare_step_qemu
+  #
+  # -------------------------------------------------------------------------
+  def prepare_step_qemu(self, step):
+    """This method installs QEMU in the rootfs before starting a step which
+    only reads the rootfs. Such steps may run concurrently, thus they must
+    not install nor remove QEMU themselves.
+    """
+
+    # Nothing to do if QEMU is not needed, already installed or the step is not read only
+    inputs, outputs = self.get_step_resources(step)
+    if not self.use_qemu_static or self.shared_qemu_installed or \
+       Key.ROOTFS.value not in inputs or Key.ROOTFS.value in outputs:
+      return
+
+    # Rootfs may not exist yet, in such case the step will fail by itself
+    if os.path.isdir(self.project.get_rootfs_mountpoint() + "/usr/bin"):
+      self.setup_qemu()
+      self.shared_qemu_installed = True
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # load_state
+  #
+  # -------------------------------------------------------------------------
+  def load_state(self):
+    """This method loads the list of completed steps from the state file.
+    """
+
+    # Nothing to load if there is no state file
+    if not os.path.isfile(self.state_file):
+      logging.info("No state file found for sequence " + self.dft.sequence_name +
+                   ", running all the steps")
+      return
+
+    # Load the yaml content
+    with open(self.state_file, "r") as working_file:
+      state = yaml.load(working_file, Loader=yaml.SafeLoader)
+    if state is not None and state.get(Key.STEPS.value) is not None:
+      self.completed_steps = state[Key.STEPS.value]
+    logging.info("Resuming sequence " + self.dft.sequence_name + ", " +
+                 str(len(self.completed_steps)) + " steps already completed")
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # save_state
+  #
+  # -------------------------------------------------------------------------
+  def save_state(self):
+    """This method writes the list of completed steps to the state file.
+    The file is written to a temporary file then renamed, thus it is never
+    left partially written.
+    """
+
+    # Ensure the directory exist
+    os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+
+    # Write the state then move it to its final location
+    state = {Key.SEQUENCE_NAME.value: self.dft.sequence_name,
+             Key.TIMESTAMP.value: datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+             Key.STEPS.value: self.completed_steps}
+    with tempfile.NamedTemporaryFile(mode='w+', delete=False,
+                                     dir=os.path.dirname(self.state_file)) as working_file:
+      yaml.dump(state, working_file, default_flow_style=False)
+    os.rename(working_file.name, self.state_file)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __run_step
+  #
+  # -------------------------------------------------------------------------
+  def __run_step(self, step):
+    """This method is the entry point of the step processes. It exits with
+    a non zero code if the step has failed.
+    """
+
+    # Steps reading the rootfs use the QEMU installed by the sequence
+    inputs, outputs = self.get_step_resources(step)
+    if Key.ROOTFS.value in inputs and Key.ROOTFS.value not in outputs:
+      self.dft.shared_qemu = True
+
+    # Execute the step. Commands exit by themselves in case of error
+    if not self.execute_step(step):
+      exit(1)
 
 
 
@@ -104,6 +104,9 @@ class StripRootFS(CliCommand):
       if Key.MESSAGE_END.value in rules:
         self.project.logging.info(rules[Key.MESSAGE_END.value])
 
+    # All the commands have been executed, stop the chroot session
+    self.stop_chroot_session()
+
     # Remove QEMU if it has been isntalled. It has to be done in the end
     # since some cleanup tasks could need QEMU
     if self.use_qemu_static:
@@ -120,7 +123,7 @@ class StripRootFS(CliCommand):
   def strip_packages(self, rules):
     """This method implement the package stripping
 
-    The method parses the output of the dpkg -l command and checks if packages are
+    The method reads the dpkg database of the rootfs and checks if packages are
     in the rules dictionnaries, then apply the action defined in the matching rule.
     """
 
@@ -128,16 +131,9 @@ class StripRootFS(CliCommand):
     if Key.PACKAGES.value in rules:
       # Check that the stripping definition includes a status absent
       if Key.ABSENT.value in rules[Key.PACKAGES.value]:
-        # Retrieve the list of installed packages
-        command = "LANG=C chroot " + self.project.get_rootfs_mountpoint()
-        command += " dpkg -l | tail -n +6 | awk '{ print $2 }'"
-        pkglist = self.execute_command(command)
-
-        # Transform the binary outputinto text
-        for binaryline in pkglist.splitlines():
-          # Each fields is stored into a variable to easy manipulation and
-          # simplify code. First get the array of words converted to UTF-8
-          self.installed_packages[binaryline.decode('utf-8').split()[0]] = True
+        # Retrieve the list of installed packages from the dpkg database
+        for record in self.project.get_dpkg_status_index():
+          self.installed_packages[record["Package"]] = True
 
         # Iterate the list packages to remove
         for pkg in rules[Key.PACKAGES.value][Key.ABSENT.value]:
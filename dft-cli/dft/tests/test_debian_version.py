@@ -0,0 +1,178 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module contains the unit tests of the Debian version comparator. The
+fixed cases come from the Debian policy, the random ones are checked against
+dpkg --compare-versions when dpkg is available.
+"""
+
+import random
+import shutil
+import subprocess
+import unittest
+from dft.debian_version import DebianVersion
+
+# -----------------------------------------------------------------------------
+#
+#    Class TestDebianVersion
+#
+# -----------------------------------------------------------------------------
+class TestDebianVersion(unittest.TestCase):
+  """Tests of the DebianVersion class
+  """
+
+  # Pairs of versions where the first one is lower than the second one
+  LOWER_VERSIONS = [("1.0~rc1", "1.0"),
+                    ("1.0~~", "1.0~"),
+                    ("1.0~", "1.0"),
+                    ("1.0", "1.0+dfsg"),
+                    ("1.0", "1.0.1"),
+                    ("1.0", "1:0.1"),
+                    ("1:2.0", "2:1.0"),
+                    ("1.0-1", "1.0-2"),
+                    ("1.0-9", "1.0-10"),
+                    ("1.0-1", "1.0.1-1"),
+                    ("1.2", "1.10"),
+                    ("1.0a", "1.0b"),
+                    ("1.0a", "1.0+"),
+                    ("1.0Z", "1.0a"),
+                    ("1.0", "1.0a"),
+                    ("2.4a", "2.30"),
+                    ("0.9-1~bpo1", "0.9-1")]
+
+  # Pairs of versions which are equal
+  EQUAL_VERSIONS = [("1.0", "1.0"),
+                    ("0:1.0", "1.0"),
+                    ("1.01", "1.1"),
+                    ("1.0-0", "1.0"),
+                    ("1.001-01", "1.1-1"),
+                    ("1.0-1", "0:1.0-1")]
+
+  # Characters used to generate the random versions
+  UPSTREAM_CHARACTERS = "0123456789.+~aZ"
+  REVISION_CHARACTERS = "0123456789.+~bY"
+
+  # Number of random comparisons checked against dpkg
+  RANDOM_COMPARISONS = 500
+
+  # -------------------------------------------------------------------------
+  #
+  # test_lower_versions
+  #
+  # -------------------------------------------------------------------------
+  def test_lower_versions(self):
+    """Checks the ordering rules of the policy (tilde, epoch, revision,
+    numbers, letters before non letters)
+    """
+
+    for version_a, version_b in self.LOWER_VERSIONS:
+      self.assertLess(DebianVersion(version_a), DebianVersion(version_b),
+                      version_a + " < " + version_b)
+      self.assertGreater(DebianVersion(version_b), DebianVersion(version_a),
+                         version_b + " > " + version_a)
+      self.assertTrue(DebianVersion.compare_versions(version_a, "lt", version_b))
+      self.assertTrue(DebianVersion.compare_versions(version_b, "gt", version_a))
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # test_equal_versions
+  #
+  # -------------------------------------------------------------------------
+  def test_equal_versions(self):
+    """Checks that leading zeros, null epochs and null revisions are ignored
+    """
+
+    for version_a, version_b in self.EQUAL_VERSIONS:
+      self.assertEqual(DebianVersion(version_a), DebianVersion(version_b),
+                       version_a + " = " + version_b)
+      self.assertTrue(DebianVersion.compare_versions(version_a, "eq", version_b))
+      self.assertTrue(DebianVersion.compare_versions(version_a, "le", version_b))
+      self.assertTrue(DebianVersion.compare_versions(version_a, "ge", version_b))
+      self.assertFalse(DebianVersion.compare_versions(version_a, "ne", version_b))
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # test_invalid_versions
+  #
+  # -------------------------------------------------------------------------
+  def test_invalid_versions(self):
+    """Checks that invalid versions are rejected, and are never compared as
+    true, as dpkg does
+    """
+
+    for version in ["", "a:1.0", "1:", "-1"]:
+      self.assertRaises(ValueError, DebianVersion, version)
+      self.assertFalse(DebianVersion.compare_versions(version, "eq", "1.0"))
+    self.assertRaises(ValueError, DebianVersion.compare_versions, "1.0", "<<", "2.0")
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # test_random_versions_against_dpkg
+  #
+  # -------------------------------------------------------------------------
+  @unittest.skipIf(shutil.which("dpkg") is None, "dpkg is not available")
+  def test_random_versions_against_dpkg(self):
+    """Checks random comparisons against dpkg --compare-versions. The seed is
+    fixed, thus failures can be reproduced.
+    """
+
+    generator = random.Random(20161018)
+    for _ in range(self.RANDOM_COMPARISONS):
+      version_a = self.generate_version(generator)
+      version_b = self.generate_version(generator)
+      if generator.random() < 0.2:
+        version_b = version_a
+
+      # Find the result of dpkg, then compare it with the result of the class
+      for operator in ["lt", "eq", "gt"]:
+        expected = subprocess.call(["dpkg", "--compare-versions",
+                                    version_a, operator, version_b]) == 0
+        self.assertEqual(DebianVersion.compare_versions(version_a, operator, version_b),
+                         expected, version_a + " " + operator + " " + version_b)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # generate_version
+  #
+  # -------------------------------------------------------------------------
+  def generate_version(self, generator):
+    """Generates a random valid version, with optional epoch and revision
+    """
+
+    # Upstream version starts with a digit
+    version = generator.choice("0123456789")
+    version += "".join(generator.choice(self.UPSTREAM_CHARACTERS)
+                       for _ in range(generator.randint(0, 6)))
+
+    # Add the epoch and the revision
+    if generator.random() < 0.3:
+      version = str(generator.randint(0, 3)) + ":" + version
+    if generator.random() < 0.5:
+      version += "-" + "".join(generator.choice(self.REVISION_CHARACTERS)
+                               for _ in range(generator.randint(1, 4)))
+    return version
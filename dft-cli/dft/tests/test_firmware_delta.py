@@ -0,0 +1,159 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module contains the unit tests of the delta firmware updates. Each
+test creates a delta between two generated trees, then checks that applying
+it reconstructs the target.
+"""
+
+import os
+import random
+import shutil
+import logging
+import tempfile
+import unittest
+from dft.enumkey import Key
+from dft.firmware_delta import FirmwareDelta
+
+# -----------------------------------------------------------------------------
+#
+#    Class TestFirmwareDelta
+#
+# -----------------------------------------------------------------------------
+class TestFirmwareDelta(unittest.TestCase):
+  """Tests of the FirmwareDelta class
+  """
+
+  # -------------------------------------------------------------------------
+  #
+  # setUp
+  #
+  # -------------------------------------------------------------------------
+  def setUp(self):
+    """Creates the working directory and the random generator
+    """
+
+    self.work_dir = tempfile.mkdtemp(prefix="dft-test-delta-")
+    self.base_dir = os.path.join(self.work_dir, "base")
+    self.target_dir = os.path.join(self.work_dir, "target")
+    self.delta_dir = os.path.join(self.work_dir, "delta")
+    self.output_dir = os.path.join(self.work_dir, "output")
+    for directory in [self.base_dir, self.target_dir, self.delta_dir]:
+      os.makedirs(directory)
+    self.generator = random.Random(20161018)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # tearDown
+  #
+  # -------------------------------------------------------------------------
+  def tearDown(self):
+    """Removes the working directory
+    """
+
+    shutil.rmtree(self.work_dir)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # test_zstd_target_larger_than_base
+  #
+  # -------------------------------------------------------------------------
+  @unittest.skipIf(shutil.which("zstd") is None, "zstd is not available")
+  def test_zstd_target_larger_than_base(self):
+    """Checks a zstd delta whose target crosses the power of two above the
+    size of the base. The window has to cover the target.
+    """
+
+    manifest = self.create_growing_delta(Key.ZSTD.value, 1000000, 1100000)
+    entry = manifest[Key.FILES.value][0]
+    self.assertEqual(entry[Key.OPERATION.value], FirmwareDelta.DELTA)
+    self.assertEqual(entry[Key.WINDOW_LOG.value], 21)
+    self.check_apply()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # test_block_target_larger_than_base
+  #
+  # -------------------------------------------------------------------------
+  def test_block_target_larger_than_base(self):
+    """Checks a block delta whose target is larger than the base
+    """
+
+    manifest = self.create_growing_delta(Key.BLOCK.value, 1000000, 1100000)
+    self.assertEqual(manifest[Key.FILES.value][0][Key.OPERATION.value], FirmwareDelta.DELTA)
+    self.check_apply()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # create_growing_delta
+  #
+  # -------------------------------------------------------------------------
+  def create_growing_delta(self, method, base_size, target_size):
+    """Creates a base file, and a target made of the base followed by random
+    data, then returns the manifest of the delta
+    """
+
+    base_data = self.generate_data(base_size)
+    extra_data = self.generate_data(target_size - base_size)
+    with open(os.path.join(self.base_dir, "firmware.squashfs"), "wb") as base_file:
+      base_file.write(base_data)
+    with open(os.path.join(self.target_dir, "firmware.squashfs"), "wb") as target_file:
+      target_file.write(base_data + extra_data)
+
+    delta = FirmwareDelta(logging.getLogger(__name__), method, threads=2)
+    return delta.create(self.base_dir, self.target_dir, self.delta_dir, "base")
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # generate_data
+  #
+  # -------------------------------------------------------------------------
+  def generate_data(self, size):
+    """Returns size random bytes
+    """
+
+    return self.generator.getrandbits(8 * size).to_bytes(size, "little")
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # check_apply
+  #
+  # -------------------------------------------------------------------------
+  def check_apply(self):
+    """Applies the delta and checks the reconstructed target
+    """
+
+    delta = FirmwareDelta(logging.getLogger(__name__), threads=2)
+    self.assertEqual(delta.apply(self.base_dir, self.delta_dir, self.output_dir), [])
+    with open(os.path.join(self.target_dir, "firmware.squashfs"), "rb") as target_file, \
+         open(os.path.join(self.output_dir, "firmware.squashfs"), "rb") as output_file:
+      self.assertEqual(target_file.read(), output_file.read())
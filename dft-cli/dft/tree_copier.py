@@ -0,0 +1,347 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the copy of directory trees, preserving all the
+metadata (ownership, permissions, times, hard links, extended attributes and
+ACLs, device nodes). It is used instead of running cp for each entry.
+
+The tree is walked once. Directories, links and special files are created
+while walking, and the content of the regular files is copied by a pool of
+threads. Data is cloned (reflink) if the filesystem supports it, otherwise
+it is copied in kernel using copy_file_range.
+"""
+
+import os
+import stat
+import time
+import errno
+import fcntl
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# -----------------------------------------------------------------------------
+#
+#    Class TreeCopier
+#
+# -----------------------------------------------------------------------------
+class TreeCopier(object):
+  """This class copies the content of a source directory into a target
+  directory, as cp -fra would do. Existing files in the target are
+  replaced, and existing directories are merged.
+
+  Errors are raised as OSError, the caller is in charge of handling them.
+  """
+
+  # ioctl used to clone a file (reflink), defined in linux/fs.h
+  FICLONE = 0x40049409
+
+  # Maximum size copied by a single call to copy_file_range
+  COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, logger, threads=None):
+    """Default constructor
+    """
+
+    # Logger used to output messages
+    self.logging = logger
+
+    # Number of threads copying files, default is the number of CPU
+    if threads is None or threads <= 0:
+      threads = os.cpu_count()
+    self.threads = threads
+
+    # Statistics of the last copy, used for the throughput report
+    self.file_count = 0
+    self.byte_count = 0
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # copy
+  #
+  # -------------------------------------------------------------------------
+  def copy(self, source, target, follow_symlinks=False):
+    """This method copies the content of the source directory into the target
+    directory, which is created if needed. If follow_symlinks is True, the
+    content pointed by the symbolic links is copied instead of the links.
+
+    As cp -a does, the copy fails (raising OSError) if a directory of the
+    source cannot be read, instead of producing an incomplete tree.
+    """
+
+    # Reset statistics
+    start_time = time.time()
+    self.file_count = 0
+    self.byte_count = 0
+
+    # Directories metadata is applied once their content has been written, and hard links are
+    # created once the file they link to has been copied
+    directories = []
+    hard_links = []
+    copied_inodes = {}
+
+    # Walk the tree once, and fan out file copies to the pool
+    with ThreadPoolExecutor(max_workers=self.threads) as executor:
+      futures = []
+      os.makedirs(target, exist_ok=True)
+      directories.append((source, target))
+      for root, dirnames, filenames in os.walk(source, followlinks=follow_symlinks,
+                                               onerror=self.__raise_walk_error):
+        target_root = os.path.join(target, os.path.relpath(root, source))
+
+        # Process the directories. os.walk lists the links to directories among them
+        for name in dirnames:
+          source_path = os.path.join(root, name)
+          target_path = os.path.join(target_root, name)
+          if not follow_symlinks and os.path.islink(source_path):
+            self.__copy_symlink(source_path, target_path)
+          else:
+            self.__remove_target(target_path, keep_directory=True)
+            os.makedirs(target_path, exist_ok=True)
+            directories.append((source_path, target_path))
+
+        # Then the other entries
+        for name in filenames:
+          source_path = os.path.join(root, name)
+          target_path = os.path.join(target_root, name)
+          source_stat = os.stat(source_path, follow_symlinks=follow_symlinks)
+
+          if stat.S_ISLNK(source_stat.st_mode):
+            self.__copy_symlink(source_path, target_path)
+          elif stat.S_ISREG(source_stat.st_mode):
+            # Files with several links in the source tree are copied once
+            inode = (source_stat.st_dev, source_stat.st_ino)
+            if source_stat.st_nlink > 1 and inode in copied_inodes:
+              hard_links.append((copied_inodes[inode], target_path))
+              continue
+            copied_inodes[inode] = target_path
+            futures.append(executor.submit(self.__copy_file, source_path, target_path,
+                                           source_stat))
+          else:
+            self.__copy_special_file(source_path, target_path, source_stat)
+
+      # Wait for the copies, errors are raised here
+      for future in futures:
+        future.result()
+
+    # Create the hard links
+    for link_target, link_path in hard_links:
+      self.__remove_target(link_path)
+      os.link(link_target, link_path)
+
+    # Apply directories metadata, deepest first, since creating entries modifies times
+    for source_path, target_path in reversed(directories):
+      self.__copy_metadata(source_path, target_path,
+                           os.stat(source_path, follow_symlinks=follow_symlinks))
+
+    # Output the throughput
+    elapsed = max(time.time() - start_time, 0.001)
+    self.logging.info("Copied %d files (%.1f MB) from %s in %.2f seconds (%.1f MB/s)" %
+                      (self.file_count, self.byte_count / 1048576, source, elapsed,
+                       self.byte_count / 1048576 / elapsed))
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __copy_file
+  #
+  # -------------------------------------------------------------------------
+  def __copy_file(self, source_path, target_path, source_stat):
+    """This method copies a regular file and its metadata. Data is cloned
+    if possible, then copied in kernel, and finally in user space.
+    """
+
+    # Existing target is replaced
+    self.__remove_target(target_path)
+
+    # Copy the data
+    with open(source_path, "rb") as source_file, open(target_path, "wb") as target_file:
+      if not self.__clone_file(source_file, target_file):
+        self.__copy_file_range(source_file, target_file, source_stat.st_size)
+
+    # Then the metadata
+    self.__copy_metadata(source_path, target_path, source_stat)
+
+    # Update statistics. Integer operations are atomic enough under the GIL for a report
+    self.file_count += 1
+    self.byte_count += source_stat.st_size
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __clone_file
+  #
+  # -------------------------------------------------------------------------
+  def __clone_file(self, source_file, target_file):
+    """This method clones the data of the source file into the target file
+    (reflink). It returns False if the filesystem does not support it.
+    """
+
+    try:
+      fcntl.ioctl(target_file.fileno(), self.FICLONE, source_file.fileno())
+      return True
+    except OSError:
+      return False
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __copy_file_range
+  #
+  # -------------------------------------------------------------------------
+  def __copy_file_range(self, source_file, target_file, size):
+    """This method copies the data in kernel using copy_file_range. If it is
+    not supported, the data is copied in user space.
+    """
+
+    # Copy by chunks until the end of the file
+    copied = 0
+    try:
+      while copied < size:
+        count = os.copy_file_range(source_file.fileno(), target_file.fileno(),
+                                   min(self.COPY_CHUNK_SIZE, size - copied))
+        if count == 0:
+          break
+        copied += count
+      return
+    except (AttributeError, OSError) as exception:
+      # Only fallback if the call is not supported, other errors are real errors
+      if isinstance(exception, OSError) and exception.errno not in \
+         (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+        raise
+
+    # Fallback to a copy in user space, from where copy_file_range stopped
+    source_file.seek(copied)
+    target_file.seek(copied)
+    shutil.copyfileobj(source_file, target_file)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __copy_symlink
+  #
+  # -------------------------------------------------------------------------
+  def __copy_symlink(self, source_path, target_path):
+    """This method copies a symbolic link and its metadata.
+    """
+
+    self.__remove_target(target_path)
+    os.symlink(os.readlink(source_path), target_path)
+    self.__copy_metadata(source_path, target_path, os.lstat(source_path))
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __copy_special_file
+  #
+  # -------------------------------------------------------------------------
+  def __copy_special_file(self, source_path, target_path, source_stat):
+    """This method copies device nodes, fifos and sockets, and their
+    metadata.
+    """
+
+    self.__remove_target(target_path)
+    if stat.S_ISFIFO(source_stat.st_mode):
+      os.mkfifo(target_path, stat.S_IMODE(source_stat.st_mode))
+    else:
+      os.mknod(target_path, source_stat.st_mode, source_stat.st_rdev)
+    self.__copy_metadata(source_path, target_path, source_stat)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __copy_metadata
+  #
+  # -------------------------------------------------------------------------
+  def __copy_metadata(self, source_path, target_path, source_stat):
+    """This method copies ownership, permissions, extended attributes (which
+    include ACLs) and times. Ownership is set first, since changing it
+    clears the setuid and setgid bits.
+    """
+
+    # Symbolic links have no permissions, and their metadata is set on the link itself
+    is_link = stat.S_ISLNK(source_stat.st_mode)
+    os.chown(target_path, source_stat.st_uid, source_stat.st_gid, follow_symlinks=False)
+    if not is_link:
+      os.chmod(target_path, stat.S_IMODE(source_stat.st_mode))
+
+    # Copy the extended attributes, if both filesystems support them
+    try:
+      for name in os.listxattr(source_path, follow_symlinks=not is_link):
+        value = os.getxattr(source_path, name, follow_symlinks=not is_link)
+        os.setxattr(target_path, name, value, follow_symlinks=not is_link)
+    except OSError as exception:
+      if exception.errno not in (errno.ENOTSUP, errno.EPERM):
+        raise
+
+    # Times are set last
+    os.utime(target_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns),
+             follow_symlinks=False)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __remove_target
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def __remove_target(target_path, keep_directory=False):
+    """This method removes an existing target before it is replaced. A
+    directory is kept if a directory is copied over it.
+    """
+
+    # Nothing to do if it does not exist
+    if not os.path.lexists(target_path):
+      return
+
+    # Directories are merged or removed
+    if os.path.isdir(target_path) and not os.path.islink(target_path):
+      if not keep_directory:
+        shutil.rmtree(target_path)
+    else:
+      os.remove(target_path)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # __raise_walk_error
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def __raise_walk_error(error):
+    """This method is called by os.walk when a directory cannot be listed.
+    The error is raised, since os.walk would otherwise skip the directory.
+    """
+
+    raise error
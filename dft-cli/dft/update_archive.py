@@ -0,0 +1,467 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the writer of the firmware update archives. The
+archive is a tar file whose first member is a manifest listing the path,
+size, mode and sha256 of each archived file. Thus a device can check the
+files while extracting the archive as a stream.
+
+Archives can also be written as a stream, compressed by an external tool
+and signed from the bytes written, without reading the archive again.
+"""
+
+import io
+import os
+import json
+import stat
+import time
+import hashlib
+import tarfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dft.file_hasher import FileHasher
+
+# -----------------------------------------------------------------------------
+#
+#    Class HashingReader
+#
+# -----------------------------------------------------------------------------
+class HashingReader(object):
+  """This class wraps a file opened for reading. Each block read by tarfile
+  is also given to a hasher running in a thread pool, thus the file is read
+  once, and hashing overlaps writing the archive.
+  """
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, source_file, executor):
+    """Default constructor
+    """
+
+    # File to read, pool running the hasher and last hashing task. Blocks are hashed in
+    # order since each task waits for the previous one
+    self.source_file = source_file
+    self.executor = executor
+    self.hasher = hashlib.sha256()
+    self.pending = None
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # read
+  #
+  # -------------------------------------------------------------------------
+  def read(self, size=-1):
+    """Reads a block from the file, and queues it for hashing
+    """
+
+    # Read the block then wait for the previous one to be hashed, and submit this one
+    block = self.source_file.read(size)
+    if len(block) > 0:
+      if self.pending is not None:
+        self.pending.result()
+      self.pending = self.executor.submit(self.hasher.update, block)
+    return block
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # hexdigest
+  #
+  # -------------------------------------------------------------------------
+  def hexdigest(self):
+    """Waits for the last block and returns the digest of the file
+    """
+
+    if self.pending is not None:
+      self.pending.result()
+    return self.hasher.hexdigest()
+
+
+
+# -----------------------------------------------------------------------------
+#
+#    Class UpdateArchive
+#
+# -----------------------------------------------------------------------------
+class UpdateArchive(object):
+  """This class writes a directory into an update archive, with the manifest
+  as first member.
+
+  The manifest is written in JSON Lines format, one file per line. Since all
+  its fields but the digests are known before the files are read, and since
+  digests have a fixed length, its size is known in advance. A placeholder
+  is written first, and replaced once the files have been archived and
+  hashed. The archive file thus has to be seekable.
+  """
+
+  # Name of the manifest member
+  MANIFEST_NAME = "dft-manifest.jsonl"
+
+  # Placeholder of the digests in the manifest
+  DIGEST_PLACEHOLDER = "0" * 64
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, logger, threads=None):
+    """Default constructor
+    """
+
+    # Logger used to output messages
+    self.logging = logger
+
+    # Number of threads hashing the files, default is the number of CPU
+    if threads is None or threads <= 0:
+      threads = os.cpu_count()
+    self.threads = threads
+
+    # Manifest of the last archive, as a list of dictionnaries
+    self.manifest = []
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # write
+  #
+  # -------------------------------------------------------------------------
+  def write(self, content_directory, archive_file):
+    """This method archives the content of the directory into the archive
+    file (a seekable file object opened for writing).
+    """
+
+    # Create the members and the manifest entries, in the order of the archive
+    tar = tarfile.open(fileobj=archive_file, mode='w')
+    members = self.list_members(tar, content_directory)
+    self.manifest = [{"path": info.name,
+                      "size": info.size,
+                      "mode": "%04o" % stat.S_IMODE(info.mode),
+                      "sha256": self.DIGEST_PLACEHOLDER}
+                     for _, info in members if info.isreg()]
+
+    # Write the manifest placeholder, and remember where its data starts
+    manifest_data = self.generate_manifest()
+    manifest_info = tarfile.TarInfo(self.MANIFEST_NAME)
+    manifest_info.size = len(manifest_data)
+    manifest_info.mode = 0o644
+    manifest_info.mtime = time.time()
+    tar.addfile(manifest_info, io.BytesIO(manifest_data))
+    blocks = (len(manifest_data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+    manifest_offset = tar.offset - blocks * tarfile.BLOCKSIZE
+
+    # Archive the members. Regular files are hashed while being written
+    digests = iter(self.manifest)
+    with ThreadPoolExecutor(max_workers=self.threads) as executor:
+      for path, info in members:
+        if info.isreg():
+          with open(path, "rb") as source_file:
+            reader = HashingReader(source_file, executor)
+            tar.addfile(info, reader)
+            next(digests)["sha256"] = reader.hexdigest()
+        else:
+          tar.addfile(info)
+    tar.close()
+
+    # Replace the placeholder with the actual manifest. Its length is unchanged
+    manifest_data = self.generate_manifest()
+    end_offset = archive_file.tell()
+    archive_file.seek(manifest_offset)
+    archive_file.write(manifest_data)
+    archive_file.seek(end_offset)
+    self.logging.debug("Manifest of %d files added to the archive" % len(self.manifest))
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # stream
+  #
+  # -------------------------------------------------------------------------
+  def stream(self, content_directory, output):
+    """This method archives the content of the directory into output, which
+    is only written sequentially (for instance an ArchiveStream). Since the
+    manifest cannot be replaced afterwards, the digests are computed by a
+    pool of threads before the archive is written. Files are thus read twice,
+    the second read being usually served by the page cache.
+    """
+
+    # Create the members, and hash the regular files in parallel
+    tar = tarfile.open(fileobj=output, mode='w|')
+    members = self.list_members(tar, content_directory)
+    file_hasher = FileHasher(threads=self.threads)
+    file_hasher.prefetch([(path, ["sha256"]) for path, info in members if info.isreg()])
+
+    # Create the manifest entries, in the order of the archive
+    self.manifest = [{"path": info.name,
+                      "size": info.size,
+                      "mode": "%04o" % stat.S_IMODE(info.mode),
+                      "sha256": file_hasher.hash_file(path, ["sha256"])["sha256"]}
+                     for path, info in members if info.isreg()]
+
+    # Write the manifest, then the members
+    manifest_data = self.generate_manifest()
+    manifest_info = tarfile.TarInfo(self.MANIFEST_NAME)
+    manifest_info.size = len(manifest_data)
+    manifest_info.mode = 0o644
+    manifest_info.mtime = time.time()
+    tar.addfile(manifest_info, io.BytesIO(manifest_data))
+    for path, info in members:
+      if info.isreg():
+        with open(path, "rb") as source_file:
+          tar.addfile(info, source_file)
+      else:
+        tar.addfile(info)
+    tar.close()
+    self.logging.debug("Manifest of %d files added to the archive" % len(self.manifest))
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # list_members
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def list_members(tar, content_directory):
+    """This method returns the list of (path, TarInfo) of the content of the
+    directory. Members names are relative to the directory.
+    """
+
+    # Directories are listed before their content. Hard links are detected by gettarinfo,
+    # thus the order of the calls has to be the order of the archive
+    members = []
+    for root, dirnames, filenames in os.walk(content_directory):
+      dirnames.sort()
+      for name in sorted(dirnames + filenames):
+        path = os.path.join(root, name)
+        info = tar.gettarinfo(path, os.path.relpath(path, content_directory))
+        if info is not None:
+          members.append((path, info))
+    return members
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # generate_manifest
+  #
+  # -------------------------------------------------------------------------
+  def generate_manifest(self):
+    """This method returns the content of the manifest, one JSON document per
+    archived file.
+    """
+
+    return "".join(json.dumps(entry, sort_keys=True) + "\n"
+                   for entry in self.manifest).encode("utf-8")
+
+
+
+# -----------------------------------------------------------------------------
+#
+#    Class ArchiveStream
+#
+# -----------------------------------------------------------------------------
+class ArchiveStream(object):
+  """This class is a file object written sequentially, which stores the
+  data into the archive file. Data is piped through the compression command
+  if one is defined, and the bytes stored into the archive file are also
+  piped into the signing command if one is defined. Thus the archive is
+  compressed and signed while it is written, and never read back.
+
+  Commands read their input from stdin. The compression command writes to
+  stdout, which is read by a thread. The signing command writes the
+  signature by itself (gpg --output).
+  """
+
+  # Size of the blocks read from the output of the compression command
+  BLOCK_SIZE = 1024 * 1024
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, archive_path, compress_command=None, sign_command=None):
+    """Default constructor. The file and the commands are started by open.
+    """
+
+    # Path of the archive and commands used to compress and sign it
+    self.archive_path = archive_path
+    self.compress_command = compress_command
+    self.sign_command = sign_command
+
+    # Archive file and running commands
+    self.archive_file = None
+    self.compressor = None
+    self.signer = None
+
+    # Thread copying the output of the compressor, and the exception it may have raised
+    self.pump = None
+    self.pump_error = None
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # open
+  #
+  # -------------------------------------------------------------------------
+  def open(self):
+    """This method creates the archive file and starts the commands
+    """
+
+    self.archive_file = open(self.archive_path, "wb")
+
+    # The signer is started first, since the compressor output is piped into it
+    if self.sign_command is not None:
+      self.signer = subprocess.Popen(self.sign_command, shell=True, stdin=subprocess.PIPE)
+
+    # Start the compressor and the thread reading its output
+    if self.compress_command is not None:
+      self.compressor = subprocess.Popen(self.compress_command, shell=True,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+      self.pump = threading.Thread(target=self.pump_compressor_output)
+      self.pump.start()
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # write
+  #
+  # -------------------------------------------------------------------------
+  def write(self, data):
+    """Writes data to the archive, through the compressor if any
+    """
+
+    if self.compressor is None:
+      self.store(data)
+    else:
+      try:
+        self.compressor.stdin.write(data)
+      except BrokenPipeError:
+        # The compressor died, its return code reports the error
+        pass
+    return len(data)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # store
+  #
+  # -------------------------------------------------------------------------
+  def store(self, data):
+    """Stores data into the archive file, and pipes it into the signer
+    """
+
+    self.archive_file.write(data)
+    if self.signer is not None:
+      try:
+        self.signer.stdin.write(data)
+      except BrokenPipeError:
+        # The signer died, its return code reports the error
+        pass
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # pump_compressor_output
+  #
+  # -------------------------------------------------------------------------
+  def pump_compressor_output(self):
+    """This method runs in a thread. It stores the output of the compressor
+    until it is closed. Errors are raised again by close.
+    """
+
+    try:
+      while True:
+        block = self.compressor.stdout.read(self.BLOCK_SIZE)
+        if len(block) == 0:
+          break
+        self.store(block)
+    except Exception as exception:
+      self.pump_error = exception
+      # Keep reading, thus the compressor is not blocked on a full pipe
+      while len(self.compressor.stdout.read(self.BLOCK_SIZE)) > 0:
+        pass
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # close
+  #
+  # -------------------------------------------------------------------------
+  def close(self):
+    """This method flushes the data, closes the archive file and waits for
+    the commands. It returns the list of errors (empty on success).
+    """
+
+    errors = []
+
+    # Close the compressor input, and wait for its output to be stored
+    if self.compressor is not None:
+      self.close_pipe(self.compressor.stdin)
+      self.pump.join()
+      returncode = self.compressor.wait()
+      if returncode != 0:
+        errors.append("Error %d occured when executing %s" % (returncode, self.compress_command))
+      if self.pump_error is not None:
+        errors.append("Error while writing " + self.archive_path + " : " + str(self.pump_error))
+
+    # The archive file is complete
+    self.archive_file.close()
+
+    # Close the signer input and wait for the signature
+    if self.signer is not None:
+      self.close_pipe(self.signer.stdin)
+      returncode = self.signer.wait()
+      if returncode != 0:
+        errors.append("Error %d occured when executing %s" % (returncode, self.sign_command))
+
+    return errors
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # close_pipe
+  #
+  # -------------------------------------------------------------------------
+  @staticmethod
+  def close_pipe(pipe):
+    """Closes the input pipe of a command, ignoring the command being dead
+    """
+
+    try:
+      pipe.close()
+    except BrokenPipeError:
+      pass
@@ -0,0 +1,227 @@
+#
+# The contents of this file are subject to the Apache 2.0 license you may not
+# use this file except in compliance with the License.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+#
+# Copyright 2016 DFT project (http://www.firmwaretoolkit.org).
+# All rights reserved. Use is subject to license terms.
+#
+#
+# Contributors list :
+#
+#    William Bonnet     wllmbnnt@gmail.com, wbonnet@theitmakers.com
+#
+#
+
+""" This module implements the generation of the dm-verity hash tree of a
+firmware file. The kernel checks each block against the tree when it is
+read, thus the firmware does not have to be checked before being mounted.
+"""
+
+import os
+import uuid
+import struct
+import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# -----------------------------------------------------------------------------
+#
+#    Class VerityHashTree
+#
+# -----------------------------------------------------------------------------
+class VerityHashTree(object):
+  """This class computes the hash tree of a data file, and writes it in the
+  format of veritysetup format 1 (the default format), including the
+  superblock. The hash file can thus be opened on the device with :
+
+    veritysetup open <data device> <name> <hash device> <root hash>
+
+  The lowest level of the tree contains the digests of the data blocks, the
+  upper levels the digests of the blocks of the level below, until a level
+  fits in a single block. Digests are salted (the salt is hashed before the
+  block). Each digest uses a slot whose size is a power of two, and the
+  hash blocks are padded with zeros. Levels are stored from the top one to
+  the lowest one, after the superblock.
+  """
+
+  # Signature and version of the superblock
+  SIGNATURE = b"verity\0\0"
+  VERSION = 1
+  HASH_TYPE = 1
+
+  # Layout of the superblock : signature, version, hash type, uuid, algorithm, data block
+  # size, hash block size, data blocks, salt size, padding, salt, padding
+  SUPERBLOCK_FORMAT = "<8sII16s32sIIQH6x256s168x"
+
+  # Maximum salt size
+  MAX_SALT_SIZE = 256
+
+  # Number of data blocks hashed by each task
+  BLOCKS_PER_TASK = 256
+
+  # -------------------------------------------------------------------------
+  #
+  # __init__
+  #
+  # -------------------------------------------------------------------------
+  def __init__(self, algorithm="sha256", block_size=4096, salt=None, threads=None):
+    """Default constructor. The same block size is used for data and hash
+    blocks. salt is a bytes object, a random 32 bytes salt is generated if
+    it is None.
+    """
+
+    # Parameters of the tree
+    self.algorithm = algorithm
+    self.block_size = block_size
+    self.salt = os.urandom(32) if salt is None else salt
+
+    # Size of the digests, and of the slots they use in the hash blocks
+    self.digest_size = hashlib.new(algorithm).digest_size
+    self.hashes_per_block = 1
+    while self.hashes_per_block * 2 * self.digest_size <= block_size:
+      self.hashes_per_block *= 2
+    self.slot_size = block_size // self.hashes_per_block
+
+    # Number of threads hashing the data blocks, default is the number of CPU
+    if threads is None or threads <= 0:
+      threads = os.cpu_count()
+    self.threads = threads
+
+    # Results of the last computation
+    self.data_blocks = 0
+    self.levels = []
+    self.root_hash = None
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # check_parameters
+  #
+  # -------------------------------------------------------------------------
+  def check_parameters(self):
+    """This method returns the list of the errors in the parameters of the
+    tree (empty if they are valid).
+    """
+
+    errors = []
+    if self.block_size < 512 or self.block_size & (self.block_size - 1) != 0:
+      errors.append("block size must be a power of 2, and at least 512 (%d)" % self.block_size)
+    elif self.digest_size > self.block_size:
+      errors.append("digests of " + self.algorithm + " do not fit in a block")
+    if len(self.salt) > self.MAX_SALT_SIZE:
+      errors.append("salt is longer than %d bytes" % self.MAX_SALT_SIZE)
+    if len(self.algorithm) >= 32:
+      errors.append("algorithm name is too long (" + self.algorithm + ")")
+    return errors
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # compute
+  #
+  # -------------------------------------------------------------------------
+  def compute(self, data_path):
+    """This method computes the hash tree of the data file, whose size must
+    be a multiple of the block size. It returns the root hash, as an hex
+    string.
+    """
+
+    # Hash the data blocks. Chunks are hashed by the pool, within a limit of pending chunks
+    # to bound the memory used
+    data_hashes = []
+    pending = collections.deque()
+    chunk_size = self.block_size * self.BLOCKS_PER_TASK
+    with open(data_path, "rb") as data_file, \
+         ThreadPoolExecutor(max_workers=self.threads) as executor:
+      chunk = data_file.read(chunk_size)
+      while len(chunk) > 0:
+        if len(chunk) % self.block_size != 0:
+          raise ValueError(data_path + " size is not a multiple of %d" % self.block_size)
+        pending.append(executor.submit(self.hash_blocks, chunk))
+        if len(pending) >= self.threads * 2:
+          data_hashes.append(pending.popleft().result())
+        chunk = data_file.read(chunk_size)
+      while len(pending) > 0:
+        data_hashes.append(pending.popleft().result())
+
+    # Build the levels from the lowest one, until a level fits in a single block. A single
+    # data block has no hash level, its digest is the root hash
+    level = b"".join(data_hashes)
+    self.data_blocks = len(level) // self.slot_size
+    if self.data_blocks == 0:
+      raise ValueError(data_path + " is empty")
+    self.levels = []
+    while len(level) > self.slot_size:
+      level = self.pad(level)
+      self.levels.append(level)
+      level = self.hash_blocks(level)
+
+    # The root hash is the digest of the top level block
+    self.root_hash = level[:self.digest_size].hex()
+    return self.root_hash
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # hash_blocks
+  #
+  # -------------------------------------------------------------------------
+  def hash_blocks(self, data):
+    """This method returns the salted digests of the blocks of data, each
+    digest being padded to the slot size.
+    """
+
+    view = memoryview(data)
+    padding = bytes(self.slot_size - self.digest_size)
+    digests = []
+    for offset in range(0, len(data), self.block_size):
+      hasher = hashlib.new(self.algorithm, self.salt)
+      hasher.update(view[offset:offset + self.block_size])
+      digests.append(hasher.digest() + padding)
+    return b"".join(digests)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # pad
+  #
+  # -------------------------------------------------------------------------
+  def pad(self, level):
+    """Pads a level with zeros, up to a multiple of the block size
+    """
+
+    return level + bytes(-len(level) % self.block_size)
+
+
+
+  # -------------------------------------------------------------------------
+  #
+  # write
+  #
+  # -------------------------------------------------------------------------
+  def write(self, hash_path):
+    """This method writes the superblock and the levels of the last computed
+    tree into the hash file.
+    """
+
+    # The superblock is padded to a hash block
+    superblock = struct.pack(self.SUPERBLOCK_FORMAT, self.SIGNATURE, self.VERSION,
+                             self.HASH_TYPE, uuid.uuid4().bytes,
+                             self.algorithm.encode("ascii"), self.block_size, self.block_size,
+                             self.data_blocks, len(self.salt), self.salt)
+
+    # Levels are written from the top one
+    with open(hash_path, "wb") as hash_file:
+      hash_file.write(self.pad(superblock))
+      for level in reversed(self.levels):
+        hash_file.write(level)